@@ -0,0 +1,381 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import compression
+import framing
+import udp_transfer
+from server import raise_fd_limit
+
+# Load generator: drives a server with many simulated clients over the real
+# protocol and prints the results as JSON, so runs against different server
+# versions can be compared. Chat messages carry "bench:<send time>" and the
+# receiving client works out the delivery latency from it.
+
+MARKER = "bench:"
+CONNECT_BATCH = 200 # Connections opened at once during setup
+QUIET_PERIOD = 0.5 # Seconds without new frames before the server counts as settled
+DRAIN_TIMEOUT = 10.0 # Give up waiting for deliveries after this long without progress
+BENCH_FILE = "bench.bin"
+
+class BenchClient:
+    """One simulated user: a connection, a frame reader task and delivery counters."""
+
+    def __init__(self, stats, name, compress=False):
+        self.stats = stats
+        self.name = name
+        self.compress = compress # Offer compression at JOIN
+        self.codec = None
+        self.reader = None
+        self.writer = None
+        self.task = None
+        self.welcomed = asyncio.Event()
+        self.download = None # Future resolved when the current TCP download completes
+        self.remaining = 0
+        self.udp_start = None # Future resolved with the FILE_START_UDP payload
+
+    async def connect(self, host, port):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        self.task = asyncio.create_task(self.read_loop())
+        await self.welcomed.wait()
+        self.send(framing.JOIN, f"{self.name} {compression.offer()}" if self.compress else self.name)
+
+    def send(self, opcode, payload=b""):
+        if isinstance(payload, str):
+            payload = payload.encode()
+        self.writer.write(compression.encode_frame(opcode, payload, self.codec))
+
+    async def read_loop(self):
+        frames = framing.FrameReader()
+        stats = self.stats
+        while True:
+            data = await self.reader.read(1 << 20)
+            if not data:
+                return
+            frames.feed(data)
+            now = time.perf_counter_ns()
+            for opcode, payload in frames.frames():
+                stats["frames"] += 1
+                opcode, payload = compression.decode(opcode, payload, self.codec)
+                if opcode == framing.FILE_DATA:
+                    self.remaining -= len(payload)
+                    if self.remaining <= 0 and self.download:
+                        self.download.set_result(None)
+                        self.download = None
+                elif opcode == framing.FILE_START_TCP:
+                    size, offset, _ = payload.decode().split(" ", 2)
+                    self.remaining = int(size) - int(offset)
+                elif opcode == framing.CAPABILITIES:
+                    agreed = compression.parse_capabilities(payload.decode()).get("compress", [])
+                    self.codec = compression.CODECS.get(agreed[0]) if agreed else None
+                elif opcode == framing.PING:
+                    self.send(framing.PONG)
+                elif opcode == framing.FILE_START_UDP:
+                    if self.udp_start:
+                        self.udp_start.set_result(payload.decode())
+                        self.udp_start = None
+                else:
+                    text = payload.decode(errors='ignore')
+                    pos = text.rfind(MARKER)
+                    if pos >= 0:
+                        sent = int(text[pos + len(MARKER):])
+                        stats["latencies"].append(now - sent)
+                    elif not self.welcomed.is_set():
+                        self.welcomed.set()
+
+    async def close(self):
+        try:
+            self.send(framing.EXIT)
+            self.writer.close()
+        except (ConnectionError, RuntimeError):
+            pass
+        if self.task:
+            self.task.cancel()
+
+def stamp():
+    return f"{MARKER}{time.perf_counter_ns()}"
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    return sorted_values[index]
+
+def latency_summary(latencies):
+    values = sorted(latencies)
+    ms = lambda ns: None if ns is None else round(ns / 1e6, 3)
+    return {
+        "p50_ms": ms(percentile(values, 0.50)),
+        "p99_ms": ms(percentile(values, 0.99)),
+        "p999_ms": ms(percentile(values, 0.999)),
+        "max_ms": ms(values[-1] if values else None),
+    }
+
+async def wait_quiet(stats):
+    # JOIN announcements and group replies fan out to everyone; let them finish first
+    last = -1
+    while stats["frames"] != last:
+        last = stats["frames"]
+        await asyncio.sleep(QUIET_PERIOD)
+
+async def wait_deliveries(stats, expected):
+    last, last_change = -1, time.monotonic()
+    while len(stats["latencies"]) < expected:
+        count = len(stats["latencies"])
+        if count != last:
+            last, last_change = count, time.monotonic()
+        elif time.monotonic() - last_change > DRAIN_TIMEOUT:
+            break
+        await asyncio.sleep(0.005)
+
+async def drain_all(clients):
+    await asyncio.gather(*(c.writer.drain() for c in clients), return_exceptions=True)
+
+async def run_chat(stats, senders, expected, send_one, messages):
+    """Sends 'messages' rounds from every sender and times delivery of all copies."""
+    stats["latencies"] = []
+    start = time.perf_counter()
+    for _ in range(messages):
+        for client in senders:
+            send_one(client)
+        await drain_all(senders)
+    await wait_deliveries(stats, expected)
+    elapsed = time.perf_counter() - start
+    delivered = len(stats["latencies"])
+    result = {
+        "sent": messages * len(senders),
+        "expected_deliveries": expected,
+        "delivered": delivered,
+        "seconds": round(elapsed, 3),
+        "deliveries_per_sec": round(delivered / elapsed, 1),
+    }
+    result.update(latency_summary(stats["latencies"]))
+    return result
+
+async def scenario_broadcast(stats, clients, args):
+    senders = clients[:args.senders]
+    expected = len(senders) * args.messages * (len(clients) - 1)
+    send = lambda c: c.send(framing.BROADCAST, stamp())
+    return await run_chat(stats, senders, expected, send, args.messages)
+
+async def scenario_unicast(stats, clients, args):
+    n = len(clients)
+    pairs = {c: clients[(i + random.randrange(1, n)) % n] for i, c in enumerate(clients)}
+    expected = len(clients) * args.messages
+    send = lambda c: c.send(framing.UNICAST, f"{pairs[c].name} {stamp()}")
+    return await run_chat(stats, clients, expected, send, args.messages)
+
+async def scenario_small_groups(stats, clients, args):
+    size = args.group_size
+    groups = {c: f"g{i // size}" for i, c in enumerate(clients)}
+    for client, group in groups.items():
+        client.send(framing.JOIN_GROUP, group)
+    await drain_all(clients)
+    await wait_quiet(stats)
+    members = {}
+    for group in groups.values():
+        members[group] = members.get(group, 0) + 1
+    expected = sum(members[g] - 1 for g in groups.values()) * args.messages
+    send = lambda c: c.send(framing.GROUP_MSG, f"{groups[c]} {stamp()}")
+    result = await run_chat(stats, clients, expected, send, args.messages)
+    for client, group in groups.items():
+        client.send(framing.LEAVE_GROUP, group)
+    await wait_quiet(stats)
+    result["groups"] = len(members)
+    return result
+
+async def scenario_huge_group(stats, clients, args):
+    for client in clients:
+        client.send(framing.JOIN_GROUP, "everyone")
+    await drain_all(clients)
+    await wait_quiet(stats)
+    senders = clients[:args.senders]
+    expected = len(senders) * args.messages * (len(clients) - 1)
+    send = lambda c: c.send(framing.GROUP_MSG, f"everyone {stamp()}")
+    result = await run_chat(stats, senders, expected, send, args.messages)
+    for client in clients:
+        client.send(framing.LEAVE_GROUP, "everyone")
+    await wait_quiet(stats)
+    return result
+
+async def download_tcp(client, filename):
+    client.download = asyncio.get_running_loop().create_future()
+    start = time.perf_counter()
+    client.send(framing.DOWNLOAD_TCP, filename)
+    await client.download
+    return time.perf_counter() - start
+
+def receive_udp(sock, start_payload, codec):
+    """Returns (ok, time.monotonic() of the last packet), which leaves out the receiver's linger for late retransmits."""
+    size, transfer_id, chunk_size, _ = start_payload.split(" ", 3)
+    with tempfile.TemporaryFile() as f:
+        receiver = udp_transfer.UdpReceiver(sock, f, int(size), int(transfer_id), int(chunk_size), codec)
+        ok = receiver.run()
+    sock.close()
+    return ok, receiver.finished
+
+async def download_udp(client, filename):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('0.0.0.0', 0))
+    udp_transfer.set_buffers(sock)
+    client.udp_start = asyncio.get_running_loop().create_future()
+    start = time.monotonic() # The receiver stamps its last packet with the same clock
+    client.send(framing.DOWNLOAD_UDP, f"{filename} {sock.getsockname()[1]}")
+    payload = await client.udp_start
+    ok, finished = await asyncio.to_thread(receive_udp, sock, payload, client.codec)
+    return (finished or time.monotonic()) - start, ok
+
+async def scenario_files(stats, clients, args):
+    size = args.file_mb * 1024 * 1024
+    mb = size / (1024 * 1024)
+    result = {"file_bytes": size}
+    seconds = await download_tcp(clients[0], BENCH_FILE)
+    result["tcp_seconds"] = round(seconds, 3)
+    result["tcp_mb_per_sec"] = round(mb / seconds, 1)
+    seconds, ok = await download_udp(clients[0], BENCH_FILE)
+    result["udp_seconds"] = round(seconds, 3)
+    result["udp_mb_per_sec"] = round(mb / seconds, 1) if ok else None
+    # Several clients downloading at once
+    downloaders = clients[:args.downloaders]
+    start = time.perf_counter()
+    await asyncio.gather(*(download_tcp(c, BENCH_FILE) for c in downloaders))
+    seconds = time.perf_counter() - start
+    result["parallel_tcp_downloads"] = len(downloaders)
+    result["parallel_tcp_mb_per_sec"] = round(mb * len(downloaders) / seconds, 1)
+    return result
+
+async def scenario_mixed(stats, clients, args):
+    """Broadcast chat while some clients pull the bench file over TCP."""
+    downloaders = clients[-args.downloaders:]
+    downloads = asyncio.gather(*(download_tcp(c, BENCH_FILE) for c in downloaders))
+    result = await scenario_broadcast(stats, clients, args)
+    start = time.perf_counter()
+    await downloads
+    result["downloads"] = len(downloaders)
+    result["download_wait_seconds"] = round(time.perf_counter() - start, 3)
+    return result
+
+SCENARIOS = {
+    "broadcast": scenario_broadcast,
+    "unicast": scenario_unicast,
+    "small_groups": scenario_small_groups,
+    "huge_group": scenario_huge_group,
+    "files": scenario_files,
+    "mixed": scenario_mixed,
+}
+
+async def connect_all(stats, host, port, count, compress):
+    clients = [BenchClient(stats, f"bench{i}", compress) for i in range(count)]
+    start = time.perf_counter()
+    for i in range(0, count, CONNECT_BATCH):
+        batch = clients[i:i + CONNECT_BATCH]
+        await asyncio.gather(*(c.connect(host, port) for c in batch))
+    elapsed = time.perf_counter() - start
+    await drain_all(clients)
+    await wait_quiet(stats)
+    return clients, {
+        "clients": count,
+        "seconds": round(elapsed, 3),
+        "connections_per_sec": round(count / elapsed, 1),
+        "join_settle_seconds": round(time.perf_counter() - start - elapsed, 3),
+    }
+
+async def run(args, host, port):
+    stats = {"frames": 0, "latencies": []}
+    clients, connect = await connect_all(stats, host, port, args.clients, args.compress)
+    results = {"connect": connect}
+    for name in args.scenarios:
+        print(f"Running {name}...", file=sys.stderr)
+        results[name] = await SCENARIOS[name](stats, clients, args)
+        await wait_quiet(stats)
+    for client in clients:
+        await client.close()
+    return results
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def start_server(args, shared_dir):
+    with open(os.path.join(shared_dir, BENCH_FILE), "wb") as f:
+        f.write(os.urandom(args.file_mb * 1024 * 1024))
+    port = free_port()
+    # Flood control would throttle the load generators themselves
+    env = dict(os.environ, SERVER_SHARED_FILES=shared_dir, SERVER_WORKERS=str(args.workers),
+               SERVER_MSG_RATE="0", SERVER_GROUP_RATE="0")
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), args.server)
+    process = subprocess.Popen([sys.executable, script, str(port)], env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return process, port
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError(f"{args.server} did not start listening on port {port}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Load generator for the messenger server; prints JSON results.")
+    parser.add_argument("--server", default="server.py", help="server script to start (server.py or server_async.py)")
+    parser.add_argument("--connect", metavar="HOST:PORT", help=f"use a running server instead (its shared folder needs {BENCH_FILE})")
+    parser.add_argument("--workers", type=int, default=1, help="SERVER_WORKERS for the started server")
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--senders", type=int, default=10, help="clients sending in the broadcast and huge group scenarios")
+    parser.add_argument("--messages", type=int, default=20, help="messages per sender")
+    parser.add_argument("--group-size", type=int, default=10)
+    parser.add_argument("--downloaders", type=int, default=4)
+    parser.add_argument("--file-mb", type=int, default=50)
+    parser.add_argument("--compress", action="store_true", help="clients offer compression at JOIN")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma separated, from: " + ", ".join(SCENARIOS))
+    parser.add_argument("--output", help="write the JSON here instead of stdout")
+    args = parser.parse_args()
+    args.scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error(f"unknown scenario '{name}'")
+
+    raise_fd_limit()
+    process = None
+    with tempfile.TemporaryDirectory() as shared_dir:
+        if args.connect:
+            host, port = args.connect.rsplit(":", 1)
+            port = int(port)
+        else:
+            process, port = start_server(args, shared_dir)
+            host = "127.0.0.1"
+        try:
+            results = asyncio.run(run(args, host, port))
+        finally:
+            if process:
+                process.terminate()
+                process.wait()
+
+    report = {
+        "server": args.connect or args.server,
+        "workers": args.workers,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": {k: getattr(args, k) for k in ("clients", "senders", "messages", "group_size", "downloaders", "file_mb", "compress")},
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    main()
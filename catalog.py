@@ -0,0 +1,131 @@
+import bisect
+import hashlib
+import os
+import time
+
+import framing
+
+LIST_PAGE = 1000 # Most names in one FILES_LIST reply
+HASH_BLOCK = 1024 * 1024
+MIN_CHUNK = 4 * 1024 * 1024 # Parallel download chunk size, grown for big files
+MAX_CHUNKS = 10000
+
+class FileEntry:
+    __slots__ = ("name", "size", "mtime_ns", "digest", "chunks")
+
+    def __init__(self, name, size, mtime_ns):
+        self.name = name
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.digest = None # SHA-256 hex, worked out on first use
+        self.chunks = None # (chunk_size, [SHA-256 hex per chunk]) for parallel downloads
+
+class Catalog:
+    """
+    In-memory index of the shared folder: one FileEntry per file, plus the
+    sorted names for paging and prefix search. The folder is re-read (on a
+    worker thread, via scan()) only when its mtime has changed, at most once
+    per poll interval, and unchanged entries are carried over. The first page
+    of the listing is kept as an encoded FILES_LIST frame until the next change.
+    """
+
+    def __init__(self, directory, poll_interval):
+        self.directory = directory
+        self.poll_interval = poll_interval
+        self.entries = {} # name -> FileEntry
+        self.names = [] # Sorted
+        self.dir_mtime = None
+        self.checked = 0.0 # time.monotonic() of the last scan
+        self.refreshing = False # A scan is running on a worker
+        self.waiting = [] # Callbacks to run once that scan is applied
+        self.first_page = None # Encoded reply to a LIST_FILES without arguments
+
+    def stale(self):
+        return time.monotonic() - self.checked >= self.poll_interval
+
+    def scan(self):
+        """Worker job. Returns (dir_mtime, entries), or None if the folder has not changed."""
+        st = os.stat(self.directory)
+        if st.st_mtime_ns == self.dir_mtime:
+            return None
+        old = self.entries
+        entries = {}
+        with os.scandir(self.directory) as it:
+            for item in it:
+                if not item.is_file():
+                    continue
+                info = item.stat()
+                entry = old.get(item.name)
+                if entry is None or entry.size != info.st_size or entry.mtime_ns != info.st_mtime_ns:
+                    entry = FileEntry(item.name, info.st_size, info.st_mtime_ns)
+                entries[item.name] = entry
+        dir_mtime = st.st_mtime_ns
+        if time.time_ns() - dir_mtime < 2 * 10**9:
+            # A file added in the same clock tick would not move the mtime again; check once more next time
+            dir_mtime = None
+        return dir_mtime, entries
+
+    def apply(self, result):
+        """Installs a scan() result on the loop thread and runs the callbacks waiting for it."""
+        self.checked = time.monotonic()
+        self.refreshing = False
+        if result is not None:
+            self.dir_mtime, self.entries = result
+            self.names = sorted(self.entries)
+            self.first_page = None
+        callbacks, self.waiting = self.waiting, []
+        for callback in callbacks:
+            callback()
+
+    def find(self, name):
+        return self.entries.get(name)
+
+    def listing(self, offset=0, limit=LIST_PAGE, prefix=""):
+        """FILES_LIST frame for up to 'limit' names starting with 'prefix', skipping the first 'offset'."""
+        default = offset == 0 and limit == LIST_PAGE and not prefix
+        if default and self.first_page is not None:
+            return self.first_page
+        names = self.names
+        lo = bisect.bisect_left(names, prefix) if prefix else 0
+        hi = bisect.bisect_left(names, prefix + "\U0010ffff") if prefix else len(names)
+        total = hi - lo
+        page = names[lo + offset:min(hi, lo + offset + limit)]
+        if not page:
+            text = f"{total} files available:\nNo files available."
+        elif len(page) == total:
+            text = f"{total} files available:\n" + "\n".join(page)
+        else:
+            text = f"{total} files available, showing {offset + 1}-{offset + len(page)}:\n" + "\n".join(page)
+            if offset + len(page) < total:
+                text += f"\n(more from offset {offset + len(page)})"
+        frame = framing.encode_frame(framing.FILES_LIST, text)
+        if default:
+            self.first_page = frame
+        return frame
+
+    def manifest(self, name):
+        """
+        Worker job: (size, chunk_size, file digest, chunk digests) for 'name', or
+        None if it has gone. Cached on the entry until the size or mtime changes.
+        """
+        entry = self.entries.get(name)
+        if entry is None:
+            return None
+        path = os.path.join(self.directory, name)
+        try:
+            info = os.stat(path)
+        except FileNotFoundError:
+            return None
+        if entry.chunks is not None and (info.st_size, info.st_mtime_ns) == (entry.size, entry.mtime_ns):
+            return (entry.size, entry.chunks[0], entry.digest, entry.chunks[1])
+        chunk_size = max(MIN_CHUNK, -(-info.st_size // MAX_CHUNKS))
+        digests = []
+        whole = hashlib.sha256()
+        with open(path, "rb") as f:
+            while chunk := f.read(chunk_size):
+                digests.append(hashlib.sha256(chunk).hexdigest())
+                whole.update(chunk)
+        entry.size, entry.mtime_ns = info.st_size, info.st_mtime_ns
+        entry.digest = whole.hexdigest()
+        entry.chunks = (chunk_size, digests)
+        return (entry.size, chunk_size, entry.digest, digests)
@@ -1,333 +1,757 @@
+import asyncio
+import hashlib
+import random
+import shutil
 import socket
 import sys
-import threading
 import os
+import threading
 import time
+from collections import deque
+
+import compression
+import framing
+import history
+import udp_transfer
+
+RECV_SIZE = 65536
+LIST_PAGE = 1000 # Names asked for per /list page
+GROUP_PAGE = 100 # Names asked for per /groups or /members page
+PARALLEL_STREAMS = 4 # Connections used by /download <file> PARALLEL unless a count is given
+CHUNK_ATTEMPTS = 3 # Tries per chunk before a parallel download gives up on it
+STREAM_TIMEOUT = 60.0
+FLUSH_INTERVAL = 0.05 # Seconds output is collected for before it is written to the terminal
+RECONNECT_MIN = 0.5 # First wait before reconnecting; doubled after each failed attempt
+RECONNECT_MAX = 30.0
+QUEUE_LIMIT = 1000 # Commands kept while disconnected; more are refused
+PACE_INTERVAL = 0.25 # Seconds between batches when sending queued commands at the server's advertised rate
+
+class Screen:
+    """
+    Terminal output. Lines are collected and written at most once per
+    FLUSH_INTERVAL in a single write, followed by one prompt, so a busy
+    room costs a write per interval instead of a print per message.
+    show() may be called from any thread.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.lines = []
+        self.scheduled = False
+
+    def show(self, text):
+        self.lines.append(text)
+        if not self.scheduled:
+            self.scheduled = True
+            self.loop.call_soon_threadsafe(self.loop.call_later, FLUSH_INTERVAL, self.flush)
+
+    def flush(self):
+        self.scheduled = False
+        lines, self.lines = self.lines, []
+        if lines:
+            sys.stdout.write("\n" + "\n".join(lines) + "\n> ")
+            sys.stdout.flush()
+
+def download_path(username, filename):
+    download_dir = f"{username}_files"
+    os.makedirs(download_dir, exist_ok=True)
+    return download_dir, os.path.join(download_dir, filename)
 
-BUFFER_SIZE = 4096
-
-def recv_all(sock, n):
-    data = b''
-    while len(data) < n:
-        packet = sock.recv(n - len(data))
-        if not packet:
-            return None
-        data += packet
-    return data
+def has_local_copy(username, filename):
+    # Anything a delta download can start from: an older copy, or what an earlier attempt left behind
+    _, file_path = download_path(username, filename)
+    return any(os.path.exists(path) for path in (file_path, file_path + ".part", file_path + ".chunks"))
 
-def receive_messages(sock, username):
+def open_part(file_path):
+    # A fresh .part replaces whatever an earlier parallel attempt left in .chunks,
+    # which missing_chunks would otherwise pick over it
+    try:
+        os.remove(file_path + ".chunks")
+    except FileNotFoundError:
+        pass
+    return open(file_path + ".part", "wb")
+
+class BlockCheck:
+    """Checks a download's bytes against the manifest's per-chunk SHA-256 as they arrive."""
+
+    def __init__(self, chunk_size, digests):
+        self.chunk_size = chunk_size
+        self.digests = digests
+        self.index = 0
+        self.filled = 0 # Bytes of the current chunk hashed so far
+        self.hasher = hashlib.sha256()
+        self.bad = [] # Indexes of the chunks that did not match
+
+    def feed(self, data):
+        view = memoryview(data)
+        while view:
+            take = min(len(view), self.chunk_size - self.filled)
+            self.hasher.update(view[:take])
+            self.filled += take
+            view = view[take:]
+            if self.filled == self.chunk_size:
+                self.end_chunk()
+
+    def end_chunk(self):
+        if self.index >= len(self.digests) or self.hasher.hexdigest() != self.digests[self.index]:
+            self.bad.append(self.index)
+        self.index += 1
+        self.filled = 0
+        self.hasher = hashlib.sha256()
+
+    def close(self):
+        """The chunks that failed, once the last byte has been fed."""
+        if self.filled:
+            self.end_chunk() # The short last chunk
+        self.bad += range(self.index, len(self.digests)) # Never arrived
+        return self.bad
+
+def udp_receiver(sock, filename, expected_size, transfer_id, chunk_size, username, codec, show):
+    # Runs on a thread: the UDP protocol (udp_transfer.py) blocks on its socket with timeouts
+    _, file_path = download_path(username, filename)
+    start = time.monotonic()
+    with open_part(file_path) as f:
+        receiver = udp_transfer.UdpReceiver(sock, f, expected_size, transfer_id, chunk_size, codec)
+        complete = receiver.run()
+    sock.close()
+    elapsed = time.monotonic() - start
+
+    if complete:
+        show(f"UDP transfer of {filename} done: {expected_size} bytes in {elapsed:.2f}s. Checking chunks...")
+    else:
+        show(f"UDP transfer of {filename} timed out: server stopped sending.\n"
+             f"Size: {receiver.cum * chunk_size}/{expected_size} bytes received in order. Fetching the rest over TCP...")
+
+async def udp_download(host, port, username, filename, manifest, sock, transfer_id, chunk_size, codec, show):
+    """A UDP download followed by a check of every chunk, with any that are missing or wrong fetched over TCP."""
+    await asyncio.to_thread(udp_receiver, sock, filename, manifest[0], transfer_id, chunk_size, username, codec, show)
+    await parallel_download(host, port, username, filename, manifest, 1, show)
+
+async def read_frames(reader, writer, frames, codec):
+    data = await reader.read(RECV_SIZE)
+    if not data:
+        raise ConnectionError("Server closed the download stream")
+    frames.feed(data)
+    decoded = []
+    for opcode, payload in frames.frames():
+        opcode, payload = compression.decode(opcode, payload, codec)
+        if opcode == framing.PING:
+            writer.write(framing.encode_frame(framing.PONG))
+        else:
+            decoded.append((opcode, payload))
+    return decoded
+
+class StreamRefused(ConnectionError):
+    """The server turned a download stream away, usually because the user is at its download limit."""
+
+async def open_stream(host, port, username):
+    """A download-only connection for parallel downloads. Returns (reader, writer, FrameReader, codec)."""
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), STREAM_TIMEOUT)
+    writer.write(framing.encode_frame(framing.JOIN, f"{username} stream=1 {compression.offer()}"))
+    frames = framing.FrameReader()
+    reply = None
     while True:
         try:
-            message = sock.recv(BUFFER_SIZE)
-            if not message:
-                print("\nDisconnected from server.")
-                break
-
-            decoded = message.decode(errors='ignore')
-
-            if decoded.startswith("FILE_START_TCP "):
-                # Format: FILE_START_TCP <filename> <size>
-                parts = decoded.split(" ", 2)
-                filename = parts[1]
-                size = int(parts[2])
-                print(f"\nReceiving file '{filename}' ({size} bytes) via TCP...")
-
-                # Check if we have extra data in 'message' beyond the header?
-                # This is tricky with TCP streaming. The header might be combined with body.
-                # Simplified: Assume header is distinct or handle split.
-                # In our server we did time.sleep(0.1) to help separate.
-
-                # Create download dir
-                download_dir = f"{username}_files"
-                if not os.path.exists(download_dir):
-                    os.makedirs(download_dir)
-
-                file_path = os.path.join(download_dir, filename)
-
-                # We need to read 'size' bytes.
-                # But 'message' currently contains the header AND potentially start of data.
-                # We need to strip the header from 'message' bytes-wise.
-                # Since we decoded with 'ignore', we should be careful.
-                # Let's assume for this assignment the sleep(0.1) works and we treat the next recvs as data.
-
-                remaining = size
-                with open(file_path, "wb") as f:
-                    while remaining > 0:
-                        chunk_size = min(remaining, BUFFER_SIZE)
-                        data = sock.recv(chunk_size)
-                        if not data:
-                            print("Connection lost during download.")
-                            break
-                        f.write(data)
-                        remaining -= len(data)
-
-                print(f"File '{filename}' downloaded successfully to {download_dir}.")
-                print(f"Size: {size} bytes.")
-                print("> ", end="", flush=True)
-
-            elif decoded.startswith("FILE_START_UDP "):
-                # Format: FILE_START_UDP <filename> <size>
-                # The data is coming on the UDP port we specified.
-                parts = decoded.split(" ", 2)
-                filename = parts[1]
-                size = int(parts[2])
-                print(f"\nIncoming UDP file '{filename}' ({size} bytes). Expecting on UDP port...")
-                # The UDP listener logic should have been started by the main thread BEFORE sending the request?
-                # Or we start it here?
-                # Actually, the main thread triggers the request.
-                # Ideally main thread starts a UDP listener, then sends request.
-                pass
-
+            received = await asyncio.wait_for(read_frames(reader, writer, frames, None), STREAM_TIMEOUT)
+        except ConnectionError:
+            writer.close()
+            if reply is not None:
+                raise StreamRefused(reply) from None
+            raise
+        for opcode, payload in received:
+            if opcode == framing.CAPABILITIES:
+                agreed = compression.parse_capabilities(payload.decode(errors='ignore')).get("compress", [])
+                return reader, writer, frames, compression.CODECS.get(agreed[0]) if agreed else None
+            reply = payload.decode(errors='ignore') # The welcome message, or why the stream was refused
+
+async def fetch_range(stream, filename, offset, length):
+    """Asks for one chunk on a download stream and returns its bytes."""
+    reader, writer, frames, codec = stream
+    writer.write(compression.encode_frame(framing.DOWNLOAD_RANGE, f"{offset} {length} {filename}".encode(), codec))
+    started = False
+    parts = []
+    received = 0
+    while not started or received < length:
+        for opcode, payload in await asyncio.wait_for(read_frames(reader, writer, frames, codec), STREAM_TIMEOUT):
+            if opcode == framing.FILE_RANGE:
+                started = True
+            elif opcode == framing.FILE_DATA and started:
+                parts.append(payload)
+                received += len(payload)
             else:
-                print(f"\n{decoded}")
-                print("> ", end="", flush=True)
-
-        except Exception as e:
-            print(f"\nError receiving message: {e}")
-            break
-    sock.close()
-    sys.exit(0)
-
-def udp_receiver(port, filename, expected_size, username):
-    download_dir = f"{username}_files"
-    if not os.path.exists(download_dir):
-        os.makedirs(download_dir)
-    file_path = os.path.join(download_dir, filename)
-
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.bind(('0.0.0.0', port))
-    sock.settimeout(5) # Timeout if no data
-
-    received_bytes = 0
-    with open(file_path, "wb") as f:
+                raise ValueError(payload.decode(errors='ignore'))
+    return b"".join(parts)
+
+def store_chunk(part_path, offset, data, digest):
+    # On a thread: hashing a multi-megabyte chunk would otherwise hold up chat
+    if hashlib.sha256(data).hexdigest() != digest:
+        return False
+    with open(part_path, "r+b") as f:
+        f.seek(offset)
+        f.write(data)
+    return True
+
+def missing_chunks(part_path, file_path, size, chunk_size, digests):
+    # On a thread: chunks already on disk are kept if they still match, whether from an earlier
+    # parallel attempt, a cut-off TCP or UDP download, or an older copy of the file (kept until done)
+    if not os.path.exists(part_path):
+        if os.path.exists(file_path + ".part"):
+            os.replace(file_path + ".part", part_path)
+        elif os.path.exists(file_path):
+            shutil.copyfile(file_path, part_path)
+    resuming = os.path.exists(part_path)
+    missing = []
+    with open(part_path, "r+b" if resuming else "wb") as f:
+        f.truncate(size) # Preallocated, so every chunk can be written where it belongs
+        for index, digest in enumerate(digests):
+            if resuming:
+                f.seek(index * chunk_size)
+                if hashlib.sha256(f.read(chunk_size)).hexdigest() == digest:
+                    continue
+            missing.append(index)
+    return missing
+
+async def parallel_download(host, port, username, filename, manifest, streams, show):
+    """
+    Fetches a file as chunks over several connections at once, each chunk
+    written to its own offset and checked against the server's SHA-256.
+    A chunk that fails is retried on its own. The file is assembled as
+    '<filename>.chunks'; chunks already on disk that still match are kept
+    (see missing_chunks), so only the rest cross the network.
+    """
+    size, chunk_size, digest, digests = manifest
+    download_dir, file_path = download_path(username, filename)
+    part_path = file_path + ".chunks"
+    start = time.monotonic()
+    todo = asyncio.Queue()
+    for index in await asyncio.to_thread(missing_chunks, part_path, file_path, size, chunk_size, digests):
+        todo.put_nowait(index)
+    missing = todo.qsize()
+    if missing:
+        streams = max(1, min(streams, missing))
+        show(f"Downloading '{filename}' ({size} bytes) as {missing} of {len(digests)} chunks over {streams} connections...")
+    attempts = [0] * len(digests)
+    failed = []
+    refused = [] # Replies of streams the server turned away
+
+    async def fetch_chunks():
+        # One per stream: takes chunks off the queue until it is empty, putting back any that fail
+        stream = None
+        while not todo.empty():
+            index = todo.get_nowait()
+            offset = index * chunk_size
+            ok = False
+            try:
+                if stream is None:
+                    stream = await open_stream(host, port, username)
+                data = await fetch_range(stream, filename, offset, min(chunk_size, size - offset))
+                ok = await asyncio.to_thread(store_chunk, part_path, offset, data, digests[index])
+                if not ok:
+                    show(f"Chunk {index} of '{filename}' failed its hash check.")
+            except StreamRefused as e:
+                # Over the download limit: this connection bows out and leaves its chunk to the others
+                todo.put_nowait(index)
+                refused.append(str(e))
+                return
+            except (OSError, ValueError, asyncio.TimeoutError, framing.FrameError) as e:
+                show(f"Chunk {index} of '{filename}' failed: {e}")
+                if stream is not None:
+                    stream[1].close()
+                    stream = None
+            if ok:
+                continue
+            attempts[index] += 1
+            if attempts[index] < CHUNK_ATTEMPTS:
+                todo.put_nowait(index)
+            else:
+                failed.append(index)
+        if stream is not None:
+            stream[1].close()
+
+    if missing:
+        await asyncio.gather(*(fetch_chunks() for _ in range(streams)))
+    elapsed = time.monotonic() - start
+    if not todo.empty():
+        # Every stream was turned away before the chunks ran out
+        show(f"Download of {filename} incomplete: {refused[-1]}\n"
+             f"Run /download {filename} again to fetch only the missing chunks.")
+    elif failed:
+        show(f"Download of {filename} incomplete: chunks {sorted(failed)} failed {CHUNK_ATTEMPTS} times.\n"
+             f"Run /download {filename} again to fetch only the missing chunks.")
+    else:
+        os.replace(part_path, file_path)
+        show(f"Download of {filename} complete: {missing} of {len(digests)} chunks fetched. Saved to {download_dir}.\n"
+             f"Size: {size} bytes in {elapsed:.2f}s. SHA-256 {digest} verified.")
+
+def read_stdin(loop, queue):
+    # A daemon thread, so a read still waiting on the terminal never holds up exit
+    try:
+        for line in sys.stdin:
+            loop.call_soon_threadsafe(queue.put_nowait, line)
+        loop.call_soon_threadsafe(queue.put_nowait, None)
+    except RuntimeError:
+        pass # The loop closed while we waited
+
+async def stdin_lines():
+    loop = asyncio.get_running_loop()
+    reader = None
+    # A pipe transport makes the descriptor non-blocking, and a terminal shares that with stdout,
+    # so only real pipes get one
+    if sys.platform != "win32" and not sys.stdin.isatty():
+        reader = asyncio.StreamReader()
         try:
-            while received_bytes < expected_size:
-                data, _ = sock.recvfrom(2048)
-                if data:
-                    f.write(data)
-                    received_bytes += len(data)
-                else:
+            await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+        except (ValueError, OSError):
+            reader = None # Redirected from a regular file
+    if reader is None:
+        # A terminal, the Windows console or a file: a thread waits on it instead
+        queue = asyncio.Queue()
+        threading.Thread(target=read_stdin, args=(loop, queue), daemon=True).start()
+        while (line := await queue.get()) is not None:
+            yield line.rstrip("\r\n")
+        return
+    while line := await reader.readline():
+        yield line.decode(errors='ignore').rstrip("\r\n")
+
+async def run_client(username, hostname, port):
+    """
+    One event loop for everything: frames from the server, lines typed at
+    the terminal, parallel downloads and screen output. Only UDP downloads
+    and chunk hashing run on threads. A lost connection is retried with
+    exponential backoff; commands typed meanwhile are queued and sent in one
+    write once the server has taken the JOIN again.
+    """
+    loop = asyncio.get_running_loop()
+    screen = Screen(loop)
+    show = screen.show
+    codec = None # Compression agreed with the server at JOIN
+    pending_udp = {} # filename -> UDP socket bound for that download
+    pending_manifests = {} # filename -> (protocol, streams) until the server's FILE_MANIFEST arrives
+    manifests = {} # filename -> (size, chunk size, file SHA-256, chunk SHA-256s) for TCP and UDP downloads under way
+    tasks = set() # Downloads running alongside chat
+    reader = writer = None # The current connection; None while reconnecting
+    ready = True # Commands go straight out; otherwise they wait in 'queued'
+    queued = deque() # (opcode, payload) typed while disconnected
+    groups = set() # Groups joined with /join, joined again if the server could not restore them
+    resume_token = "" # From the server's CAPABILITIES; brings the groups back on reconnect
+    joined = False # The server has taken our JOIN at least once
+    accepted = False # ... on the current connection
+    pace = None # (commands per second, burst) the server's flood control allows, from CAPABILITIES
+    exiting = False
+
+    def send_frame(opcode, payload=b""):
+        if isinstance(payload, str):
+            payload = payload.encode()
+        if not ready:
+            if len(queued) >= QUEUE_LIMIT:
+                show(f"Not connected and {QUEUE_LIMIT} commands are already waiting; this one was dropped.")
+                return
+            queued.append((opcode, payload))
+            return
+        writer.write(compression.encode_frame(opcode, payload, codec))
+
+    def on_joined(resumed):
+        # The server has our JOIN: what was typed while disconnected goes out now
+        nonlocal joined, accepted
+        if accepted:
+            return
+        accepted = True
+        if joined and not resumed:
+            queued.extendleft((framing.JOIN_GROUP, name.encode()) for name in sorted(groups, reverse=True))
+            if groups:
+                show(f"Rejoining {len(groups)} group(s)...")
+        elif resumed:
+            show(f"Reconnected; back in {len(groups)} group(s).")
+        joined = True
+        start_task(send_queued(writer))
+
+    async def send_queued(connection):
+        # Pipelined in as few writes as the server's flood control allows: a full burst at once, then
+        # the rest at its rate, so nothing is dropped. New commands queue behind until it is all sent
+        nonlocal ready
+        allowance = pace[1] if pace else len(queued)
+        if len(queued) > allowance:
+            show(f"Sending {len(queued)} queued commands, {pace[0]:g} a second...")
+        while queued:
+            count = min(len(queued), int(allowance))
+            if count:
+                connection.write(b"".join(compression.encode_frame(*queued.popleft(), codec) for _ in range(count)))
+                allowance -= count
+            if queued:
+                await asyncio.sleep(PACE_INTERVAL)
+                if writer is not connection:
+                    return # Lost again; the rest waits for the next connection
+                allowance = min(allowance + pace[0] * PACE_INTERVAL, pace[1])
+        ready = True
+
+    def send_join():
+        writer.write(framing.encode_frame(framing.JOIN, f"{username} {compression.offer()} resume={resume_token}"))
+
+    async def stay_connected():
+        """Reads from the server until the connection drops, then connects and JOINs again with backoff."""
+        nonlocal reader, writer, ready, accepted, codec, pace
+        delay = RECONNECT_MIN
+        while True:
+            await receive_messages()
+            ready = False
+            writer.close()
+            reader = writer = None
+            if not accepted and not joined:
+                return # Never got in (a taken name, say), so trying again would not help
+            if accepted:
+                delay = RECONNECT_MIN
+            accepted = False
+            show("Connection lost.")
+            while not exiting:
+                wait = delay * random.uniform(0.5, 1.0) # Jitter, so clients cut off together do not return together
+                show(f"Reconnecting in {wait:.1f}s...")
+                await asyncio.sleep(wait)
+                delay = min(delay * 2, RECONNECT_MAX)
+                try:
+                    reader, writer = await asyncio.open_connection(hostname, port)
                     break
-        except socket.timeout:
-            print("\nUDP Download timed out (finished or lost packets).")
-
-    sock.close()
-    print(f"\nUDP Download of {filename} complete (or timed out). Saved to {download_dir}.")
-    print(f"Size: {received_bytes}/{expected_size} bytes.")
-    print("> ", end="", flush=True)
-
-def main():
-    if len(sys.argv) != 4:
-        print(f"Usage: python {sys.argv[0]} [username] [hostname] [port]")
-        sys.exit(1)
-
-    username = sys.argv[1]
-    hostname = sys.argv[2]
+                except OSError as e:
+                    show(f"Unable to reconnect - {e}")
+            if exiting:
+                return
+            codec = pace = None
+            send_join() # Commands wait until the server has answered it
+
+    def start_task(coro):
+        task = loop.create_task(coro)
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    async def receive_messages():
+        """Frames from the server. Chat text, file listings and file transfer frames are told apart by opcode."""
+        nonlocal codec, resume_token, pace
+        frames = framing.FrameReader()
+        download = None # [file, filename, file_path, remaining, size, BlockCheck] for the active TCP download
+
+        def finish_download():
+            f, filename, file_path, remaining, size, check = download
+            f.close()
+            manifest = manifests.pop(filename, None)
+            bad = check.close() if check else []
+            if bad:
+                # The chunks that arrived intact stay; only the bad ones are fetched again
+                show(f"{len(bad)} chunk(s) of '{filename}' failed their hash check. Fetching them again...")
+                start_task(parallel_download(hostname, port, username, filename, manifest, 1, show))
+                return
+            # The .part suffix only comes off once every byte has arrived and checked out
+            os.replace(file_path + ".part", file_path)
+            verified = f" SHA-256 {manifest[2]} verified." if manifest else ""
+            show(f"File '{filename}' downloaded successfully to {file_path}.\nSize: {size} bytes.{verified}")
 
-    try:
-        port = int(sys.argv[3])
-    except ValueError:
-        print("Port must be an integer.")
-        sys.exit(1)
+        try:
+            while data := await reader.read(RECV_SIZE):
+                frames.feed(data)
+                for opcode, payload in frames.frames():
+                    opcode, payload = compression.decode(opcode, payload, codec)
+                    if opcode == framing.FILE_DATA:
+                        if download is None:
+                            continue
+                        download[0].write(payload)
+                        if download[5]:
+                            download[5].feed(payload)
+                        download[3] -= len(payload)
+                        if download[3] <= 0:
+                            finish_download()
+                            download = None
+
+                    elif opcode == framing.FILE_START_TCP:
+                        # Payload: <size> <offset> <filename>; the offset is always 0, as resuming goes through PARALLEL
+                        size, _, filename = payload.decode(errors='ignore').split(" ", 2)
+                        size = int(size)
+                        if download is not None:
+                            # The server sends one file after another, so this only happens if one was cut short
+                            download[0].close()
+                            show(f"Download of '{download[1]}' was cut short. Run /download {download[1]} TCP again.")
+                            download = None
+                        show(f"Receiving file '{filename}' ({size} bytes) via TCP...")
+                        _, file_path = download_path(username, filename)
+                        f = open_part(file_path)
+                        manifest = manifests.get(filename)
+                        check = BlockCheck(manifest[1], manifest[3]) if manifest else None
+                        download = [f, filename, file_path, size, size, check]
+                        if size == 0:
+                            finish_download()
+                            download = None
+
+                    elif opcode == framing.FILE_START_UDP:
+                        # Payload: <size> <transfer id> <chunk size> <filename>
+                        size, transfer_id, chunk_size, filename = payload.decode(errors='ignore').split(" ", 3)
+                        udp_sock = pending_udp.pop(filename, None)
+                        manifest = manifests.pop(filename, None)
+                        if udp_sock and manifest:
+                            show(f"Incoming UDP file '{filename}' ({size} bytes) on port {udp_sock.getsockname()[1]}...")
+                            start_task(udp_download(hostname, port, username, filename, manifest, udp_sock,
+                                                    int(transfer_id), int(chunk_size), codec, show))
+                        else:
+                            show("Error: Received UDP start but no port pending.")
+
+                    elif opcode == framing.FILE_MANIFEST:
+                        # Payload: <size> <chunk size> <file SHA-256> <filename>, then one SHA-256 per chunk
+                        header, *digests = payload.decode(errors='ignore').split("\n")
+                        size, chunk_size, digest, filename = header.split(" ", 3)
+                        manifest = (int(size), int(chunk_size), digest, digests)
+                        protocol, streams = pending_manifests.pop(filename, ("PARALLEL", PARALLEL_STREAMS))
+                        local = has_local_copy(username, filename)
+                        if protocol == "TCP" and not local:
+                            # Nothing to build on, so the whole file streams over this connection, checked as it comes
+                            manifests[filename] = manifest
+                            send_frame(framing.DOWNLOAD_TCP, filename)
+                        elif protocol == "UDP" and not local:
+                            # Bind before asking, so no datagram can arrive ahead of the socket
+                            udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                            udp_sock.bind(('0.0.0.0', 0))
+                            udp_transfer.set_buffers(udp_sock)
+                            udp_port = udp_sock.getsockname()[1]
+                            old_sock = pending_udp.pop(filename, None)
+                            if old_sock:
+                                old_sock.close()
+                            pending_udp[filename] = udp_sock
+                            manifests[filename] = manifest
+                            send_frame(framing.DOWNLOAD_UDP, f"{filename} {udp_port}")
+                            show(f"Requested UDP download on port {udp_port}. Waiting for server...")
+                        else:
+                            # A local copy to compare against (or PARALLEL): only the chunks that differ are fetched
+                            start_task(parallel_download(hostname, port, username, filename, manifest, streams, show))
+
+                    elif opcode == framing.HISTORY_BATCH:
+                        channel, seq, gap, texts = history.message_frames(payload)
+                        lines = [f"--- {len(texts)} earlier message(s) on {channel}, up to #{seq} ---"]
+                        if gap:
+                            lines.append("(older messages are no longer kept)")
+                        lines += texts
+                        lines.append("--- end of history ---")
+                        show("\n".join(lines))
+
+                    elif opcode == framing.PING:
+                        # Straight out, even while queued commands are still being paced
+                        writer.write(compression.encode_frame(framing.PONG, b"", codec))
+
+                    elif opcode == framing.CAPABILITIES:
+                        caps = compression.parse_capabilities(payload.decode(errors='ignore'))
+                        agreed = caps.get("compress", [])
+                        codec = compression.CODECS.get(agreed[0]) if agreed else None
+                        if caps.get("resume"):
+                            resume_token = caps["resume"][0]
+                        rate, burst = caps.get("rate"), caps.get("burst")
+                        pace = (float(rate[0]), int(burst[0])) if rate and burst else None
+                        on_joined("resumed" in caps)
+
+                    elif opcode == framing.FILES_LIST:
+                        show(f"FILES_LIST {payload.decode(errors='ignore')}")
 
-    client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                    else:
+                        text = payload.decode(errors='ignore')
+                        if text == f"Server: {username} has joined":
+                            on_joined(False) # Servers that send no CAPABILITIES
+                        show(text)
+            show("Disconnected from server.")
+        except (OSError, framing.FrameError) as e:
+            show(f"Error receiving message: {e}")
+        if download is not None:
+            download[0].close()
+            show(f"Connection lost during download. Run /download {download[1]} TCP again to fetch only what is missing.")
 
     try:
-        client_socket.connect((hostname, port))
-        # Send JOIN command immediately
-        client_socket.send(f"JOIN {username}".encode())
-    except Exception as e:
+        reader, writer = await asyncio.open_connection(hostname, port)
+    except OSError as e:
         print(f"Unable to connect to {hostname}:{port} - {e}")
-        sys.exit(1)
-
-    # Start listener thread
-    listener_thread = threading.Thread(target=receive_messages, args=(client_socket, username))
-    listener_thread.daemon = True
-    listener_thread.start()
+        return
+    send_join() # Commands may follow it straight away this first time
 
     print(f"Connected to {hostname}:{port} as {username}")
     print("Commands:")
     print("  /broadcast <msg>       - Switch to broadcast mode (default)")
     print("  /unicast <user> <msg>  - Switch to unicast mode for <user>")
-    print("  /join <group>          - Join a group")
+    print("  /join <group> [max]    - Join a group (max sets the size limit of a new group)")
     print("  /leave <group>         - Leave a group")
     print("  /group <group> <msg>   - Switch to group mode for <group>")
-    print("  /list                  - List shared files")
+    print("  /groups [offset [prefix]] - List groups (paged)")
+    print("  /members <group> [offset] - List a group's members (paged)")
+    print("  /history <*|#group|@> [since] - Show recent messages (@ = your private messages)")
+    print("  /list [offset [prefix]] - List shared files (paged; prefix filters by name)")
     print("  /download <file> <TCP|UDP> - Download a file")
+    print("  /download <file> PARALLEL [n] - Download in verified chunks over n connections")
     print("  /exit                  - Exit")
     print("------------------------------------------------------------")
 
+    receiver = loop.create_task(stay_connected())
     current_mode = "BROADCAST"
     target = None
+    lines = stdin_lines()
 
-    while True:
+    while not receiver.done():
+        next_line = loop.create_task(lines.__anext__())
+        await asyncio.wait((next_line, receiver), return_when=asyncio.FIRST_COMPLETED)
+        if not next_line.done():
+            next_line.cancel()
+            break
         try:
-            user_input = input("")
-            if not user_input:
-                continue
+            user_input = next_line.result()
+        except StopAsyncIteration:
+            break
+        if not user_input:
+            continue
+
+        if user_input.startswith("/broadcast"):
+            current_mode = "BROADCAST"
+            target = None
+            show("Switched to BROADCAST mode.")
+            parts = user_input.split(" ", 1)
+            if len(parts) > 1:
+                send_frame(framing.BROADCAST, parts[1])
+
+        elif user_input.startswith("/unicast"):
+            parts = user_input.split(" ", 2)
+            if len(parts) >= 2:
+                current_mode = "UNICAST"
+                target = parts[1]
+                show(f"Switched to UNICAST mode (Target: {target}).")
+                if len(parts) > 2:
+                    send_frame(framing.UNICAST, f"{target} {parts[2]}")
+
+        elif user_input.startswith("/join"):
+            parts = user_input.split(" ", 1)
+            if len(parts) > 1:
+                groups.add(parts[1].split(" ")[0])
+                send_frame(framing.JOIN_GROUP, parts[1])
+
+        elif user_input.startswith("/leave"):
+            parts = user_input.split(" ", 1)
+            if len(parts) > 1:
+                groups.discard(parts[1])
+                send_frame(framing.LEAVE_GROUP, parts[1])
+
+        elif user_input == "/groups" or user_input.startswith("/groups "):
+            # Payload: <offset> <limit> [prefix]
+            parts = user_input.split(" ", 2)
+            if len(parts) == 1 or parts[1].isdigit():
+                offset = parts[1] if len(parts) > 1 else 0
+                prefix = parts[2] if len(parts) > 2 else ""
+                send_frame(framing.LIST_GROUPS, f"{offset} {GROUP_PAGE} {prefix}".rstrip(" "))
+            else:
+                show("Usage: /groups [offset [prefix]]")
 
-            if user_input.startswith("/broadcast"):
-                current_mode = "BROADCAST"
-                target = None
-                print("Switched to BROADCAST mode.")
-                parts = user_input.split(" ", 1)
-                if len(parts) > 1:
-                    client_socket.send(f"BROADCAST {parts[1]}".encode())
-
-            elif user_input.startswith("/unicast"):
-                parts = user_input.split(" ", 2)
-                if len(parts) >= 2:
-                    current_mode = "UNICAST"
-                    target = parts[1]
-                    print(f"Switched to UNICAST mode (Target: {target}).")
-                    if len(parts) > 2:
-                        client_socket.send(f"UNICAST {target} {parts[2]}".encode())
-
-            elif user_input.startswith("/join"):
-                parts = user_input.split(" ", 1)
-                if len(parts) > 1:
-                    client_socket.send(f"JOIN_GROUP {parts[1]}".encode())
-
-            elif user_input.startswith("/leave"):
-                parts = user_input.split(" ", 1)
-                if len(parts) > 1:
-                    client_socket.send(f"LEAVE_GROUP {parts[1]}".encode())
-
-            elif user_input.startswith("/group"):
-                parts = user_input.split(" ", 2)
-                if len(parts) >= 2:
-                    current_mode = "GROUP"
-                    target = parts[1]
-                    print(f"Switched to GROUP mode (Group: {target}).")
-                    if len(parts) > 2:
-                        client_socket.send(f"GROUP_MSG {target} {parts[2]}".encode())
-
-            elif user_input == "/list":
-                client_socket.send("LIST_FILES".encode())
-
-            elif user_input.startswith("/download"):
-                parts = user_input.split(" ")
-                if len(parts) == 3:
-                    filename = parts[1]
-                    protocol = parts[2].upper()
-                    if protocol == "TCP":
-                        client_socket.send(f"DOWNLOAD_TCP {filename}".encode())
-                    elif protocol == "UDP":
-                        # Pick a random local port
-                        import random
-                        udp_port = random.randint(10000, 20000)
-                        # We need to know file size to stop receiver...
-                        # But we don't know it yet.
-                        # We will start the thread assuming unlimited/unknown or handle it differently?
-                        # The Server sends FILE_START_UDP <size>.
-                        # So we can't start receiver yet?
-                        # We should start receiver AFTER we get the size from server via TCP?
-                        # But listener thread sees that.
-                        # This is tricky.
-                        # Solution: Send request. Listener thread sees FILE_START_UDP <size>.
-                        # Listener thread spawns udp_receiver thread.
-
-                        client_socket.send(f"DOWNLOAD_UDP {filename} {udp_port}".encode())
-                        print(f"Requested UDP download on port {udp_port}. Waiting for server...")
-
-                        # We need to pass udp_port to listener thread?
-                        # Or listener thread can parse it?
-                        # Server sends back: FILE_START_UDP <name> <size>
-                        # But listener doesn't know 'udp_port'.
-                        # We can store 'pending_udp_port' in a global or pass it?
-                        # Simple hack: Write udp_port to a file or global var.
-                        global PENDING_UDP_PORT
-                        PENDING_UDP_PORT = udp_port
-                    else:
-                        print("Protocol must be TCP or UDP.")
-                else:
-                    print("Usage: /download <filename> <TCP|UDP>")
+        elif user_input.startswith("/members"):
+            parts = user_input.split(" ")
+            if len(parts) in (2, 3) and (len(parts) == 2 or parts[2].isdigit()):
+                offset = parts[2] if len(parts) == 3 else 0
+                send_frame(framing.GROUP_MEMBERS, f"{parts[1]} {offset} {GROUP_PAGE}")
+            else:
+                show("Usage: /members <group> [offset]")
+
+        elif user_input.startswith("/group"):
+            parts = user_input.split(" ", 2)
+            if len(parts) >= 2:
+                current_mode = "GROUP"
+                target = parts[1]
+                show(f"Switched to GROUP mode (Group: {target}).")
+                if len(parts) > 2:
+                    send_frame(framing.GROUP_MSG, f"{target} {parts[2]}")
+
+        elif user_input.startswith("/history"):
+            parts = user_input.split(" ")
+            if len(parts) in (2, 3) and (len(parts) == 2 or parts[2].isdigit()):
+                channel = parts[1]
+                if channel.startswith("@"):
+                    channel = "@" # The server only shows your own
+                since = parts[2] if len(parts) == 3 else 0
+                send_frame(framing.HISTORY, f"{channel} {since}")
+            else:
+                show("Usage: /history <*|#group|@> [since]")
 
-            elif user_input == "/exit":
-                client_socket.send("/exit".encode())
-                break
+        elif user_input == "/list":
+            send_frame(framing.LIST_FILES)
 
+        elif user_input.startswith("/list "):
+            # Payload: <offset> <limit> [prefix]
+            parts = user_input.split(" ", 2)
+            if parts[1].isdigit():
+                prefix = parts[2] if len(parts) > 2 else ""
+                send_frame(framing.LIST_FILES, f"{parts[1]} {LIST_PAGE} {prefix}".rstrip(" "))
             else:
-                if current_mode == "BROADCAST":
-                    client_socket.send(f"BROADCAST {user_input}".encode())
-                elif current_mode == "UNICAST":
-                    if target:
-                        client_socket.send(f"UNICAST {target} {user_input}".encode())
-                    else:
-                        print("No unicast target.")
-                elif current_mode == "GROUP":
-                    if target:
-                        client_socket.send(f"GROUP_MSG {target} {user_input}".encode())
-                    else:
-                        print("No group target.")
+                show("Usage: /list [offset [prefix]]")
+
+        elif user_input.startswith("/download"):
+            # Every download starts from the server's hashes (FILE_MANIFEST); what happens next is up to the protocol
+            parts = user_input.split(" ")
+            if len(parts) == 4 and parts[2].upper() == "PARALLEL" and parts[3].isdigit():
+                pending_manifests[parts[1]] = ("PARALLEL", int(parts[3]))
+                send_frame(framing.MANIFEST, parts[1])
+            elif len(parts) == 3:
+                filename = parts[1]
+                protocol = parts[2].upper()
+                if protocol in ("TCP", "UDP", "PARALLEL"):
+                    pending_manifests[filename] = (protocol, PARALLEL_STREAMS if protocol == "PARALLEL" else 1)
+                    send_frame(framing.MANIFEST, filename)
+                else:
+                    show("Protocol must be TCP, UDP or PARALLEL.")
+            else:
+                show("Usage: /download <filename> <TCP|UDP|PARALLEL [connections]>")
 
-        except KeyboardInterrupt:
-            client_socket.close()
-            break
-        except Exception as e:
-            print(f"Error: {e}")
-            client_socket.close()
+        elif user_input == "/exit":
+            exiting = True
+            if ready:
+                send_frame(framing.EXIT)
             break
 
-PENDING_UDP_PORT = None
+        else:
+            if current_mode == "BROADCAST":
+                send_frame(framing.BROADCAST, user_input)
+            elif current_mode == "UNICAST":
+                if target:
+                    send_frame(framing.UNICAST, f"{target} {user_input}")
+                else:
+                    show("No unicast target.")
+            elif current_mode == "GROUP":
+                if target:
+                    send_frame(framing.GROUP_MSG, f"{target} {user_input}")
+                else:
+                    show("No group target.")
 
-# We need to inject the pending port handling into listener thread.
-# Redefining receive_messages to use the global PENDING_UDP_PORT
-def receive_messages(sock, username):
-    global PENDING_UDP_PORT
-    while True:
-        try:
-            message = sock.recv(BUFFER_SIZE)
-            if not message:
-                print("\nDisconnected.")
-                break
+        if writer is not None:
+            try:
+                await writer.drain()
+            except OSError:
+                pass # The receiver sees the connection go and reconnects
 
-            decoded = message.decode(errors='ignore')
+    exiting = True
+    if writer is not None:
+        try:
+            await writer.drain()
+        except OSError:
+            pass
+        writer.close()
+    receiver.cancel()
+    for task in tasks:
+        task.cancel()
+    screen.flush()
 
-            if decoded.startswith("FILE_START_TCP "):
-                parts = decoded.split(" ", 2)
-                filename = parts[1]
-                size = int(parts[2])
-                print(f"\nReceiving file '{filename}' ({size} bytes) via TCP...")
-
-                download_dir = f"{username}_files"
-                if not os.path.exists(download_dir):
-                    os.makedirs(download_dir)
-                file_path = os.path.join(download_dir, filename)
-
-                remaining = size
-                with open(file_path, "wb") as f:
-                    while remaining > 0:
-                        chunk_size = min(remaining, BUFFER_SIZE)
-                        data = sock.recv(chunk_size)
-                        if not data: break
-                        f.write(data)
-                        remaining -= len(data)
-
-                print(f"Download complete: {file_path}")
-                print("> ", end="", flush=True)
-
-            elif decoded.startswith("FILE_START_UDP "):
-                parts = decoded.split(" ", 2)
-                filename = parts[1]
-                size = int(parts[2])
+def main():
+    if len(sys.argv) != 4:
+        print(f"Usage: python {sys.argv[0]} [username] [hostname] [port]")
+        sys.exit(1)
 
-                if PENDING_UDP_PORT:
-                    port = PENDING_UDP_PORT
-                    t = threading.Thread(target=udp_receiver, args=(port, filename, size, username))
-                    t.start()
-                else:
-                    print("Error: Received UDP start but no port pending.")
+    username = sys.argv[1]
+    hostname = sys.argv[2]
+    if " " in username:
+        print("Username cannot contain spaces.")
+        sys.exit(1)
 
-            else:
-                print(f"\n{decoded}")
-                print("> ", end="", flush=True)
+    try:
+        port = int(sys.argv[3])
+    except ValueError:
+        print("Port must be an integer.")
+        sys.exit(1)
 
-        except Exception as e:
-            print(f"\nError: {e}")
-            break
-    sock.close()
-    sys.exit(0)
+    try:
+        asyncio.run(run_client(username, hostname, port))
+    except KeyboardInterrupt:
+        pass
 
 if __name__ == "__main__":
     main()
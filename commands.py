@@ -0,0 +1,214 @@
+import compression
+import framing
+
+# Client commands, parsed once per frame into small objects for the server's
+# handlers. PARSERS is keyed on the opcode, so finding the parser costs one
+# dict lookup whatever the command. Fields are cut from the payload bytes
+# and only names, filenames and message text are decoded; numbers are
+# parsed straight from the bytes.
+
+class CommandError(ValueError):
+    pass
+
+class Join:
+    __slots__ = ("username", "caps")
+
+    def __init__(self, username, caps):
+        self.username = username
+        self.caps = caps # Capabilities offered, from compression.parse_capabilities
+
+class Text:
+    __slots__ = ("text",)
+
+    def __init__(self, text):
+        self.text = text
+
+class Addressed:
+    __slots__ = ("target", "text") # A username for UNICAST, a group name for GROUP_MSG
+
+    def __init__(self, target, text):
+        self.target = target
+        self.text = text
+
+class Named:
+    __slots__ = ("name",) # A group name or a filename
+
+    def __init__(self, name):
+        self.name = name
+
+class GroupJoin:
+    __slots__ = ("name", "max_size")
+
+    def __init__(self, name, max_size):
+        self.name = name
+        self.max_size = max_size # Only used when the group is created; None for the server's limit
+
+class GroupPage:
+    __slots__ = ("name", "offset", "limit")
+
+    def __init__(self, name, offset, limit):
+        self.name = name
+        self.offset = offset
+        self.limit = limit # None for the server's page size
+
+class History:
+    __slots__ = ("channel", "since")
+
+    def __init__(self, channel, since):
+        self.channel = channel
+        self.since = since
+
+class Listing:
+    __slots__ = ("offset", "limit", "prefix")
+
+    def __init__(self, offset, limit, prefix):
+        self.offset = offset
+        self.limit = limit # None for the server's page size
+        self.prefix = prefix
+
+class Download:
+    __slots__ = ("filename", "offset", "length")
+
+    def __init__(self, filename, offset=0, length=None):
+        self.filename = filename
+        self.offset = offset
+        self.length = length # DOWNLOAD_RANGE only
+
+class UdpDownload:
+    __slots__ = ("filename", "port")
+
+    def __init__(self, filename, port):
+        self.filename = filename
+        self.port = port
+
+def text(data):
+    return data.decode(errors='ignore')
+
+def invalid(opcode):
+    return CommandError(f"Invalid {framing.OPCODE_NAMES[opcode]} format.")
+
+def parse_join(payload):
+    # <username> [capability=value,... ...]
+    username, _, caps = payload.strip().partition(b" ")
+    return Join(text(username), compression.parse_capabilities(text(caps)))
+
+def parse_text(payload):
+    return Text(text(payload))
+
+def parse_addressed(opcode):
+    def parse(payload):
+        target, sep, rest = payload.partition(b" ")
+        if not sep:
+            raise invalid(opcode)
+        return Addressed(text(target), text(rest))
+    return parse
+
+def parse_named(payload):
+    return Named(text(payload.strip()))
+
+def parse_join_group(payload):
+    # <group> [max size]
+    name, sep, max_size = payload.strip().partition(b" ")
+    try:
+        max_size = int(max_size) if sep else None
+    except ValueError:
+        raise invalid(framing.JOIN_GROUP) from None
+    if max_size is not None and max_size < 1:
+        raise invalid(framing.JOIN_GROUP)
+    return GroupJoin(text(name), max_size)
+
+def parse_group_members(payload):
+    # <group> [offset [limit]]
+    args = payload.strip().split(b" ")
+    try:
+        if len(args) > 3:
+            raise ValueError
+        offset = int(args[1]) if len(args) > 1 else 0
+        limit = int(args[2]) if len(args) > 2 else None
+    except ValueError:
+        raise invalid(framing.GROUP_MEMBERS) from None
+    if offset < 0 or (limit is not None and limit < 1):
+        raise invalid(framing.GROUP_MEMBERS)
+    return GroupPage(text(args[0]), offset, limit)
+
+def parse_history(payload):
+    # <channel> [since]
+    channel, sep, since = payload.partition(b" ")
+    try:
+        return History(text(channel), int(since) if sep else 0)
+    except ValueError:
+        raise invalid(framing.HISTORY) from None
+
+def parse_listing(opcode):
+    def parse(payload):
+        # Optional: <offset> <limit> [prefix]
+        if not payload:
+            return Listing(0, None, "")
+        args = payload.split(b" ", 2)
+        try:
+            offset, limit = int(args[0]), int(args[1])
+        except (ValueError, IndexError):
+            raise invalid(opcode) from None
+        if offset < 0 or limit < 1:
+            raise invalid(opcode)
+        return Listing(offset, limit, text(args[2]) if len(args) > 2 else "")
+    return parse
+
+def parse_download(payload):
+    return Download(text(payload.strip()))
+
+def parse_resume(payload):
+    # <offset> <filename>
+    offset, sep, filename = payload.strip().partition(b" ")
+    try:
+        if not sep:
+            raise ValueError
+        return Download(text(filename), int(offset))
+    except ValueError:
+        raise invalid(framing.RESUME_TCP) from None
+
+def parse_range(payload):
+    # <offset> <length> <filename>
+    args = payload.strip().split(b" ", 2)
+    try:
+        offset, length, filename = args
+        return Download(text(filename), int(offset), int(length))
+    except ValueError:
+        raise invalid(framing.DOWNLOAD_RANGE) from None
+
+def parse_udp(payload):
+    # <filename> <port>
+    filename, sep, port = payload.rpartition(b" ")
+    try:
+        if not sep:
+            raise ValueError
+        return UdpDownload(text(filename), int(port))
+    except ValueError:
+        raise invalid(framing.DOWNLOAD_UDP) from None
+
+def parse_nothing(payload):
+    return None
+
+PARSERS = {
+    framing.JOIN: parse_join,
+    framing.BROADCAST: parse_text,
+    framing.UNICAST: parse_addressed(framing.UNICAST),
+    framing.GROUP_MSG: parse_addressed(framing.GROUP_MSG),
+    framing.JOIN_GROUP: parse_join_group,
+    framing.LEAVE_GROUP: parse_named,
+    framing.LIST_GROUPS: parse_listing(framing.LIST_GROUPS),
+    framing.GROUP_MEMBERS: parse_group_members,
+    framing.LIST_FILES: parse_listing(framing.LIST_FILES),
+    framing.DOWNLOAD_TCP: parse_download,
+    framing.RESUME_TCP: parse_resume,
+    framing.MANIFEST: parse_named,
+    framing.DOWNLOAD_RANGE: parse_range,
+    framing.DOWNLOAD_UDP: parse_udp,
+    framing.HISTORY: parse_history,
+    framing.EXIT: parse_nothing,
+    framing.PONG: parse_nothing,
+}
+
+def parse(opcode, payload):
+    """The command object for a frame. Raises KeyError for an unknown opcode, CommandError for a bad payload."""
+    return PARSERS[opcode](payload)
@@ -0,0 +1,146 @@
+import threading
+import zlib
+
+import framing
+
+# Optional codecs: used when installed on both ends, zlib otherwise
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+# Compression is agreed at JOIN: the client lists what it supports,
+#   JOIN <username> compress=zstd,lz4,zlib
+# and the server answers with a CAPABILITIES frame naming the one it picked
+# (or compress=none). From then on either side may set framing.COMPRESSED on
+# a frame's opcode, meaning the payload is compressed with that codec.
+# Payloads under MIN_SIZE, or that do not shrink, are sent as they are.
+
+MIN_SIZE = 256
+
+class FrameTooLarge(framing.FrameError):
+    pass
+
+class ZlibCodec:
+    name = "zlib"
+    errors = (zlib.error,) # Raised by decompress() for data that is not this codec's
+
+    def compress(self, data):
+        return zlib.compress(data, 1)
+
+    def decompress(self, data, max_size):
+        d = zlib.decompressobj()
+        out = d.decompress(data, max_size)
+        if d.unconsumed_tail:
+            raise FrameTooLarge(f"Compressed frame expands past {max_size} bytes")
+        return out
+
+class ZstdCodec:
+    name = "zstd"
+    errors = () # decompress() already turns zstandard errors into FrameTooLarge
+
+    def __init__(self):
+        self.local = threading.local() # zstandard contexts are not thread-safe; UDP sends run on workers
+
+    def compress(self, data):
+        try:
+            compressor = self.local.compressor
+        except AttributeError:
+            compressor = self.local.compressor = zstandard.ZstdCompressor(level=3)
+        return compressor.compress(data)
+
+    def decompress(self, data, max_size):
+        try:
+            return zstandard.ZstdDecompressor().decompress(data, max_output_size=max_size)
+        except zstandard.ZstdError as e:
+            raise FrameTooLarge(str(e))
+
+class Lz4Codec:
+    name = "lz4"
+    errors = (RuntimeError,)
+
+    def compress(self, data):
+        return lz4.frame.compress(data)
+
+    def decompress(self, data, max_size):
+        d = lz4.frame.LZ4FrameDecompressor()
+        out = d.decompress(data, max_length=max_size)
+        if not d.eof:
+            raise FrameTooLarge(f"Compressed frame expands past {max_size} bytes")
+        return out
+
+CODECS = {"zlib": ZlibCodec()} # In order of preference once the optional ones are added
+if lz4 is not None:
+    CODECS = {"lz4": Lz4Codec(), **CODECS}
+if zstandard is not None:
+    CODECS = {"zstd": ZstdCodec(), **CODECS}
+
+def offer():
+    """The JOIN capability string for this side."""
+    return "compress=" + ",".join(CODECS)
+
+def parse_capabilities(text):
+    """'key=a,b key2=c' -> {'key': ['a', 'b'], 'key2': ['c']}"""
+    caps = {}
+    for item in text.split():
+        key, _, value = item.partition("=")
+        caps[key] = [v for v in value.split(",") if v]
+    return caps
+
+def negotiate(offered):
+    """Our most preferred codec among the names the peer offered, or None."""
+    for name, codec in CODECS.items():
+        if name in offered:
+            return codec
+    return None
+
+def encode_frame(opcode, payload, codec):
+    """Like framing.encode_frame, compressing the payload with 'codec' when that makes it smaller."""
+    if codec is None or len(payload) < MIN_SIZE:
+        return framing.encode_frame(opcode, payload)
+    packed = codec.compress(payload)
+    if len(packed) >= len(payload):
+        return framing.encode_frame(opcode, payload)
+    return framing.HEADER.pack(len(packed), opcode | framing.COMPRESSED) + packed
+
+def compress_frame(frame, codec):
+    """Compressed copy of an already encoded frame, or the frame itself if that would not help."""
+    if codec is None or len(frame) - framing.HEADER_SIZE < MIN_SIZE:
+        return frame
+    _, opcode = framing.HEADER.unpack_from(frame)
+    return encode_frame(opcode, memoryview(frame)[framing.HEADER_SIZE:], codec)
+
+def decode(opcode, payload, codec):
+    """Undoes framing.COMPRESSED. Returns (opcode, payload)."""
+    if not opcode & framing.COMPRESSED:
+        return opcode, payload
+    if codec is None:
+        raise framing.FrameError("Compressed frame before compression was agreed")
+    try:
+        return opcode & ~framing.COMPRESSED, codec.decompress(payload, framing.MAX_FRAME_SIZE)
+    except codec.errors as e:
+        # A peer sending garbage is a protocol error on that connection, not a server fault
+        raise framing.FrameError(f"Bad {codec.name} data: {e}") from None
+
+class Fanout:
+    """One message for many recipients: each codec's compressed frame is made once and shared."""
+
+    __slots__ = ("frame", "variants")
+
+    def __init__(self, frame):
+        self.frame = frame
+        self.variants = None
+
+    def frame_for(self, codec):
+        if codec is None:
+            return self.frame
+        if self.variants is None:
+            self.variants = {}
+        data = self.variants.get(codec)
+        if data is None:
+            data = self.variants[codec] = compress_frame(self.frame, codec)
+        return data
@@ -0,0 +1,130 @@
+import struct
+
+# Every message on the TCP connection is one frame:
+#   4-byte payload length | 1-byte opcode | payload
+# Text payloads are UTF-8, FILE_DATA payloads are raw file bytes.
+HEADER = struct.Struct("!IB")
+HEADER_SIZE = HEADER.size
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+# Client -> Server
+JOIN = 1
+BROADCAST = 2
+UNICAST = 3
+GROUP_MSG = 4
+JOIN_GROUP = 5
+LEAVE_GROUP = 6
+LIST_FILES = 7
+DOWNLOAD_TCP = 8
+DOWNLOAD_UDP = 9
+EXIT = 10
+RESUME_TCP = 11
+MANIFEST = 12 # <filename>: ask for the file's SHA-256 and per-chunk hashes, which every client download checks against
+DOWNLOAD_RANGE = 13 # <offset> <length> <filename>
+HISTORY = 14 # <channel> [since]: recent messages on '*', '#<group>' or '@' (your own private messages)
+PONG = 15 # Answer to PING
+LIST_GROUPS = 16 # Optional <offset> <limit> [prefix]: the groups on this server, by name
+GROUP_MEMBERS = 17 # <group> [offset [limit]]: one page of a group's members
+
+# Server -> Client
+MESSAGE = 64
+FILES_LIST = 65
+FILE_START_TCP = 66
+FILE_DATA = 67
+FILE_START_UDP = 68
+CAPABILITIES = 69 # Reply to JOIN: what the server agreed to, e.g. "compress=zlib"
+FILE_MANIFEST = 70 # <size> <chunk size> <file SHA-256> <filename>, then one SHA-256 hex digest per chunk, one per line
+FILE_RANGE = 71 # <offset> <length> <filename>; FILE_DATA frames carrying 'length' bytes follow
+HISTORY_BATCH = 72 # <channel> <newest seq> <gap>, a newline, then the messages as MESSAGE frames
+PING = 73 # Heartbeat sent to a client that has been quiet; answered with PONG
+GROUPS_LIST = 74 # Reply to LIST_GROUPS: "<total> groups:", then "<name> (<members>/<max size>)" per line
+MEMBERS_LIST = 75 # Reply to GROUP_MEMBERS: "<total> members of '<group>':", then one username per line
+
+# Flag on the opcode: the payload is compressed with the codec agreed at JOIN (see compression.py)
+COMPRESSED = 0x80
+
+OPCODE_NAMES = {
+    JOIN: "JOIN",
+    BROADCAST: "BROADCAST",
+    UNICAST: "UNICAST",
+    GROUP_MSG: "GROUP_MSG",
+    JOIN_GROUP: "JOIN_GROUP",
+    LEAVE_GROUP: "LEAVE_GROUP",
+    LIST_FILES: "LIST_FILES",
+    DOWNLOAD_TCP: "DOWNLOAD_TCP",
+    DOWNLOAD_UDP: "DOWNLOAD_UDP",
+    EXIT: "EXIT",
+    RESUME_TCP: "RESUME_TCP",
+    MANIFEST: "MANIFEST",
+    DOWNLOAD_RANGE: "DOWNLOAD_RANGE",
+    HISTORY: "HISTORY",
+    PONG: "PONG",
+    LIST_GROUPS: "LIST_GROUPS",
+    GROUP_MEMBERS: "GROUP_MEMBERS",
+    MESSAGE: "MESSAGE",
+    FILES_LIST: "FILES_LIST",
+    FILE_START_TCP: "FILE_START_TCP",
+    FILE_DATA: "FILE_DATA",
+    FILE_START_UDP: "FILE_START_UDP",
+    CAPABILITIES: "CAPABILITIES",
+    FILE_MANIFEST: "FILE_MANIFEST",
+    FILE_RANGE: "FILE_RANGE",
+    HISTORY_BATCH: "HISTORY_BATCH",
+    PING: "PING",
+    GROUPS_LIST: "GROUPS_LIST",
+    MEMBERS_LIST: "MEMBERS_LIST",
+}
+
+class FrameError(Exception):
+    pass
+
+def encode_frame(opcode, payload=b""):
+    if isinstance(payload, str):
+        payload = payload.encode()
+    if len(payload) > MAX_FRAME_SIZE:
+        raise FrameError(f"Frame of {len(payload)} bytes exceeds {MAX_FRAME_SIZE}")
+    return HEADER.pack(len(payload), opcode) + payload
+
+def send_frame(sock, opcode, payload=b""):
+    sock.sendall(encode_frame(opcode, payload))
+
+def split_args(payload, count):
+    """Splits a text payload into at most 'count' space separated fields."""
+    return payload.decode(errors='ignore').split(" ", count - 1)
+
+class FrameReader:
+    """
+    Reassembles frames from a byte stream. Bytes are appended to one
+    bytearray and only the consumed prefix is trimmed after each batch,
+    so a recv() holding many frames (or half of one) costs no extra copies.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.pos = 0
+
+    def feed(self, data):
+        self.buffer += data
+
+    def frames(self):
+        buf = self.buffer
+        try:
+            while len(buf) - self.pos >= HEADER_SIZE:
+                length, opcode = HEADER.unpack_from(buf, self.pos)
+                if length > MAX_FRAME_SIZE:
+                    raise FrameError(f"Frame of {length} bytes exceeds {MAX_FRAME_SIZE}")
+                start = self.pos + HEADER_SIZE
+                end = start + length
+                if len(buf) < end:
+                    break
+                with memoryview(buf) as view:
+                    payload = view[start:end].tobytes()
+                self.pos = end
+                yield opcode, payload
+        finally:
+            if self.pos:
+                del buf[:self.pos]
+                self.pos = 0
+
+    def pending(self):
+        return len(self.buffer) - self.pos
@@ -0,0 +1,99 @@
+import bisect
+import time
+from array import array
+
+import framing
+
+# Groups are kept as sorted arrays of session ids (4 bytes a member) rather
+# than sets of sessions, so a 100k member group is 400 KB and asking whether
+# a session is in it is a binary search. Messages to a group too big to
+# reach in one loop turn become Deliveries: each turn sends the next batch
+# of members, found by binary search from the last id reached, so members
+# joining or leaving in between never shift a delivery off course.
+
+PAGE = 100 # Most names in one GROUPS_LIST or MEMBERS_LIST reply
+
+class Group:
+    __slots__ = ("name", "ids", "max_size", "creator", "created", "queued")
+
+    def __init__(self, name, max_size, creator):
+        self.name = name
+        self.ids = array("I") # Member session ids, ascending
+        self.max_size = max_size
+        self.creator = creator
+        self.created = time.time()
+        self.queued = 0 # Deliveries not yet finished; later messages queue behind them to keep their order
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __contains__(self, session_id):
+        ids = self.ids
+        i = bisect.bisect_left(ids, session_id)
+        return i < len(ids) and ids[i] == session_id
+
+    def add(self, session_id):
+        """Returns False if the group is full."""
+        if len(self.ids) >= self.max_size:
+            return False
+        ids = self.ids
+        if not ids or ids[-1] < session_id:
+            ids.append(session_id) # Ids only grow, so a new session always goes on the end
+        elif session_id not in self:
+            bisect.insort(ids, session_id)
+        return True
+
+    def discard(self, session_id):
+        ids = self.ids
+        i = bisect.bisect_left(ids, session_id)
+        if i < len(ids) and ids[i] == session_id:
+            del ids[i]
+
+    def after(self, session_id, count):
+        """Up to 'count' member ids greater than 'session_id'."""
+        i = bisect.bisect_right(self.ids, session_id)
+        return self.ids[i:i + count]
+
+class Delivery:
+    """One message still being fanned out to a large group."""
+
+    __slots__ = ("group", "fanout", "sender", "cursor", "last")
+
+    def __init__(self, group, fanout, sender):
+        self.group = group
+        self.fanout = fanout # compression.Fanout of the MESSAGE frame
+        self.sender = sender
+        self.cursor = 0 # Highest member id reached so far
+        self.last = group.ids[-1] if group.ids else 0 # Members who join after the message was sent do not get it
+
+def page_text(noun, total, offset, lines, note=""):
+    # Same layout as the shared file listing
+    if not lines:
+        text = f"{total} {noun}:\nNone."
+    elif len(lines) == total:
+        text = f"{total} {noun}:\n" + "\n".join(lines)
+    else:
+        text = f"{total} {noun}, showing {offset + 1}-{offset + len(lines)}:\n" + "\n".join(lines)
+        if offset + len(lines) < total:
+            text += f"\n(more from offset {offset + len(lines)})"
+    return text + note
+
+def groups_list(groups, offset, limit, prefix, note=""):
+    """GROUPS_LIST frame for the groups named 'prefix'..., sorted by name. 'note' is added at the end."""
+    names = sorted(name for name in groups if name.startswith(prefix))
+    page = names[offset:offset + limit]
+    lines = [f"{name} ({len(groups[name])}/{groups[name].max_size})" for name in page]
+    return framing.encode_frame(framing.GROUPS_LIST, page_text("groups", len(names), offset, lines, note))
+
+def members_list(group, by_id, offset, limit, note=""):
+    """MEMBERS_LIST frame for one page of a group's members, in the order they joined the server."""
+    lines = []
+    for session_id in group.ids[offset:offset + limit]:
+        session = by_id.get(session_id)
+        if session is not None:
+            lines.append(session.username)
+    text = page_text(f"members of '{group.name}'", len(group), offset, lines, note)
+    return framing.encode_frame(framing.MEMBERS_LIST, text)
@@ -0,0 +1,169 @@
+from collections import OrderedDict
+
+import framing
+
+# Recent chat, kept per channel so a client that was away can catch up:
+#   *        broadcasts
+#   #<group> one group's messages
+#   @<user>  private messages to one user (their mailbox while offline)
+# Every recorded message gets the next number from one server-wide sequence,
+# so "since N" means the same thing on every channel. Messages are kept as
+# the encoded MESSAGE frames that were sent, and a catch-up is answered with
+# one HISTORY_BATCH frame holding all of them.
+
+# Slots and bytes per ring, by the channel's first character
+LIMITS = {"*": (1000, 4 * 1024 * 1024), "#": (200, 256 * 1024), "@": (50, 64 * 1024)}
+MAX_AWAY = 100000 # Users whose leaving point is remembered
+
+# What a ring costs beyond its frames' bytes, so SERVER_HISTORY_MB bounds the real
+# memory used even with 100k mostly empty mailboxes: the ring itself with its
+# empty lists, dict entry and channel name; each slot in the two lists; and
+# each message's bytes and sequence number objects
+RING_COST = 400
+SLOT_COST = 18
+MESSAGE_COST = 70
+
+class Ring:
+    """
+    The last messages of one channel. The slot lists grow as messages arrive,
+    up to 'capacity', and are then reused in place. 'size' counts everything
+    the ring holds, overheads included.
+    """
+
+    __slots__ = ("seqs", "frames", "capacity", "head", "count", "size", "max_bytes", "dropped")
+
+    def __init__(self, capacity, max_bytes, dropped=0):
+        self.seqs = []
+        self.frames = []
+        self.capacity = capacity
+        self.head = 0 # Slot of the oldest message
+        self.count = 0
+        self.size = RING_COST # Bytes held
+        self.max_bytes = max_bytes
+        self.dropped = dropped # Sequence number of the newest message pushed out (or never held)
+
+    def append(self, seq, frame):
+        """Stores a message, pushing out the oldest ones as needed. Returns the change in bytes held."""
+        before = self.size
+        cost = len(frame) + MESSAGE_COST
+        while self.count and (self.count == self.capacity or self.size + cost + SLOT_COST > self.max_bytes):
+            self.drop_oldest()
+        slots = len(self.frames)
+        if self.count == slots:
+            # Every slot is in use but the ring is below capacity: unroll so the oldest is first, then grow
+            if self.head:
+                self.seqs = self.seqs[self.head:] + self.seqs[:self.head]
+                self.frames = self.frames[self.head:] + self.frames[:self.head]
+                self.head = 0
+            self.seqs.append(seq)
+            self.frames.append(frame)
+            self.size += SLOT_COST
+        else:
+            slot = (self.head + self.count) % slots
+            self.seqs[slot] = seq
+            self.frames[slot] = frame
+        self.count += 1
+        self.size += cost
+        return self.size - before
+
+    def drop_oldest(self):
+        self.dropped = self.seqs[self.head]
+        self.size -= len(self.frames[self.head]) + MESSAGE_COST
+        self.frames[self.head] = None
+        self.head = (self.head + 1) % len(self.frames)
+        self.count -= 1
+
+    def since(self, seq):
+        """Frames numbered after 'seq', oldest first."""
+        slots = len(self.frames)
+        n = self.count
+        # Walk back from the newest, so the cost is the number of messages returned
+        while n and self.seqs[(self.head + n - 1) % slots] > seq:
+            n -= 1
+        return [self.frames[(self.head + i) % slots] for i in range(n, self.count)]
+
+class History:
+    """
+    Rings for the channels that have had messages, least recently written
+    first, plus where each user who left had got to. When the rings together
+    pass 'max_bytes' the least recently written are dropped whole, so memory
+    stays bounded however many users and groups there are.
+
+    With a store.MessageLog every message is also written to disk, numbering
+    carries on from the log after a restart, and older messages can be read
+    back from it.
+    """
+
+    def __init__(self, max_bytes, log=None):
+        self.max_bytes = max_bytes
+        self.log = log
+        self.rings = OrderedDict() # channel -> Ring
+        self.bytes = 0
+        self.seq = log.seq if log is not None else 0 # Number of the newest message on any channel
+        self.floor = self.seq # Rings made from now on may be missing messages up to here
+        self.away = OrderedDict() # username -> (seq when they left, their groups)
+
+    def record(self, channel, frame):
+        self.seq += 1
+        ring = self.rings.get(channel)
+        if ring is None:
+            ring = self.rings[channel] = Ring(*LIMITS[channel[0]], self.floor)
+            self.bytes += ring.size
+        else:
+            self.rings.move_to_end(channel)
+        self.bytes += ring.append(self.seq, frame)
+        while self.bytes > self.max_bytes and len(self.rings) > 1:
+            _, victim = self.rings.popitem(last=False)
+            self.bytes -= victim.size
+            self.floor = self.seq
+        if self.log is not None:
+            self.log.append(channel, self.seq, frame)
+        return self.seq
+
+    def covers(self, channel, seq):
+        """True if the ring for 'channel' holds everything after 'seq'."""
+        ring = self.rings.get(channel)
+        if ring is None:
+            return self.floor <= seq
+        return ring.dropped <= seq
+
+    def since(self, channel, seq):
+        ring = self.rings.get(channel)
+        return ring.since(seq) if ring is not None else []
+
+    def batch(self, channel, seq, always=True):
+        """
+        HISTORY_BATCH payload for the messages on 'channel' after 'seq'.
+        With always=False, None when there are none.
+        """
+        frames = self.since(channel, seq)
+        if not frames and not always:
+            return None
+        gap = 1 if not self.covers(channel, seq) else 0
+        return b"".join([f"{channel} {self.seq} {gap}\n".encode(), *frames])
+
+    def batch_from(self, channel, frames, seq, gap):
+        """HISTORY_BATCH payload for frames read back from the log, the newest numbered 'seq'."""
+        return b"".join([f"{channel} {seq} {1 if gap else 0}\n".encode(), *frames])
+
+    def left(self, username, groups):
+        self.away.pop(username, None)
+        self.away[username] = (self.seq, tuple(groups))
+        if len(self.away) > MAX_AWAY:
+            self.away.popitem(last=False)
+
+    def returned(self, username):
+        """(seq, groups) from when the user left, or None if they are not remembered."""
+        return self.away.pop(username, None)
+
+    def is_away(self, username):
+        return username in self.away
+
+def message_frames(payload):
+    """Splits a HISTORY_BATCH payload into (channel, newest seq, gap, [message text])."""
+    header, _, body = payload.partition(b"\n")
+    channel, seq, gap = header.decode(errors='ignore').rsplit(" ", 2)
+    reader = framing.FrameReader()
+    reader.feed(body)
+    texts = [p.decode(errors='ignore') for _, p in reader.frames()]
+    return channel, int(seq), gap == "1", texts
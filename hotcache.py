@@ -0,0 +1,126 @@
+import mmap
+import os
+import threading
+from collections import OrderedDict
+
+class OpenFile:
+    """A shared file opened for one download only."""
+
+    __slots__ = ("file", "size", "view")
+
+    def __init__(self, f, size):
+        self.file = f
+        self.size = size
+        self.view = None # Read with the file's own position; only one transfer uses it
+
+    def close(self):
+        self.file.close()
+
+class CachedFile:
+    """
+    A shared file kept open and memory-mapped for every download of it.
+    Transfers read from 'view' (or sendfile() from 'file' at an explicit
+    offset), never from the file position, so any number can share it.
+    """
+
+    __slots__ = ("cache", "path", "file", "map", "view", "size", "ino", "mtime_ns", "refs", "evicted")
+
+    def __init__(self, cache, path, f, info):
+        self.cache = cache
+        self.path = path
+        self.file = f
+        self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.map)
+        self.size = info.st_size
+        self.ino = info.st_ino
+        self.mtime_ns = info.st_mtime_ns
+        self.refs = 0 # Transfers using the mapping
+        self.evicted = False # Out of the cache; unmapped once the last transfer is done
+
+    def matches(self, info):
+        return (self.ino, self.size, self.mtime_ns) == (info.st_ino, info.st_size, info.st_mtime_ns)
+
+    def close(self):
+        self.cache.release(self)
+
+    def unmap(self):
+        self.view.release()
+        self.map.close()
+        self.file.close()
+
+class HotFileCache:
+    """
+    LRU of memory-mapped shared files, bounded by the total bytes mapped.
+    open() runs on worker threads and one os.stat() tells a hit from a stale
+    entry: a file that was replaced or rewritten (new inode, size or mtime)
+    is mapped afresh. Files that are empty or larger than the whole budget
+    are opened uncached.
+
+    A mapped file must not be truncated in place while it is being served;
+    publish new versions by writing a new file and renaming it over the old one.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict() # path -> CachedFile, least recently used first
+        self.mapped_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def open(self, path):
+        """Worker job: a CachedFile or OpenFile for 'path', or None if it has gone. Call close() when done."""
+        try:
+            info = os.stat(path)
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and entry.matches(info):
+                self.entries.move_to_end(path)
+                entry.refs += 1
+                self.hits += 1
+                return entry
+            self.misses += 1
+        try:
+            f = open(path, "rb")
+        except (FileNotFoundError, IsADirectoryError):
+            return None
+        info = os.fstat(f.fileno())
+        if info.st_size == 0 or info.st_size > self.max_bytes:
+            return OpenFile(f, info.st_size)
+        try:
+            entry = CachedFile(self, path, f, info)
+        except (OSError, ValueError):
+            return OpenFile(f, info.st_size)
+        with self.lock:
+            old = self.entries.pop(path, None)
+            if old is not None:
+                self.drop(old)
+            entry.refs = 1
+            self.entries[path] = entry
+            self.mapped_bytes += entry.size
+            while self.mapped_bytes > self.max_bytes:
+                _, victim = self.entries.popitem(last=False)
+                self.evictions += 1
+                self.drop(victim)
+        return entry
+
+    def release(self, entry):
+        with self.lock:
+            entry.refs -= 1
+            if entry.evicted and not entry.refs:
+                entry.unmap()
+
+    def drop(self, entry):
+        # Called with the lock held
+        entry.evicted = True
+        self.mapped_bytes -= entry.size
+        if not entry.refs:
+            entry.unmap()
+
+    def clear(self):
+        with self.lock:
+            while self.entries:
+                self.drop(self.entries.popitem()[1])
@@ -0,0 +1,110 @@
+import bisect
+import time
+
+import framing
+
+# Counters the server updates on its hot paths, rendered in the Prometheus
+# text format when the admin endpoint (SERVER_METRICS_PORT) is scraped.
+# Everything is a plain attribute or list so updating it costs one addition;
+# totals that would need a walk over every session (queue depths, client
+# counts) are only worked out at scrape time.
+
+LOOP_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+FANOUT_BUCKETS = (1, 2, 5, 10, 50, 100, 500, 1000, 5000, 10000, 50000, 100000)
+
+class Histogram:
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1) # The last slot is +Inf
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, help_text):
+        lines = [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+        total = 0
+        for bound, count in zip(self.bounds, self.counts):
+            total += count
+            lines.append(f'{name}_bucket{{le="{bound}"}} {total}')
+        lines.append(f'{name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f"{name}_sum {self.sum}")
+        lines.append(f"{name}_count {self.count}")
+        return lines
+
+class Metrics:
+    def __init__(self):
+        self.started = time.time()
+        self.connections = 0 # Accepted since start
+        self.bytes_in = 0
+        self.bytes_out = 0 # Frames written from outboxes
+        self.commands = [0] * 256 # Frames received, by opcode
+        self.command_seconds = [0.0] * 256 # Time spent in each opcode's handler
+        self.file_bytes = {"tcp": 0, "udp": 0}
+        self.transfers = {"tcp": 0, "udp": 0} # Completed downloads
+        self.throttled = {"drop": 0, "delay": 0, "disconnect": 0, "group": 0, "downloads": 0} # Commands held back by flood control
+        self.reaped = {"join": 0, "heartbeat": 0} # Connections closed for never joining or not answering PING
+        self.loop_iterations = 0
+        self.loop_seconds = Histogram(LOOP_BUCKETS) # Work done per loop turn, excluding the wait in select()
+        self.fanout = Histogram(FANOUT_BUCKETS) # Recipients per broadcast or group message
+        self.gauges = [] # (name, help, kind, fn) worked out at scrape time
+
+    def gauge(self, name, help_text, fn, kind="gauge"):
+        # kind="counter" for totals kept elsewhere, such as the hot file cache's hit count
+        self.gauges.append((name, help_text, kind, fn))
+
+    def render(self):
+        lines = []
+
+        def counter(name, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} counter")
+            for labels, value in samples:
+                lines.append(f"{name}{labels} {value}")
+
+        lines.append("# HELP server_uptime_seconds Seconds since the server started")
+        lines.append("# TYPE server_uptime_seconds gauge")
+        lines.append(f"server_uptime_seconds {time.time() - self.started:.3f}")
+        for name, help_text, kind, fn in self.gauges:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.append(f"{name} {fn()}")
+        counter("server_connections_total", "Connections accepted", [("", self.connections)])
+        counter("server_bytes_received_total", "Bytes read from clients", [("", self.bytes_in)])
+        counter("server_bytes_sent_total", "Frame bytes written to clients, excluding file bodies", [("", self.bytes_out)])
+        counter("server_commands_total", "Frames received from clients, by command",
+                [(f'{{command="{framing.OPCODE_NAMES.get(op, op)}"}}', count)
+                 for op, count in enumerate(self.commands) if count])
+        counter("server_command_seconds_total", "Seconds spent in each command's handler",
+                [(f'{{command="{framing.OPCODE_NAMES.get(op, op)}"}}', seconds)
+                 for op, seconds in enumerate(self.command_seconds) if seconds])
+        counter("server_file_bytes_sent_total", "File bytes sent, by protocol",
+                [(f'{{protocol="{proto}"}}', count) for proto, count in self.file_bytes.items()])
+        counter("server_transfers_total", "Downloads completed, by protocol",
+                [(f'{{protocol="{proto}"}}', count) for proto, count in self.transfers.items()])
+        counter("server_throttled_total", "Commands held back by flood control, by what was done",
+                [(f'{{action="{action}"}}', count) for action, count in self.throttled.items()])
+        counter("server_reaped_total", "Connections closed as dead or idle, by reason",
+                [(f'{{reason="{reason}"}}', count) for reason, count in self.reaped.items()])
+        counter("server_loop_iterations_total", "Event loop turns", [("", self.loop_iterations)])
+        lines += self.loop_seconds.render("server_loop_seconds", "Time spent handling the events of one loop turn")
+        lines += self.fanout.render("server_fanout_recipients", "Recipients of each broadcast or group message")
+        return "\n".join(lines) + "\n"
+
+class Scrape:
+    """One connection to the admin endpoint, served by the event loop like any client."""
+
+    __slots__ = ("sock", "reply", "timer")
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.reply = None # memoryview of the response still to send, once the request has arrived
+        self.timer = None # Closes the connection if it is still open after SCRAPE_TIMEOUT
+
+def http_response(body):
+    body = body.encode()
+    return (b"HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+            b"Content-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body)
@@ -0,0 +1,47 @@
+import time
+
+# Flood control. Each session has a bucket that every command takes a token
+# from, and each group has one that its messages take from. Buckets refill
+# from the time since they were last used, so nothing runs between commands.
+# What happens to a command that finds its session's bucket empty is set by
+# SERVER_FLOOD_POLICY:
+#   drop        it is discarded and the sender told (at most once a second)
+#   delay       it and everything after it wait until a token is due;
+#               the connection is not read from meanwhile
+#   disconnect  the connection is closed
+# Group messages over their group's rate are always dropped.
+
+POLICIES = ("drop", "delay", "disconnect")
+NOTICE_INTERVAL = 1.0 # Seconds between "slow down" notices to one session
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "stamp", "noticed")
+
+    def __init__(self, rate, burst):
+        self.rate = rate # Tokens per second
+        self.burst = burst # Most tokens that can be saved up
+        self.tokens = burst
+        self.stamp = time.monotonic()
+        self.noticed = 0.0 # When the owner was last told they are being throttled
+
+    def take(self, now, cost=1):
+        """Takes 'cost' tokens if there are that many. Returns False, taking nothing, if not."""
+        tokens = self.tokens + (now - self.stamp) * self.rate
+        if tokens > self.burst:
+            tokens = self.burst
+        self.stamp = now
+        if tokens >= cost:
+            self.tokens = tokens - cost
+            return True
+        self.tokens = tokens
+        return False
+
+    def wait(self, cost=1):
+        """Seconds from the last take() until 'cost' tokens are available."""
+        return max(0.0, (cost - self.tokens) / self.rate)
+
+    def should_notice(self, now):
+        if now - self.noticed < NOTICE_INTERVAL:
+            return False
+        self.noticed = now
+        return True
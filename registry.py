@@ -0,0 +1,117 @@
+from collections import deque
+from itertools import count
+
+import framing
+import groups
+
+class Session:
+    """Everything the server keeps for one connection. __slots__ keeps this small at 100k users."""
+
+    __slots__ = ("id", "sock", "addr", "username", "groups", "reader", "outbox", "outbox_size",
+                 "flush_pending", "want_write", "transfers", "closing", "joining", "codec", "stream", "bucket", "held", "downloads",
+                 "owner", "last_seen", "pinged", "timer", "resume_token")
+
+    def __init__(self, session_id, sock, addr):
+        self.id = session_id # Never reused, so group member arrays can hold it instead of the session
+        self.sock = sock
+        self.addr = addr
+        self.username = None # Set once JOIN succeeds
+        self.groups = set() # Names of the groups this session belongs to
+        self.reader = framing.FrameReader()
+        self.outbox = deque() # Pending outbound bytes
+        self.outbox_size = 0
+        self.flush_pending = False # Listed for the end-of-turn flush
+        self.want_write = False # Registered for write readiness
+        self.transfers = None # deque of FileTransfer while downloads are queued
+        self.closing = False # Close once the outbox has drained
+        self.joining = None # Username awaiting a cluster-wide claim (multi-process mode only)
+        self.codec = None # Compression agreed at JOIN, if any
+        self.stream = False # Extra connection of a parallel download: ranges only, never listed as a user
+        self.bucket = None # ratelimit.TokenBucket for this connection's commands
+        self.held = None # (opcode, payload) waiting for a token under the "delay" flood policy
+        self.downloads = 0 # TCP, UDP and range downloads, and download streams, requested and not yet finished
+        self.owner = None # For a download stream: the user's session, whose download limit the stream counts against
+        self.last_seen = 0.0 # time.monotonic() of the last bytes received
+        self.pinged = None # When the last heartbeat PING was sent
+        self.timer = None # timerwheel.Timer for the next idle/heartbeat check
+        self.resume_token = None # Given at JOIN to clients that can reconnect; see SERVER_RESUME_SECONDS
+
+    def __repr__(self):
+        return self.username or f"{self.addr[0]}:{self.addr[1]}"
+
+class Registry:
+    """
+    Indexes sessions by socket, id and username, and groups by name, with
+    each session holding the names of its own groups. Lookups are O(1),
+    group membership changes O(log n) plus the array shift; removing a
+    session costs that for each group it belongs to.
+    """
+
+    def __init__(self):
+        self.by_sock = {} # socket -> Session
+        self.by_id = {} # session id -> Session
+        self.by_name = {} # username -> Session, joined sessions only
+        self.groups = {}  # group_name -> groups.Group
+        self.ids = count(1)
+
+    def __len__(self):
+        return len(self.by_sock)
+
+    def add(self, sock, addr):
+        session = Session(next(self.ids), sock, addr)
+        self.by_sock[sock] = session
+        self.by_id[session.id] = session
+        return session
+
+    def claim_name(self, session, username):
+        """Gives the session its username. Returns False if another session already has it."""
+        if username in self.by_name:
+            return False
+        session.username = username
+        self.by_name[username] = session
+        return True
+
+    def find(self, username):
+        return self.by_name.get(username)
+
+    def joined(self):
+        return self.by_name.values()
+
+    def members(self, group_name):
+        """The groups.Group, which is empty (false) once everyone has left."""
+        return self.groups.get(group_name, ())
+
+    def member_sessions(self, group_name):
+        by_id = self.by_id
+        return [by_id[session_id] for session_id in self.groups.get(group_name, ())]
+
+    def join_group(self, session, group_name, max_size):
+        """Returns False if the group is full. A group that does not exist yet is created, with room for 'max_size'."""
+        group = self.groups.get(group_name)
+        if group is None:
+            group = self.groups[group_name] = groups.Group(group_name, max_size, session.username)
+        if not group.add(session.id):
+            if not group:
+                del self.groups[group_name]
+            return False
+        session.groups.add(group_name)
+        return True
+
+    def leave_group(self, session, group_name):
+        """Returns False if the session was not in the group. Empty groups are deleted."""
+        if group_name not in session.groups:
+            return False
+        session.groups.discard(group_name)
+        members = self.groups[group_name]
+        members.discard(session.id)
+        if not members:
+            del self.groups[group_name]
+        return True
+
+    def remove(self, session):
+        self.by_sock.pop(session.sock, None)
+        self.by_id.pop(session.id, None)
+        if session.username is not None and self.by_name.get(session.username) is session:
+            del self.by_name[session.username]
+        for group_name in list(session.groups):
+            self.leave_group(session, group_name)
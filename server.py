@@ -1,272 +1,1296 @@
 import socket
-import select
+import selectors
 import sys
 import os
 import time
+import atexit
+import logging
+import logging.handlers
+import queue
+import secrets
+from collections import deque
+from itertools import islice
+
+import commands
+import compression
+import framing
+import groups
+import history
+import hotcache
+import metrics
+import ratelimit
+import store
+import timerwheel
+from catalog import Catalog, LIST_PAGE
+import udp_transfer
+import workers
+from registry import Registry
 
 HOST = '0.0.0.0'
 DEFAULT_PORT = 12000
-BUFFER_SIZE = 4096
+RECV_SIZE = 65536 # One recv can carry many pipelined frames
+FILE_CHUNK_SIZE = 65536
+SENDFILE_SLICE = 256 * 1024 # Largest FILE_DATA frame written per wakeup
+COMPRESSED_SLICE = 64 * 1024 # File bytes compressed per FILE_DATA frame; compression runs on the loop thread
+MAX_OUTBOX_BYTES = 64 * 1024 * 1024 # Per-client cap before a slow reader is disconnected
+FILE_WORKERS = int(os.environ.get('SERVER_FILE_WORKERS', '8'))
+UDP_WORKERS = int(os.environ.get('SERVER_UDP_WORKERS', '8')) # UDP transfers sent at once; later ones wait their turn
+USER_FILE_JOBS = int(os.environ.get('SERVER_USER_FILE_JOBS', '2')) # File jobs one client may have running at once
+MAX_WAITING_FILE_JOBS = 1024
+SERVER_WORKERS = int(os.environ.get('SERVER_WORKERS', '1')) # Processes sharing the port (see shard.py)
+LOG_LEVEL = os.environ.get('SERVER_LOG_LEVEL', 'INFO').upper() # DEBUG also logs every message; WARNING for production
+HOT_CACHE_BYTES = int(os.environ.get('SERVER_HOT_CACHE_MB', '256')) * 1024 * 1024 # Shared files kept memory-mapped
+CATALOG_POLL = float(os.environ.get('SERVER_CATALOG_POLL', '2')) # Seconds a shared folder listing is trusted for
+HISTORY_BYTES = int(os.environ.get('SERVER_HISTORY_MB', '64')) * 1024 * 1024 # Recent messages kept for catch-up
+STORE_DIR = os.environ.get('SERVER_STORE_DIR', '') # Durable message log (store.py), off when empty
+STORE_SEGMENT_BYTES = int(os.environ.get('SERVER_STORE_SEGMENT_MB', '64')) * 1024 * 1024
+STORE_RETENTION_BYTES = int(os.environ.get('SERVER_STORE_RETENTION_MB', '1024')) * 1024 * 1024 # Oldest segments deleted past this
+STORE_COMMIT = float(os.environ.get('SERVER_STORE_COMMIT_MS', '20')) / 1000 # Group commit interval: one fsync per interval
+MAX_HISTORY_BATCH = 4 * 1024 * 1024 # Bytes of logged messages per HISTORY_BATCH reply
+METRICS_PORT = int(os.environ.get('SERVER_METRICS_PORT', '0')) # Prometheus text endpoint on 127.0.0.1, 0 = off
+MSG_RATE = float(os.environ.get('SERVER_MSG_RATE', '20')) # Commands per second per connection, 0 = unlimited
+MSG_BURST = int(os.environ.get('SERVER_MSG_BURST', '50'))
+GROUP_RATE = float(os.environ.get('SERVER_GROUP_RATE', '200')) # Messages per second per group, 0 = unlimited
+GROUP_BURST = int(os.environ.get('SERVER_GROUP_BURST', '400'))
+FLOOD_POLICY = os.environ.get('SERVER_FLOOD_POLICY', 'drop').lower() # drop, delay or disconnect (see ratelimit.py)
+USER_DOWNLOADS = int(os.environ.get('SERVER_USER_DOWNLOADS', '4')) # Downloads and download streams one client may have going at once
+MAX_HELD_BYTES = 1024 * 1024 # Input a client held back by the "delay" policy may send before it is disconnected
+PING_INTERVAL = float(os.environ.get('SERVER_PING_INTERVAL', '30')) # Seconds of silence before a client is pinged, 0 = no heartbeats
+PING_TIMEOUT = float(os.environ.get('SERVER_PING_TIMEOUT', '15')) # Seconds a pinged client has to answer
+JOIN_TIMEOUT = float(os.environ.get('SERVER_JOIN_TIMEOUT', '30')) # Seconds a new connection has to JOIN
+STREAM_COMMANDS = (framing.MANIFEST, framing.DOWNLOAD_RANGE, framing.PONG, framing.EXIT) # All a download stream may send
+GROUP_MAX_SIZE = int(os.environ.get('SERVER_GROUP_MAX_SIZE', '100000')) # Most members a group can have
+FANOUT_BATCH = int(os.environ.get('SERVER_FANOUT_BATCH', '2000')) # Group members given a queued message per loop turn
+SCRAPE_TIMEOUT = 5.0 # Seconds a metrics connection may stay open
+RESUME_SECONDS = float(os.environ.get('SERVER_RESUME_SECONDS', '300')) # How long a lost client's resume token keeps its groups
+UNTHROTTLED = (framing.PONG, framing.EXIT) # Never refused by flood control
+HAVE_SENDMSG = hasattr(socket.socket, "sendmsg") # Not available on Windows
+try:
+    IOV_MAX = min(os.sysconf("SC_IOV_MAX"), 1024)
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 64
 
-def main():
-    if len(sys.argv) != 2:
-        print(f"Usage: python {sys.argv[0]} [port]")
-        sys.exit(1)
+log = logging.getLogger("server")
+stats = metrics.Metrics()
+log_listener = None
 
+def setup_logging():
+    """
+    Log records are put on a queue and written to stdout by a background
+    thread, so a slow terminal never stalls the event loop. Call again in
+    a forked worker, which does not inherit the writer thread.
+    """
+    global log_listener
+    if log_listener is not None:
+        log_listener.stop()
+    records = queue.SimpleQueue()
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    log_listener = logging.handlers.QueueListener(records, handler)
+    log_listener.start()
+    log.handlers[:] = [logging.handlers.QueueHandler(records)]
+    log.setLevel(LOG_LEVEL)
+    log.propagate = False
+    atexit.register(log_listener.stop)
+
+def raise_fd_limit():
+    # Each idle client costs one descriptor; lift the soft limit as far as allowed
     try:
-        port = int(sys.argv[1])
-    except ValueError:
-        print("Port must be an integer.")
-        sys.exit(1)
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    target = max(soft, 65536) if hard == resource.RLIM_INFINITY else hard
+    if target > soft:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+        except (ValueError, OSError):
+            pass
+
+def setup_shared_files():
+    # Utilise environment variable if set, otherwise default
+    shared_files_dir = os.environ.get('SERVER_SHARED_FILES', 'SharedFiles')
+
+    if not os.path.exists(shared_files_dir):
+        os.makedirs(shared_files_dir)
+        log.info(f"Created {shared_files_dir} directory.")
+
+    dummy_file = os.path.join(shared_files_dir, "welcome.txt")
+    if not os.path.exists(dummy_file):
+        with open(dummy_file, "w") as f:
+            f.write("This is a test file served from SharedFiles.")
+    return shared_files_dir
+
+def send_file_udp(file_path, addr, transfer_id, chunk_size):
+    """Sends a file reliably to a client's UdpReceiver. Returns False if the client stopped acking."""
+    f = open(file_path, "rb")
+    handle = hotcache.OpenFile(f, os.fstat(f.fileno()).st_size)
+    return send_open_file_udp(handle, os.path.basename(file_path), addr, transfer_id, chunk_size)
+
+def send_open_file_udp(handle, filename, addr, transfer_id, chunk_size, codec=None):
+    """Worker job: as send_file_udp, for a file handle from HotFileCache.open(). Closes the handle."""
+    loss_rate = float(os.environ.get('SERVER_UDP_LOSS', '0')) # Simulated packet loss, for testing
+    try:
+        sender = udp_transfer.UdpSender(handle.file, handle.size, addr, transfer_id, chunk_size, loss_rate, handle.view, codec)
+        ok = sender.run()
+    finally:
+        handle.close()
+    log.debug("UDP send of %s: %d packets, %d retransmitted", filename, sender.packets_sent, sender.retransmits)
+    return ok
+
+def write_outbox(session):
+    """
+    Writes queued frames with one scatter/gather sendmsg() per IOV_MAX buffers.
+    Returns True once the outbox is empty, False when the socket is full.
+    """
+    queue = session.outbox
+    sock = session.sock
+    while queue:
+        try:
+            if HAVE_SENDMSG:
+                sent = sock.sendmsg(islice(queue, IOV_MAX))
+            else:
+                sent = sock.send(b"".join(islice(queue, IOV_MAX)))
+        except BlockingIOError:
+            return False
+        session.outbox_size -= sent
+        stats.bytes_out += sent
+        while sent:
+            head = queue[0]
+            if sent < len(head):
+                queue[0] = memoryview(head)[sent:]
+                return False
+            sent -= len(head)
+            queue.popleft()
+    return True
 
+def read_file_slice(handle, offset, count):
+    if handle.view is not None:
+        return handle.view[offset:offset + count]
+    if hasattr(os, "pread"):
+        return os.pread(handle.file.fileno(), count, offset)
+    handle.file.seek(offset)
+    return handle.file.read(count)
+
+def send_file_slice(sock, handle, offset, count):
+    if hasattr(os, "sendfile"):
+        # Zero-copy: the kernel moves file pages straight into the socket
+        return os.sendfile(sock.fileno(), handle.file.fileno(), offset, count)
+    if handle.view is not None:
+        return sock.send(handle.view[offset:offset + min(count, FILE_CHUNK_SIZE)])
+    f = handle.file
+    f.seek(offset)
+    return sock.send(f.read(min(count, FILE_CHUNK_SIZE)))
+
+class FileTransfer:
+    """
+    A TCP download in progress. The file is sent as FILE_DATA frames of up to
+    SENDFILE_SLICE bytes, each written as a frame header followed by sendfile().
+    With a compression codec, each slice is read, compressed and sent as one
+    whole frame instead. 'start' is the FILE_START_TCP (or FILE_RANGE) frame;
+    it goes out when the transfer reaches the head of the session's queue, so
+    the FILE_DATA of a transfer ahead of it is never split by it.
+    """
+
+    def __init__(self, handle, filename, offset, size, codec=None, start=None):
+        self.handle = handle # hotcache.CachedFile or OpenFile
+        self.filename = filename
+        self.offset = offset
+        self.size = size
+        self.codec = codec
+        self.start = memoryview(start) if start else None # Sent by the first send_slice(), after the outbox has drained
+        self.header = None # Unsent part of the frame header (or of the whole frame, when compressing)
+        self.counted = False # Holds one of the session's SERVER_USER_DOWNLOADS
+        self.slice_left = 0
+
+    def in_slice(self):
+        return self.header is not None or self.slice_left > 0
+
+    def done(self):
+        return self.offset >= self.size and self.start is None and not self.in_slice()
+
+    def send_slice(self, sock):
+        # Raises BlockingIOError when the socket fills; the next call carries on from there
+        if self.start is not None:
+            # From here on it is part of a slice, so nothing else may be written until it is all out
+            self.header, self.start = self.start, None
+        elif not self.in_slice() and self.codec is not None:
+            count = min(COMPRESSED_SLICE, self.size - self.offset)
+            data = read_file_slice(self.handle, self.offset, count)
+            if len(data) < count:
+                raise OSError(f"{self.filename} shrank during transfer")
+            frame = compression.encode_frame(framing.FILE_DATA, data, self.codec)
+            if not frame[framing.HEADER_SIZE - 1] & framing.COMPRESSED:
+                # Already compressed media and the like; the rest goes out with sendfile
+                self.codec = None
+            self.header = memoryview(frame)
+            self.offset += count
+            stats.file_bytes["tcp"] += count
+        elif not self.in_slice():
+            count = min(SENDFILE_SLICE, self.size - self.offset)
+            self.header = memoryview(framing.HEADER.pack(count, framing.FILE_DATA))
+            self.slice_left = count
+        while self.header is not None:
+            sent = sock.send(self.header)
+            self.header = self.header[sent:] if sent < len(self.header) else None
+        while self.slice_left:
+            sent = send_file_slice(sock, self.handle, self.offset, self.slice_left)
+            if sent == 0:
+                raise OSError(f"{self.filename} shrank during transfer")
+            stats.file_bytes["tcp"] += sent
+            self.offset += sent
+            self.slice_left -= sent
+
+    def close(self):
+        self.handle.close()
+
+def create_listener(port, reuse_port=False):
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        # Every worker binds the same port; the kernel spreads new connections across them
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
 
     try:
         server_socket.bind((HOST, port))
-        server_socket.listen(5)
-        print(f"Server listening on {HOST}:{port}")
+        server_socket.listen(socket.SOMAXCONN)
+        server_socket.setblocking(False)
     except Exception as e:
         print(f"Error starting server: {e}")
         sys.exit(1)
+    return server_socket
+
+def serve(server_socket, bus=None, metrics_port=0, store_dir=None):
+    """
+    Runs the event loop on a listening socket. 'bus' is a shard.BusConnection
+    when this is one of several worker processes (see shard.py); messages for
+    users on other workers, and username claims, then go through it.
+    With 'store_dir' every message is also kept in a store.MessageLog there.
+    """
+    # epoll/kqueue where available, so each loop turn only costs the ready sockets
+    sel = selectors.DefaultSelector()
+    sel.register(server_socket, selectors.EVENT_READ)
 
-    inputs = [server_socket]
-    clients = {} # socket -> username
-    groups = {}  # group_name -> set(sockets)
+    # Disk work runs here; results come back through the pool's wakeup socket
+    pool = workers.WorkerPool(FILE_WORKERS, USER_FILE_JOBS, MAX_WAITING_FILE_JOBS)
+    sel.register(pool, selectors.EVENT_READ)
+    # UDP transfers hold a thread for their whole length, so they get their own, leaving the short jobs above free
+    udp_pool = workers.WorkerPool(UDP_WORKERS, USER_FILE_JOBS, MAX_WAITING_FILE_JOBS)
+    sel.register(udp_pool, selectors.EVENT_READ)
 
-    def broadcast_message(message, sender_socket=None):
-        for sock in clients:
-            if sock != sender_socket:
+    registry = Registry()
+    message_log = None
+    if store_dir:
+        message_log = store.MessageLog(store_dir, STORE_SEGMENT_BYTES, STORE_RETENTION_BYTES, STORE_COMMIT)
+        log.info(f"Message log in {store_dir}, continuing from #{message_log.seq}")
+        stats.gauge("server_store_commits_total", "Group commits (one write and fsync each) to the message log",
+                    lambda: message_log.commits, "counter")
+        stats.gauge("server_store_fsync_seconds_total", "Time spent writing and syncing the message log",
+                    lambda: round(message_log.fsync_seconds, 6), "counter")
+        stats.gauge("server_store_pending", "Messages waiting for the next commit", lambda: len(message_log.pending))
+    recent = history.History(HISTORY_BYTES, message_log)
+
+    admin_socket = None
+    if metrics_port:
+        admin_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        admin_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        admin_socket.bind(("127.0.0.1", metrics_port))
+        admin_socket.listen()
+        admin_socket.setblocking(False)
+        sel.register(admin_socket, selectors.EVENT_READ)
+        log.info(f"Metrics on http://127.0.0.1:{metrics_port}/metrics")
+    stats.gauge("server_clients", "Open client connections", lambda: len(registry))
+    stats.gauge("server_users", "Clients that have joined", lambda: len(registry.by_name))
+    stats.gauge("server_groups", "Groups with members", lambda: len(registry.groups))
+    stats.gauge("server_outbox_bytes", "Bytes queued for all clients", lambda: sum(s.outbox_size for s in registry.by_sock.values()))
+    stats.gauge("server_outbox_bytes_max", "Largest queue of any one client", lambda: max((s.outbox_size for s in registry.by_sock.values()), default=0))
+    stats.gauge("server_file_jobs", "File jobs running or waiting", pool.active)
+    stats.gauge("server_udp_sends", "UDP transfers running or waiting", udp_pool.active)
+    stats.gauge("server_hot_cache_hits_total", "Downloads served from an already mapped file", lambda: hot_files.hits, "counter")
+    stats.gauge("server_hot_cache_misses_total", "Downloads that had to open the file", lambda: hot_files.misses, "counter")
+    stats.gauge("server_hot_cache_evictions_total", "Mapped files pushed out of the cache", lambda: hot_files.evictions, "counter")
+    stats.gauge("server_hot_cache_bytes", "Bytes of shared files currently mapped", lambda: hot_files.mapped_bytes)
+    stats.gauge("server_history_bytes", "Bytes of recent messages kept for catch-up", lambda: recent.bytes)
+    stats.gauge("server_group_deliveries", "Group messages still being fanned out", lambda: len(deliveries))
+    stats.gauge("server_shared_files", "Files in the shared folder catalog", lambda: len(catalog.entries))
+
+    pending_joins = {} # username -> Session waiting for the bus to confirm its claim
+    deliveries = deque() # groups.Delivery for group messages still being fanned out
+    resumable = {} # resume token -> (username, group names) of a client that has gone, for RESUME_SECONDS
+    group_buckets = {} # group_name -> ratelimit.TokenBucket
+    timers = timerwheel.TimerWheel() # Heartbeats, idle connections and flood-control delays
+    flood_policy = FLOOD_POLICY
+    if flood_policy not in ratelimit.POLICIES:
+        log.warning(f"Unknown SERVER_FLOOD_POLICY '{flood_policy}', using drop")
+        flood_policy = "drop"
+    if bus is not None:
+        import shard
+        sel.register(bus, selectors.EVENT_READ, bus)
+
+    dirty = [] # Sessions given new outbound frames during this loop turn
+
+    def send_to(session, data):
+        # Frames are only queued here (by reference, so a fan-out shares one buffer);
+        # flush_dirty() writes each outbox with one gathered send at the end of the turn
+        if session.sock is None or session.closing:
+            return
+        session.outbox.append(data)
+        session.outbox_size += len(data)
+        if session.outbox_size > MAX_OUTBOX_BYTES:
+            log.warning(f"Dropping slow client {session}: {session.outbox_size} bytes queued")
+            drop_client(session)
+            return
+        if not session.flush_pending:
+            session.flush_pending = True
+            dirty.append(session)
+
+    def set_write_interest(session, enabled):
+        if session.want_write != enabled:
+            session.want_write = enabled
+            events = selectors.EVENT_READ | selectors.EVENT_WRITE if enabled else selectors.EVENT_READ
+            sel.modify(session.sock, events, session)
+
+    def flush_dirty():
+        for session in dirty:
+            session.flush_pending = False
+            # Sessions already waiting for write readiness (or mid-download) are flushed by on_writable
+            if session.sock is None or session.want_write:
+                continue
+            try:
+                done = write_outbox(session)
+            except OSError as e:
+                log.warning(f"Send error for {session}: {e}")
+                drop_client(session)
+                continue
+            if not done:
+                set_write_interest(session, True)
+            elif session.closing:
+                drop_client(session)
+        dirty.clear()
+
+    def flush_bus():
+        done = bus.flush()
+        if bus.want_write == done:
+            bus.want_write = not done
+            events = selectors.EVENT_READ | selectors.EVENT_WRITE if bus.want_write else selectors.EVENT_READ
+            sel.modify(bus, events, bus)
+
+    def on_writable(session):
+        sock = session.sock
+        pending = session.transfers
+        try:
+            # A FILE_DATA slice that is half written must finish before any other frame
+            if pending and pending[0].in_slice():
+                pending[0].send_slice(sock)
+            if not write_outbox(session):
+                return
+            if pending:
+                transfer = pending[0]
+                if transfer.done():
+                    finish_transfer(session)
+                else:
+                    # One slice per wakeup, so chat and other downloads get a turn in between
+                    transfer.send_slice(sock)
+                return
+        except BlockingIOError:
+            return
+        except OSError as e:
+            log.warning(f"Send error for {session}: {e}")
+            drop_client(session)
+            return
+        if session.closing:
+            drop_client(session)
+            return
+        set_write_interest(session, False)
+
+    def close_after_flush(session):
+        # Lets a final reply reach the client before the connection is closed
+        if not session.outbox:
+            drop_client(session)
+            return
+        session.closing = True
+
+    def start_transfer(session, transfer):
+        if session.transfers is None:
+            session.transfers = deque()
+        session.transfers.append(transfer)
+        set_write_interest(session, True)
+
+    def finish_transfer(session):
+        transfer = session.transfers.popleft()
+        transfer.close()
+        if transfer.counted:
+            session.downloads -= 1
+        if session.stream:
+            log.debug("Sent a range of %s to %s", transfer.filename, session)
+        else:
+            stats.transfers["tcp"] += 1
+            log.info(f"Sent {transfer.filename} via TCP to {session}")
+        if not session.transfers:
+            session.transfers = None
+
+    def drop_client(session, announce=True):
+        sock = session.sock
+        if sock is None:
+            return
+        sel.unregister(sock)
+        if session.username is not None and not session.stream:
+            recent.left(session.username, session.groups) # Where to catch up from if they come back
+            if bus is not None:
+                bus.send(shard.RELEASE, session.username)
+                for group_name in session.groups:
+                    if len(registry.members(group_name)) == 1:
+                        bus.send(shard.GROUP_DROP, group_name)
+        group_names = list(session.groups)
+        registry.remove(session) # Still keyed by the socket, so before sock is cleared
+        for group_name in group_names:
+            if not registry.members(group_name):
+                group_buckets.pop(group_name, None)
+        if session.resume_token is not None:
+            # Lets the same client JOIN again with its groups; tokens are only good once
+            resumable[session.resume_token] = (session.username, group_names)
+            timers.schedule(RESUME_SECONDS, resumable.pop, session.resume_token, None)
+        if session.owner is not None:
+            session.owner.downloads -= 1 # The stream itself was counted when it joined
+            session.owner = None
+        session.sock = None
+        session.outbox.clear()
+        session.outbox_size = 0
+        for transfer in session.transfers or ():
+            transfer.close()
+        session.transfers = None
+        pool.cancel(session)
+        udp_pool.cancel(session)
+        timers.cancel(session.timer)
+        session.timer = None
+        try:
+            sock.close()
+        except OSError:
+            pass
+        if session.username is not None and announce and not session.stream:
+            broadcast_message(f"Server: {session.username} has left")
+
+    def with_catalog(session, fn):
+        # Runs fn() against a catalog no older than CATALOG_POLL, rescanning on a worker first if needed
+        def run():
+            if session.sock is not None:
+                fn()
+        if not catalog.stale():
+            run()
+            return
+        catalog.waiting.append(run)
+        if not catalog.refreshing:
+            catalog.refreshing = True
+            if not pool.submit(catalog, catalog.scan, (), on_scanned):
+                catalog.apply(None) # Pool is full; answer from the listing we have
+
+    def on_scanned(result, error):
+        if error:
+            log.warning(f"Unable to scan shared files: {error}")
+            result = None
+        catalog.apply(result)
+
+    def submit_file_job(session, fn, args, callback, jobs=pool, started=None, discarded=None):
+        def on_done(result, error):
+            # The client may have left while the job ran
+            if session.sock is not None:
                 try:
-                    sock.send(message.encode())
-                except:
-                    pass
-
-    def group_message(group_name, message, sender_socket=None):
-        if group_name in groups:
-            for sock in groups[group_name]:
-                if sock != sender_socket:
-                    try:
-                        sock.send(message.encode())
-                    except:
-                        pass
+                    callback(result, error)
+                except Exception:
+                    if hasattr(result, "close"):
+                        result.close()
+                    session_failed(session, "finishing a file job")
+            elif hasattr(result, "close"):
+                result.close()
+        if not jobs.submit(session, fn, args, on_done, started, discarded):
+            send_text(session, "Server: Too many file requests, try again later.")
+            return False
+        return True
 
-    # Utilise environment variable if set, otherwise default
-    shared_files_dir = os.environ.get('SERVER_SHARED_FILES', 'SharedFiles')
+    def send_text(session, text, opcode=framing.MESSAGE):
+        if isinstance(text, str):
+            text = text.encode()
+        send_to(session, compression.encode_frame(opcode, text, session.codec))
 
-    if not os.path.exists(shared_files_dir):
-        os.makedirs(shared_files_dir)
-        print(f"Created {shared_files_dir} directory.")
+    def deliver_all(data, sender=None):
+        recent.record("*", data)
+        recipients = list(registry.joined())
+        stats.fanout.observe(len(recipients))
+        # Compressed once per codec in use, then shared like the plain frame
+        fanout = compression.Fanout(data)
+        for session in recipients:
+            if session is not sender:
+                send_to(session, fanout.frame_for(session.codec))
 
-    dummy_file = os.path.join(shared_files_dir, "welcome.txt")
-    if not os.path.exists(dummy_file):
-        with open(dummy_file, "w") as f:
-            f.write("This is a test file served from SharedFiles.")
+    def deliver_group(group_name, data, sender=None):
+        recent.record("#" + group_name, data)
+        group = registry.members(group_name)
+        stats.fanout.observe(len(group))
+        if not group:
+            return
+        delivery = groups.Delivery(group, compression.Fanout(data), sender)
+        if group.queued or len(group) > FANOUT_BATCH:
+            # Too many members for one turn: sent FANOUT_BATCH at a time by run_deliveries()
+            group.queued += 1
+            deliveries.append(delivery)
+        else:
+            deliver_batch(delivery, len(group))
+
+    def deliver_batch(delivery, count):
+        """Sends the delivery to up to 'count' more members. Returns how many were reached."""
+        ids = delivery.group.after(delivery.cursor, count)
+        by_id = registry.by_id
+        fanout = delivery.fanout
+        sender = delivery.sender
+        last = delivery.last
+        sent = 0
+        for session_id in ids:
+            if session_id > last:
+                break
+            session = by_id.get(session_id)
+            if session is not None and session is not sender:
+                send_to(session, fanout.frame_for(session.codec))
+            sent += 1
+        delivery.cursor = ids[sent - 1] if sent else last
+        return sent
+
+    def run_deliveries():
+        # Oldest first, so each group's messages arrive in order
+        budget = FANOUT_BATCH
+        while deliveries and budget > 0:
+            delivery = deliveries[0]
+            budget -= deliver_batch(delivery, budget)
+            if delivery.cursor >= delivery.last:
+                deliveries.popleft()
+                delivery.group.queued -= 1
+
+    def accept_scrapes():
+        # Metrics connections are non-blocking and go through the selector, so a slow or idle one never stalls the loop
+        while True:
+            try:
+                conn, _ = admin_socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                log.warning(f"Error accepting metrics connection: {e}")
+                return
+            conn.setblocking(False)
+            scrape = metrics.Scrape(conn)
+            sel.register(conn, selectors.EVENT_READ, scrape)
+            scrape.timer = timers.schedule(SCRAPE_TIMEOUT, close_scrape, scrape)
+
+    def on_scrape(scrape, mask):
+        # Any request gets the metrics back, written as fast as the socket takes it
+        sock = scrape.sock
+        try:
+            if scrape.reply is None:
+                if not sock.recv(4096):
+                    close_scrape(scrape)
+                    return
+                scrape.reply = memoryview(metrics.http_response(stats.render()))
+            sent = sock.send(scrape.reply)
+            scrape.reply = scrape.reply[sent:]
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError:
+            close_scrape(scrape)
+            return
+        if scrape.reply is not None and not scrape.reply:
+            close_scrape(scrape)
+        elif scrape.reply is not None and mask == selectors.EVENT_READ:
+            sel.modify(sock, selectors.EVENT_WRITE, scrape)
+
+    def close_scrape(scrape):
+        if scrape.sock is None:
+            return
+        sel.unregister(scrape.sock)
+        scrape.sock.close()
+        scrape.sock = None
+        timers.cancel(scrape.timer)
+
+    def broadcast_message(message, sender=None):
+        data = framing.encode_frame(framing.MESSAGE, message) # Encoded once, shared by every recipient
+        deliver_all(data, sender)
+        if bus is not None:
+            bus.send(shard.PUBLISH_ALL, data)
+
+    def group_message(group_name, message, sender=None):
+        data = framing.encode_frame(framing.MESSAGE, message)
+        deliver_group(group_name, data, sender)
+        if bus is not None:
+            bus.send(shard.PUBLISH_GROUP, group_name, data)
+
+    def negotiate_codec(s, caps, extra=""):
+        if caps:
+            # Clients that sent capabilities get told what was agreed; older clients get nothing new
+            codec = compression.negotiate(caps.get("compress", ()))
+            send_text(s, f"compress={codec.name if codec else 'none'}{extra}", framing.CAPABILITIES)
+            s.codec = codec
+
+    def finish_join(s, username, ok, caps):
+        if not ok or not registry.claim_name(s, username):
+            log.info(f"Rejected duplicate username '{username}' from {s.addr}")
+            send_text(s, f"Server: Username '{username}' is already taken.")
+            close_after_flush(s)
+            return
+        log.info(f"User '{username}' has joined from {s.addr}")
+        extra = ""
+        if MSG_RATE > 0:
+            # Lets a client pace what it queued while disconnected, instead of losing it to flood control
+            extra = f" rate={MSG_RATE:g} burst={MSG_BURST}"
+        if "resume" in caps:
+            # A client that can reconnect gets a token; coming back with it restores its groups in this same reply
+            token = caps["resume"][0] if caps["resume"] else None
+            record = resumable.pop(token, None) if token else None
+            if record is not None and record[0] == username:
+                for group_name in record[1]:
+                    join_group(s, group_name, GROUP_MAX_SIZE)
+                extra += " resumed=1"
+                log.info(f"Restored {len(s.groups)} group(s) for '{username}'")
+            s.resume_token = secrets.token_hex(16)
+            extra = f" resume={s.resume_token}" + extra
+        negotiate_codec(s, caps, extra)
+        away = recent.returned(username)
+        if away is not None:
+            # Back after leaving: what they missed comes first, one batch per channel
+            seq, group_names = away
+            for channel in ("*", "@" + username, *("#" + g for g in group_names)):
+                send_history(s, channel, seq, always=False)
+        broadcast_message(f"Server: {username} has joined")
 
-    print("Server started. Waiting for connections...")
+    def send_history(s, channel, since, always=True):
+        # From the in-memory ring when it reaches back far enough, else from the message log on a worker
+        if message_log is None or recent.covers(channel, since):
+            batch = recent.batch(channel, since, always)
+            if batch is not None:
+                send_text(s, batch, framing.HISTORY_BATCH)
+            return
 
-    while True:
+        def on_read(result, error):
+            if error:
+                log.warning(f"Unable to read the message log: {error}")
+                frames, last, more = [], since, False
+            else:
+                frames, last, more = result
+            if not more:
+                # The newest messages may not be committed yet; those come from the ring
+                frames += recent.since(channel, last)
+                last = recent.seq
+            if frames or always:
+                send_text(s, recent.batch_from(channel, frames, last, False), framing.HISTORY_BATCH)
+        submit_file_job(s, message_log.read, (channel, since, MAX_HISTORY_BATCH), on_read)
+
+    def allowed(s, opcode, payload):
+        # Flood control: True if the session has a token for this command
+        now = time.monotonic()
+        if s.bucket.take(now):
+            return True
+        if flood_policy == "disconnect":
+            stats.throttled["disconnect"] += 1
+            log.warning(f"Disconnecting {s} for flooding")
+            send_text(s, "Server: Disconnected for sending too fast.")
+            close_after_flush(s)
+        elif flood_policy == "delay":
+            # Nothing more is read from the session's buffer until the command's token is due
+            stats.throttled["delay"] += 1
+            s.held = (opcode, payload)
+            timers.schedule(s.bucket.wait(), resume_held, s)
+        else:
+            stats.throttled["drop"] += 1
+            if s.bucket.should_notice(now):
+                send_text(s, "Server: You are sending too fast; messages are being dropped.")
+        return False
+
+    def resume_held(s):
+        if s.sock is None or s.held is None:
+            return
+        if not s.bucket.take(time.monotonic()):
+            timers.schedule(s.bucket.wait(), resume_held, s)
+            return
+        opcode, payload = s.held
+        s.held = None
+        handle_frame(s, opcode, payload)
+        if s.sock is not None and not s.closing and not s.joining:
+            process_frames(s)
+
+    def check_alive(s):
+        # The session's one timer: set at accept, then re-armed from the last time the client was heard from
+        if s.sock is None:
+            return
+        now = time.monotonic()
+        if s.username is None and s.joining is None:
+            stats.reaped["join"] += 1
+            log.info(f"Closing {s}: no JOIN within {JOIN_TIMEOUT:g} seconds")
+            drop_client(s)
+            return
+        if PING_INTERVAL <= 0:
+            s.timer = None
+            return
+        if s.pinged is not None and s.last_seen < s.pinged:
+            if now - s.pinged >= PING_TIMEOUT:
+                # Half-open or hung: the normal leave path frees its name, groups and queued frames
+                stats.reaped["heartbeat"] += 1
+                log.info(f"Closing {s}: no answer to heartbeat for {now - s.pinged:.0f} seconds")
+                drop_client(s)
+                return
+            s.timer = timers.schedule(s.pinged + PING_TIMEOUT - now, check_alive, s)
+            return
+        idle = now - s.last_seen
+        if idle >= PING_INTERVAL:
+            s.pinged = now
+            send_text(s, b"", framing.PING)
+            s.timer = timers.schedule(PING_TIMEOUT, check_alive, s)
+        else:
+            s.timer = timers.schedule(PING_INTERVAL - idle, check_alive, s)
+
+    def process_frames(s):
         try:
-            readable, _, exceptional = select.select(inputs, [], inputs)
+            for opcode, payload in s.reader.frames():
+                opcode, payload = compression.decode(opcode, payload, s.codec)
+                if s.bucket is not None and s.username is not None and opcode not in UNTHROTTLED \
+                        and not allowed(s, opcode, payload):
+                    if s.sock is None or s.closing or s.held is not None:
+                        break
+                    continue
+                handle_frame(s, opcode, payload)
+                # Frames after a JOIN wait in the reader until the bus answers the claim
+                if s.sock is None or s.closing or s.joining:
+                    break
+        except framing.FrameError as e:
+            log.warning(f"Protocol error from {s}: {e}")
+            drop_client(s)
+
+    def on_session_event(s, mask, now):
+        if mask & selectors.EVENT_WRITE:
+            on_writable(s)
+            if s.sock is None:
+                return
+
+        if not mask & selectors.EVENT_READ or s.closing:
+            return
+
+        # Data from an existing client
+        try:
+            data = s.sock.recv(RECV_SIZE)
+        except BlockingIOError:
+            return
+        except OSError:
+            log.info(f"Client disconnected abruptly: {s}")
+            drop_client(s)
+            return
+
+        if not data:
+            # Empty data means disconnect
+            log.info(f"Client disconnected: {s}")
+            drop_client(s)
+            return
+
+        stats.bytes_in += len(data)
+        s.last_seen = now
+        s.reader.feed(data)
+        if s.held is not None:
+            if s.reader.pending() > MAX_HELD_BYTES:
+                log.warning(f"Dropping {s}: kept sending while held back for flooding")
+                drop_client(s)
+        elif not s.joining:
+            process_frames(s)
+
+    def session_failed(s, doing):
+        # A bug hit by one client's traffic costs that client its connection, not everyone theirs
+        log.exception(f"Error {doing} for {s}; dropping the connection")
+        if s.sock is not None:
+            drop_client(s)
+
+    def handle_bus_message(opcode, fields):
+        if opcode == shard.CLAIM_RESULT:
+            username = fields[0].decode()
+            s, caps = pending_joins.pop(username, (None, None))
+            if s is None:
+                return
+            ok = fields[1] == b"1"
+            s.joining = None
+            if s.sock is None:
+                # Left before the answer came back
+                if ok:
+                    bus.send(shard.RELEASE, username)
+                return
+            finish_join(s, username, ok, caps)
+            if s.sock is not None and not s.closing:
+                process_frames(s)
+        elif opcode == shard.DELIVER_ALL:
+            deliver_all(fields[0])
+        elif opcode == shard.DELIVER_GROUP:
+            deliver_group(fields[0].decode(), fields[1])
+        elif opcode == shard.DELIVER_USER:
+            target_user = fields[0].decode()
+            target = registry.find(target_user)
+            if target:
+                recent.record("@" + target_user, fields[1])
+                send_to(target, compression.compress_frame(fields[1], target.codec))
+        elif opcode == shard.NOT_FOUND:
+            sender = registry.find(fields[0].decode())
+            if sender:
+                send_text(sender, f"Server: User '{fields[1].decode()}' not found.")
+
+    def start_download(s, owner=None):
+        # Counts a download against the SERVER_USER_DOWNLOADS of 'owner' (default s); False if it is at the limit
+        owner = owner or s
+        if owner.downloads >= USER_DOWNLOADS:
+            stats.throttled["downloads"] += 1
+            send_text(s, f"Server: At most {USER_DOWNLOADS} downloads at once; try again when one finishes.")
+            return False
+        owner.downloads += 1
+        return True
+
+    def handle_join(s, command):
+        username, caps = command.username, command.caps
+        old = registry.find(username) if caps.get("resume") else None
+        if old is not None and old.resume_token == caps["resume"][0]:
+            # The same client back before its old connection was found dead: the new one takes over
+            log.info(f"'{username}' reconnected from {s.addr}; closing the old connection")
+            drop_client(old, announce=False)
+        if not username:
+            send_text(s, "Server: Invalid username.")
+            close_after_flush(s)
+        elif "stream" in caps:
+            # A parallel download's extra connection: it takes no name, so it is never announced or messaged.
+            # It must belong to a joined user and counts as one of their downloads until it closes
+            owner = registry.find(username)
+            if owner is None and bus is None:
+                send_text(s, "Server: Download streams must belong to a user who has joined.")
+                close_after_flush(s)
+                return
+            if owner is not None:
+                if not start_download(s, owner):
+                    close_after_flush(s)
+                    return
+                s.owner = owner
+            s.username = username
+            s.stream = True
+            negotiate_codec(s, caps)
+            log.debug("Download stream for %s from %s", username, s.addr)
+        elif bus is not None and registry.find(username) is None and username not in pending_joins:
+            # Usernames are unique across all workers; the bus holds the directory
+            s.joining = username
+            pending_joins[username] = (s, caps)
+            bus.send(shard.CLAIM, username)
+        else:
+            finish_join(s, username, bus is None, caps)
+
+    def handle_broadcast(s, command):
+        log.debug("[Broadcast] %s: %s", s.username, command.text)
+        broadcast_message(f"[Broadcast] {s.username}: {command.text}", sender=s)
+
+    def handle_unicast(s, command):
+        username, target_user, content = s.username, command.target, command.text
+        target = registry.find(target_user)
+        data = framing.encode_frame(framing.MESSAGE, f"[PM from {username}]: {content}")
+        if target:
+            recent.record("@" + target_user, data)
+            send_to(target, compression.compress_frame(data, target.codec))
+            log.debug("[Unicast] %s -> %s: %s", username, target_user, content)
+        elif bus is not None:
+            # Possibly on another worker; the bus answers NOT_FOUND if not
+            bus.send(shard.PUBLISH_USER, username, target_user, data)
+            log.debug("[Unicast] %s -> %s: %s", username, target_user, content)
+        elif recent.is_away(target_user):
+            # Kept in their mailbox and handed over when they JOIN again
+            recent.record("@" + target_user, data)
+            send_text(s, f"Server: User '{target_user}' is offline; they will get your message when they return.")
+        else:
+            send_text(s, f"Server: User '{target_user}' not found.")
+
+    def handle_group_msg(s, command):
+        group_name, content = command.target, command.text
+        if group_name not in s.groups:
+            send_text(s, f"Server: You are not a member of group mode: group '{group_name}'.")
+            return
+        bucket = group_buckets.get(group_name)
+        if bucket is None and GROUP_RATE > 0:
+            bucket = group_buckets[group_name] = ratelimit.TokenBucket(GROUP_RATE, GROUP_BURST)
+        if bucket is not None and not bucket.take(time.monotonic()):
+            # One busy group is held to its own rate, whoever is sending
+            stats.throttled["group"] += 1
+            send_text(s, f"Server: Group '{group_name}' is too busy; your message was dropped.")
+            return
+        group_message(group_name, f"[Group {group_name}] {s.username}: {content}", sender=s)
+        log.debug("[Group %s] %s: %s", group_name, s.username, content)
+
+    def join_group(s, group_name, max_size):
+        if not registry.join_group(s, group_name, max_size):
+            return False
+        if bus is not None and len(registry.members(group_name)) == 1:
+            bus.send(shard.GROUP_ADD, group_name)
+        return True
 
-            for s in readable:
-                if s is server_socket:
-                    # New connection
-                    client_sock, client_addr = server_socket.accept()
-                    print(f"Client connected from {client_addr[0]}:{client_addr[1]}")
-                    inputs.append(client_sock)
+    def handle_join_group(s, command):
+        # The first member may set the group's size limit; GROUP_MAX_SIZE caps it
+        group_name = command.name
+        if group_name in s.groups:
+            send_text(s, f"Server: You are already in group '{group_name}'.")
+            return
+        if not join_group(s, group_name, min(command.max_size or GROUP_MAX_SIZE, GROUP_MAX_SIZE)):
+            send_text(s, f"Server: Group '{group_name}' is full ({registry.members(group_name).max_size} members).{local_note}")
+            return
+        send_text(s, f"Server: You joined group '{group_name}'.")
+        log.debug("%s joined group %s", s.username, group_name)
 
-                    # Send welcome message
-                    welcome_msg = "Welcome to the instant messenger!"
-                    client_sock.send(welcome_msg.encode())
+    # The bus only knows which workers have a group, not who is in it, so with SERVER_WORKERS
+    # listings and the size limit cover this worker's members; the replies say so
+    local_note = "\n(members on this server process only)" if bus is not None else ""
 
+    def handle_list_groups(s, command):
+        limit = groups.PAGE if command.limit is None else min(command.limit, groups.PAGE)
+        send_to(s, groups.groups_list(registry.groups, command.offset, limit, command.prefix, local_note))
+
+    def handle_group_members(s, command):
+        group = registry.members(command.name)
+        if not group:
+            send_text(s, f"Server: Group '{command.name}' does not exist.")
+            return
+        limit = groups.PAGE if command.limit is None else min(command.limit, groups.PAGE)
+        send_to(s, groups.members_list(group, registry.by_id, command.offset, limit, local_note))
+
+    def handle_leave_group(s, command):
+        group_name = command.name
+        if registry.leave_group(s, group_name):
+            if not registry.members(group_name):
+                group_buckets.pop(group_name, None)
+                if bus is not None:
+                    bus.send(shard.GROUP_DROP, group_name)
+            send_text(s, f"Server: You left group '{group_name}'.")
+        else:
+            send_text(s, f"Server: You are not in group '{group_name}'.")
+
+    def handle_history(s, command):
+        # '@' is the sender's own private messages
+        channel = command.channel
+        if channel == "@":
+            channel += s.username
+        elif channel.startswith("#"):
+            if channel[1:] not in s.groups:
+                send_text(s, f"Server: You are not in group '{channel[1:]}'.")
+                return
+        elif channel != "*":
+            send_text(s, "Server: History channel must be *, #<group> or @.")
+            return
+        send_history(s, channel, command.since)
+
+    def handle_list_files(s, command):
+        offset, prefix = command.offset, command.prefix
+        limit = LIST_PAGE if command.limit is None else min(command.limit, LIST_PAGE)
+        with_catalog(s, lambda: send_to(s, catalog.listing(offset, limit, prefix)))
+
+    def handle_download_tcp(s, command):
+        # Also RESUME_TCP, which carries the offset to start from
+        filename, offset = command.filename, command.offset
+        if not start_download(s):
+            return
+
+        def on_opened(opened, error):
+            if error or opened is None:
+                s.downloads -= 1
+                send_text(s, f"Server: File '{filename}' not found.")
+                return
+            file_size = opened.size
+            start = offset if 0 <= offset <= file_size else 0
+            header = compression.encode_frame(framing.FILE_START_TCP, f"{file_size} {start} {filename}".encode(), s.codec)
+            # The body follows as FILE_DATA frames, streamed with sendfile as the socket drains
+            transfer = FileTransfer(opened, filename, start, file_size, s.codec, header)
+            transfer.counted = True
+            start_transfer(s, transfer)
+            log.info(f"Sending {filename} via TCP to {s.username} from byte {start}")
+
+        def on_found():
+            # Only names in the catalog can be opened, so paths like ../x never reach the disk
+            if catalog.find(filename) is None:
+                s.downloads -= 1
+                send_text(s, f"Server: File '{filename}' not found.")
+                return
+            if not submit_file_job(s, hot_files.open, (os.path.join(shared_files_dir, filename),), on_opened):
+                s.downloads -= 1
+        with_catalog(s, on_found)
+
+    def handle_manifest(s, command):
+        # Reply: FILE_MANIFEST <size> <chunk size> <file SHA-256> <filename>, then one SHA-256 per chunk
+        filename = command.name
+
+        def on_manifest(result, error):
+            if error or result is None:
+                send_text(s, f"Server: File '{filename}' not found.")
+                return
+            size, chunk_size, digest, digests = result
+            send_text(s, "\n".join([f"{size} {chunk_size} {digest} {filename}", *digests]), framing.FILE_MANIFEST)
+
+        def on_found():
+            if catalog.find(filename) is None:
+                send_text(s, f"Server: File '{filename}' not found.")
+                return
+            # Hashing reads the whole file, so it runs on a worker; the result is kept on the catalog entry
+            submit_file_job(s, catalog.manifest, (filename,), on_manifest)
+        with_catalog(s, on_found)
+
+    def handle_download_range(s, command):
+        filename, offset, length = command.filename, command.offset, command.length
+        # Ranges on a stream are covered by the stream's own count; anywhere else each one counts
+        counted = s.owner is None
+        if counted and not start_download(s):
+            return
+
+        def on_opened(opened, error):
+            if error or opened is None:
+                s.downloads -= counted
+                send_text(s, f"Server: File '{filename}' not found.")
+                return
+            if offset < 0 or length < 0 or offset + length > opened.size:
+                opened.close()
+                s.downloads -= counted
+                send_text(s, f"Server: Range {offset}+{length} is outside '{filename}'.")
+                return
+            header = compression.encode_frame(framing.FILE_RANGE, f"{offset} {length} {filename}".encode(), s.codec)
+            transfer = FileTransfer(opened, filename, offset, offset + length, s.codec, header)
+            transfer.counted = counted
+            start_transfer(s, transfer)
+
+        def on_found():
+            if catalog.find(filename) is None:
+                s.downloads -= counted
+                send_text(s, f"Server: File '{filename}' not found.")
+                return
+            if not submit_file_job(s, hot_files.open, (os.path.join(shared_files_dir, filename),), on_opened):
+                s.downloads -= counted
+        with_catalog(s, on_found)
+
+    def handle_download_udp(s, command):
+        filename, udp_port = command.filename, command.port
+        file_path = os.path.join(shared_files_dir, filename)
+        client_ip = s.addr[0]
+        if not start_download(s):
+            return
+
+        def on_opened(opened, error):
+            if error or opened is None:
+                s.downloads -= 1
+                send_text(s, f"Server: File '{filename}' not found.")
+                return
+            file_size = opened.size
+
+            def on_sent(ok, error):
+                s.downloads -= 1
+                if ok:
+                    stats.file_bytes["udp"] += file_size
+                    stats.transfers["udp"] += 1
+                    log.info(f"Finished UDP send of {filename}")
                 else:
-                    # Data from an existing client
-                    try:
-                        data = s.recv(BUFFER_SIZE)
-                        if data:
-                            msg = data.decode().strip()
-
-                            # Handle JOIN protocol
-                            if s not in clients:
-                                if msg.startswith("JOIN "):
-                                    username = msg.split(" ", 1)[1]
-                                    clients[s] = username
-                                    print(f"User '{username}' has joined from {s.getpeername()}")
-                                    broadcast_message(f"Server: {username} has joined")
-                                else:
-                                    print(f"Unexpected initial message from {s.getpeername()}: {msg}")
-                            else:
-                                username = clients[s]
-
-                                # PROTOCOL PARSING
-                                if msg.startswith("BROADCAST "):
-                                    content = msg.split(" ", 1)[1]
-                                    print(f"[Broadcast] {username}: {content}")
-                                    broadcast_message(f"[Broadcast] {username}: {content}", sender_socket=s)
-
-                                elif msg.startswith("UNICAST "):
-                                    try:
-                                        _, target_user, content = msg.split(" ", 2)
-                                        target_sock = None
-                                        for sock, name in clients.items():
-                                            if name == target_user:
-                                                target_sock = sock
-                                                break
-
-                                        if target_sock:
-                                            target_sock.send(f"[PM from {username}]: {content}".encode())
-                                            print(f"[Unicast] {username} -> {target_user}: {content}")
-                                        else:
-                                            s.send(f"Server: User '{target_user}' not found.".encode())
-                                    except ValueError:
-                                        s.send("Server: Invalid UNICAST format.".encode())
-
-                                elif msg.startswith("GROUP_MSG "):
-                                    try:
-                                        _, group_name, content = msg.split(" ", 2)
-                                        if group_name in groups and s in groups[group_name]:
-                                            group_message(group_name, f"[Group {group_name}] {username}: {content}", sender_socket=s)
-                                            print(f"[Group {group_name}] {username}: {content}")
-                                        else:
-                                            s.send(f"Server: You are not a member of group mode: group '{group_name}'.".encode())
-                                    except ValueError:
-                                        s.send("Server: Invalid GROUP_MSG format.".encode())
-
-                                elif msg.startswith("JOIN_GROUP "):
-                                    group_name = msg.split(" ", 1)[1]
-                                    if group_name not in groups:
-                                        groups[group_name] = set()
-                                    groups[group_name].add(s)
-                                    s.send(f"Server: You joined group '{group_name}'.".encode())
-                                    print(f"{username} joined group {group_name}")
-
-                                elif msg.startswith("LEAVE_GROUP "):
-                                    group_name = msg.split(" ", 1)[1]
-                                    if group_name in groups and s in groups[group_name]:
-                                        groups[group_name].remove(s)
-                                        s.send(f"Server: You left group '{group_name}'.".encode())
-                                        if not groups[group_name]:
-                                            del groups[group_name]
-                                    else:
-                                        s.send(f"Server: You are not in group '{group_name}'.".encode())
-
-                                elif msg == "LIST_FILES":
-                                    files = os.listdir(shared_files_dir)
-                                    file_list = "\n".join(files) if files else "No files available."
-                                    s.send(f"FILES_LIST {len(files)} files available:\n{file_list}".encode())
-
-                                elif msg.startswith("DOWNLOAD_TCP "):
-                                    filename = msg.split(" ", 1)[1]
-                                    file_path = os.path.join(shared_files_dir, filename)
-                                    if os.path.exists(file_path) and os.path.isfile(file_path):
-                                        file_size = os.path.getsize(file_path)
-                                        s.send(f"FILE_START_TCP {filename} {file_size}".encode())
-                                        # Wait a tiny bit for client to switch mode? No, TCP stream.
-                                        # Send file data
-                                        time.sleep(0.1) # Brief pause to ensure header is processed separate from body if possible
-                                        with open(file_path, "rb") as f:
-                                            while True:
-                                                bytes_read = f.read(BUFFER_SIZE)
-                                                if not bytes_read:
-                                                    break
-                                                s.send(bytes_read)
-                                        print(f"Sent {filename} via TCP to {username}")
-                                    else:
-                                        s.send(f"Server: File '{filename}' not found.".encode())
-
-                                elif msg.startswith("DOWNLOAD_UDP "):
-                                    # Format: DOWNLOAD_UDP <filename> <port>
-                                    try:
-                                        _, filename, udp_port_str = msg.split(" ", 2)
-                                        udp_port = int(udp_port_str)
-                                        file_path = os.path.join(shared_files_dir, filename)
-                                        if os.path.exists(file_path) and os.path.isfile(file_path):
-                                            file_size = os.path.getsize(file_path)
-                                            # Send confirmation via TCP
-                                            s.send(f"FILE_START_UDP {filename} {file_size}".encode())
-
-                                            # Send via UDP
-                                            udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                                            client_ip = s.getpeername()[0]
-                                            print(f"Sending {filename} via UDP to {client_ip}:{udp_port}")
-
-                                            with open(file_path, "rb") as f:
-                                                while True:
-                                                    chunk = f.read(1024) # Smaller chunk for UDP safety
-                                                    if not chunk:
-                                                        break
-                                                    udp_sock.sendto(chunk, (client_ip, udp_port))
-                                                    time.sleep(0.001) # Tiny sleep to prevent packet loss flooding
-
-                                            udp_sock.close()
-                                            print(f"Finished UDP send of {filename}")
-                                        else:
-                                            s.send(f"Server: File '{filename}' not found.".encode())
-                                    except ValueError:
-                                        s.send("Server: Invalid DOWNLOAD_UDP format.".encode())
-
-                                elif msg == "/exit":
-                                    print(f"User '{username}' initiated exit.")
-                                    inputs.remove(s)
-                                    del clients[s]
-                                    for g in groups.values():
-                                        if s in g:
-                                            g.remove(s)
-                                    s.close()
-                                    broadcast_message(f"Server: {username} has left")
-
-                                else:
-                                    print(f"Unknown command from {username}: {msg}")
-                                    s.send("Server: Unknown command or protocol error.".encode())
-
-                        else:
-                            # Empty data means disconnect
-                            if s in clients:
-                                username = clients[s]
-                                print(f"Client disconnected: {username}")
-                                broadcast_message(f"Server: {username} has left")
-                                del clients[s]
-                                for g in groups.values():
-                                    if s in g:
-                                        g.remove(s)
-                            else:
-                                print(f"Client disconnected: {s.getpeername()}")
-
-                            inputs.remove(s)
-                            s.close()
-                    except ConnectionResetError:
-                        if s in clients:
-                            username = clients[s]
-                            print(f"Client disconnected abruptly: {username}")
-                            broadcast_message(f"Server: {username} has left")
-                            del clients[s]
-                            for g in groups.values():
-                                if s in g:
-                                    g.remove(s)
-                        else:
-                            print("Client disconnected abruptly.")
-                        inputs.remove(s)
-                        s.close()
-
-            for s in exceptional:
-                print(f"Socket exception: {s.getpeername()}")
-                inputs.remove(s)
-                if s in clients:
-                    del clients[s]
-                for g in groups.values():
-                    if s in g:
-                        g.remove(s)
-                s.close()
+                    log.warning(f"UDP send of {filename} abandoned: {error or f'no acknowledgements from {s.username}'}")
+                    send_text(s, f"Server: UDP transfer of '{filename}' failed.")
+
+            transfer_id = udp_transfer.new_transfer_id()
+            chunk_size = udp_transfer.chunk_size_for(client_ip)
+
+            def on_started():
+                # Only once a thread has the job, so time waiting for one never eats into the client's receive timeout.
+                # Confirmation via TCP: <size> <transfer id> <chunk size> <filename>
+                send_text(s, f"{file_size} {transfer_id} {chunk_size} {filename}", framing.FILE_START_UDP)
+                log.info(f"Sending {filename} via UDP to {client_ip}:{udp_port}")
+
+            # Send via UDP, on a worker thread of its own pool
+            args = (opened, filename, (client_ip, udp_port), transfer_id, chunk_size, s.codec)
+            if not submit_file_job(s, send_open_file_udp, args, on_sent, udp_pool, on_started, opened.close):
+                s.downloads -= 1
+                opened.close()
+
+        def on_found():
+            if catalog.find(filename) is None:
+                s.downloads -= 1
+                send_text(s, f"Server: File '{filename}' not found.")
+                return
+            if not submit_file_job(s, hot_files.open, (file_path,), on_opened):
+                s.downloads -= 1
+        with_catalog(s, on_found)
+
+    def handle_pong(s, command):
+        pass # Hearing from the client at all is what counts; see check_alive()
+
+    def handle_exit(s, command):
+        log.info(f"User '{s.username}' initiated exit.")
+        drop_client(s)
+
+    # One handler per opcode; commands.PARSERS turns the payload into its argument
+    handlers = {
+        framing.BROADCAST: handle_broadcast,
+        framing.UNICAST: handle_unicast,
+        framing.GROUP_MSG: handle_group_msg,
+        framing.JOIN_GROUP: handle_join_group,
+        framing.LEAVE_GROUP: handle_leave_group,
+        framing.LIST_GROUPS: handle_list_groups,
+        framing.GROUP_MEMBERS: handle_group_members,
+        framing.HISTORY: handle_history,
+        framing.LIST_FILES: handle_list_files,
+        framing.DOWNLOAD_TCP: handle_download_tcp,
+        framing.RESUME_TCP: handle_download_tcp,
+        framing.MANIFEST: handle_manifest,
+        framing.DOWNLOAD_RANGE: handle_download_range,
+        framing.DOWNLOAD_UDP: handle_download_udp,
+        framing.EXIT: handle_exit,
+        framing.PONG: handle_pong,
+    }
+
+    def handle_frame(s, opcode, payload):
+        stats.commands[opcode] += 1
+        if s.username is None:
+            # Nothing but JOIN until the session has a name
+            if opcode == framing.JOIN:
+                try:
+                    handle_join(s, commands.parse_join(payload))
+                except Exception:
+                    session_failed(s, "handling JOIN")
+            else:
+                log.warning(f"Unexpected initial message from {s.addr}: {framing.OPCODE_NAMES.get(opcode, opcode)}")
+            return
+        handler = handlers.get(opcode)
+        if handler is None:
+            log.warning(f"Unknown command from {s.username}: {framing.OPCODE_NAMES.get(opcode, opcode)}")
+            send_text(s, "Server: Unknown command or protocol error.")
+            return
+        if s.stream and opcode not in STREAM_COMMANDS:
+            send_text(s, "Server: Download streams only take MANIFEST and DOWNLOAD_RANGE.")
+            return
+        try:
+            command = commands.parse(opcode, payload)
+        except commands.CommandError as e:
+            send_text(s, f"Server: {e}")
+            return
+        started = time.perf_counter()
+        try:
+            handler(s, command)
+        except Exception:
+            session_failed(s, f"handling {framing.OPCODE_NAMES.get(opcode, opcode)}")
+            return
+        stats.command_seconds[opcode] += time.perf_counter() - started
+
+    shared_files_dir = setup_shared_files()
+    catalog = Catalog(shared_files_dir, CATALOG_POLL)
+    hot_files = hotcache.HotFileCache(HOT_CACHE_BYTES)
+    catalog.apply(catalog.scan())
+
+    log.info("Server started. Waiting for connections...")
+
+    bus_lost = False
+    while not bus_lost:
+        try:
+            events = sel.select(0 if deliveries else timers.timeout(time.monotonic()))
+            turn_start = time.perf_counter()
+            now = time.monotonic()
+
+            for key, mask in events:
+                s = key.data
+                if key.fileobj is pool or key.fileobj is udp_pool:
+                    key.fileobj.run_callbacks()
+                    continue
+
+                if key.fileobj is bus:
+                    if mask & selectors.EVENT_WRITE:
+                        flush_bus()
+                    if mask & selectors.EVENT_READ:
+                        messages = bus.read()
+                        if messages is None:
+                            log.warning("Lost the message bus, stopping.")
+                            bus_lost = True
+                            break
+                        for opcode, fields in messages:
+                            handle_bus_message(opcode, fields)
+                    continue
+
+                if key.fileobj is admin_socket:
+                    accept_scrapes()
+                    continue
+
+                if isinstance(s, metrics.Scrape):
+                    on_scrape(s, mask)
+                    continue
+
+                if key.fileobj is server_socket:
+                    # New connections; accept everything pending in one go
+                    while True:
+                        try:
+                            client_sock, client_addr = server_socket.accept()
+                        except (BlockingIOError, InterruptedError):
+                            break
+                        except OSError as e:
+                            log.warning(f"Error accepting connection: {e}")
+                            break
+                        log.info(f"Client connected from {client_addr[0]}:{client_addr[1]}")
+                        stats.connections += 1
+                        client_sock.setblocking(False)
+                        session = registry.add(client_sock, client_addr)
+                        if MSG_RATE > 0:
+                            session.bucket = ratelimit.TokenBucket(MSG_RATE, MSG_BURST)
+                        session.last_seen = now
+                        session.timer = timers.schedule(JOIN_TIMEOUT, check_alive, session)
+                        sel.register(client_sock, selectors.EVENT_READ, session)
+
+                        # Send welcome message
+                        welcome_msg = "Welcome to the instant messenger!"
+                        send_text(session, welcome_msg)
+                    continue
+
+                if s.sock is None:
+                    # Already dropped earlier in this batch
+                    continue
+                try:
+                    on_session_event(s, mask, now)
+                except Exception:
+                    session_failed(s, "serving the connection")
+
+            timers.advance(time.monotonic())
+            if deliveries:
+                run_deliveries()
+            flush_dirty()
+            if bus is not None and bus.outbox and not bus.want_write:
+                flush_bus()
+            stats.loop_iterations += 1
+            stats.loop_seconds.observe(time.perf_counter() - turn_start)
 
         except KeyboardInterrupt:
-            print("\nServer stopping...")
+            log.info("Server stopping...")
             break
-        except Exception as e:
-            print(f"Error in main loop: {e}")
+        except Exception:
+            log.exception("Error in main loop")
             break
 
+    pool.shutdown()
+    udp_pool.shutdown()
+    hot_files.clear()
+    if message_log is not None:
+        message_log.close()
+    sel.close()
     server_socket.close()
+    if admin_socket is not None:
+        admin_socket.close()
+
+def main():
+    if len(sys.argv) != 2:
+        print(f"Usage: python {sys.argv[0]} [port]")
+        sys.exit(1)
+
+    try:
+        port = int(sys.argv[1])
+    except ValueError:
+        print("Port must be an integer.")
+        sys.exit(1)
+
+    raise_fd_limit()
+    setup_logging()
+
+    if SERVER_WORKERS > 1:
+        import shard
+        shard.run_sharded(port, SERVER_WORKERS)
+        return
+
+    server_socket = create_listener(port)
+    log.info(f"Server listening on {HOST}:{port}")
+    serve(server_socket, metrics_port=METRICS_PORT, store_dir=STORE_DIR or None)
 
 if __name__ == "__main__":
     main()
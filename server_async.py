@@ -0,0 +1,326 @@
+import asyncio
+import os
+import sys
+
+import compression
+import framing
+import udp_transfer
+from catalog import Catalog
+from registry import Registry
+from server import CATALOG_POLL, GROUP_MAX_SIZE, HOST, SENDFILE_SLICE, STREAM_COMMANDS, log, setup_logging, setup_shared_files, send_file_udp
+
+# Per-client transport buffer limits. drain() pauses a client's own coroutine
+# above HIGH_WATER until the buffer falls to LOW_WATER. Fan-out never waits:
+# above DROP_WATER a recipient misses messages, above DISCONNECT_WATER it is cut off.
+HIGH_WATER = 256 * 1024
+LOW_WATER = 64 * 1024
+DROP_WATER = 4 * 1024 * 1024
+DISCONNECT_WATER = 16 * 1024 * 1024
+
+async def serve(port):
+    registry = Registry() # Sessions here hold the StreamWriter in place of a socket
+    dropped = {} # writer -> number of fan-out messages dropped for being too slow
+    held_frames = {} # writer -> [bytes, frames] waiting for a sendfile() slice to finish
+    shared_files_dir = setup_shared_files()
+    catalog = Catalog(shared_files_dir, CATALOG_POLL) # Only names in it are served, so paths like ../x never reach the disk
+    udp_sends = set() # UDP transfers running, each as its own task so the client's chat carries on
+    loop = asyncio.get_running_loop()
+
+    def deliver(writer, data):
+        transport = writer.transport
+        if transport.is_closing():
+            return
+        held = held_frames.get(writer)
+        queued = transport.get_write_buffer_size()
+        if held is not None:
+            queued += held[0]
+        if queued > DISCONNECT_WATER:
+            log.warning(f"Disconnecting stalled client {writer.get_extra_info('peername')}: {queued} bytes queued")
+            transport.abort()
+        elif queued > DROP_WATER:
+            dropped[writer] = dropped.get(writer, 0) + 1
+        elif held is not None:
+            # The transport refuses writes while sendfile() runs; send these after the slice
+            held[0] += len(data)
+            held[1].append(data)
+        else:
+            writer.write(data)
+
+    def send_text(writer, text, opcode=framing.MESSAGE):
+        deliver(writer, framing.encode_frame(opcode, text))
+
+    def broadcast_message(message, sender=None):
+        data = framing.encode_frame(framing.MESSAGE, message)
+        for session in list(registry.joined()):
+            if session is not sender:
+                deliver(session.sock, data)
+
+    def group_message(group_name, message, sender=None):
+        data = framing.encode_frame(framing.MESSAGE, message)
+        for session in registry.member_sessions(group_name):
+            if session is not sender:
+                deliver(session.sock, data)
+
+    async def send_file_tcp(writer, file_path, offset, size):
+        with open(file_path, "rb") as f:
+            while offset < size:
+                count = min(SENDFILE_SLICE, size - offset)
+                writer.write(framing.HEADER.pack(count, framing.FILE_DATA))
+                # Only this client's coroutine waits for its socket to drain
+                await writer.drain()
+                held_frames[writer] = [0, []]
+                try:
+                    await loop.sendfile(writer.transport, f, offset, count)
+                finally:
+                    held = held_frames.pop(writer)[1]
+                if held and not writer.transport.is_closing():
+                    writer.write(b"".join(held))
+                offset += count
+
+    async def refresh_catalog():
+        # Rescans the shared folder on a thread if the listing is older than CATALOG_POLL; one scan at a time
+        if not catalog.stale():
+            return
+        scanned = loop.create_future()
+        catalog.waiting.append(lambda: scanned.set_result(None))
+        if not catalog.refreshing:
+            catalog.refreshing = True
+            try:
+                result = await loop.run_in_executor(None, catalog.scan)
+            except OSError:
+                result = None
+            catalog.apply(result)
+        await scanned
+
+    async def handle_frame(session, opcode, payload):
+        writer = session.sock
+        # Handle JOIN protocol
+        if session.username is None:
+            if opcode == framing.JOIN:
+                # Compression is never agreed: this engine does not compress
+                username, _, caps = payload.decode(errors='ignore').strip().partition(" ")
+                if not username:
+                    send_text(writer, "Server: Invalid username.")
+                    return False
+                if "stream" in compression.parse_capabilities(caps):
+                    # A parallel download's extra connection; it takes no name and is never announced
+                    if registry.find(username) is None:
+                        send_text(writer, "Server: Download streams must belong to a user who has joined.")
+                        return False
+                    session.username = username
+                    session.stream = True
+                    send_text(writer, "compress=none", framing.CAPABILITIES)
+                    return True
+                if not registry.claim_name(session, username):
+                    log.info(f"Rejected duplicate username '{username}' from {session.addr}")
+                    send_text(writer, f"Server: Username '{username}' is already taken.")
+                    return False
+                log.info(f"User '{username}' has joined from {session.addr}")
+                broadcast_message(f"Server: {username} has joined")
+            else:
+                log.warning(f"Unexpected initial message from {session.addr}: {framing.OPCODE_NAMES.get(opcode, opcode)}")
+            return True
+
+        username = session.username
+        if session.stream and opcode not in STREAM_COMMANDS:
+            send_text(writer, "Server: Download streams only take MANIFEST and DOWNLOAD_RANGE.")
+            return True
+
+        if opcode == framing.BROADCAST:
+            content = payload.decode(errors='ignore')
+            log.debug("[Broadcast] %s: %s", username, content)
+            broadcast_message(f"[Broadcast] {username}: {content}", sender=session)
+
+        elif opcode == framing.UNICAST:
+            try:
+                target_user, content = framing.split_args(payload, 2)
+            except ValueError:
+                send_text(writer, "Server: Invalid UNICAST format.")
+                return True
+            target = registry.find(target_user)
+            if target:
+                send_text(target.sock, f"[PM from {username}]: {content}")
+                log.debug("[Unicast] %s -> %s: %s", username, target_user, content)
+            else:
+                send_text(writer, f"Server: User '{target_user}' not found.")
+
+        elif opcode == framing.GROUP_MSG:
+            try:
+                group_name, content = framing.split_args(payload, 2)
+            except ValueError:
+                send_text(writer, "Server: Invalid GROUP_MSG format.")
+                return True
+            if group_name in session.groups:
+                group_message(group_name, f"[Group {group_name}] {username}: {content}", sender=session)
+                log.debug("[Group %s] %s: %s", group_name, username, content)
+            else:
+                send_text(writer, f"Server: You are not a member of group mode: group '{group_name}'.")
+
+        elif opcode == framing.JOIN_GROUP:
+            group_name = payload.decode(errors='ignore').strip()
+            if registry.join_group(session, group_name, GROUP_MAX_SIZE):
+                send_text(writer, f"Server: You joined group '{group_name}'.")
+                log.debug("%s joined group %s", username, group_name)
+            else:
+                send_text(writer, f"Server: Group '{group_name}' is full.")
+
+        elif opcode == framing.LEAVE_GROUP:
+            group_name = payload.decode(errors='ignore').strip()
+            if registry.leave_group(session, group_name):
+                send_text(writer, f"Server: You left group '{group_name}'.")
+            else:
+                send_text(writer, f"Server: You are not in group '{group_name}'.")
+
+        elif opcode == framing.LIST_FILES:
+            files = await loop.run_in_executor(None, os.listdir, shared_files_dir)
+            file_list = "\n".join(files) if files else "No files available."
+            send_text(writer, f"{len(files)} files available:\n{file_list}", framing.FILES_LIST)
+
+        elif opcode == framing.DOWNLOAD_TCP or opcode == framing.RESUME_TCP:
+            # RESUME_TCP payload: <offset> <filename>
+            offset = 0
+            filename = payload.decode(errors='ignore').strip()
+            if opcode == framing.RESUME_TCP:
+                try:
+                    offset_str, filename = filename.split(" ", 1)
+                    offset = int(offset_str)
+                except ValueError:
+                    send_text(writer, "Server: Invalid RESUME_TCP format.")
+                    return True
+            await refresh_catalog()
+            file_path = os.path.join(shared_files_dir, filename)
+            if catalog.find(filename) is not None and os.path.isfile(file_path):
+                file_size = os.path.getsize(file_path)
+                if offset < 0 or offset > file_size:
+                    offset = 0
+                send_text(writer, f"{file_size} {offset} {filename}", framing.FILE_START_TCP)
+                await send_file_tcp(writer, file_path, offset, file_size)
+                log.info(f"Sent {filename} via TCP to {username}")
+            else:
+                send_text(writer, f"Server: File '{filename}' not found.")
+
+        elif opcode == framing.MANIFEST:
+            # Reply: FILE_MANIFEST <size> <chunk size> <file SHA-256> <filename>, then one SHA-256 per chunk
+            filename = payload.decode(errors='ignore').strip()
+            await refresh_catalog()
+            manifest = None
+            if catalog.find(filename) is not None:
+                manifest = await loop.run_in_executor(None, catalog.manifest, filename)
+            if manifest is None:
+                send_text(writer, f"Server: File '{filename}' not found.")
+                return True
+            size, chunk_size, digest, digests = manifest
+            send_text(writer, "\n".join([f"{size} {chunk_size} {digest} {filename}", *digests]), framing.FILE_MANIFEST)
+
+        elif opcode == framing.DOWNLOAD_RANGE:
+            # Payload: <offset> <length> <filename>
+            try:
+                offset, length, filename = payload.decode(errors='ignore').strip().split(" ", 2)
+                offset, length = int(offset), int(length)
+            except ValueError:
+                send_text(writer, "Server: Invalid DOWNLOAD_RANGE format.")
+                return True
+            await refresh_catalog()
+            entry = catalog.find(filename)
+            if entry is None:
+                send_text(writer, f"Server: File '{filename}' not found.")
+            elif offset < 0 or length < 0 or offset + length > entry.size:
+                send_text(writer, f"Server: Range {offset}+{length} is outside '{filename}'.")
+            else:
+                send_text(writer, f"{offset} {length} {filename}", framing.FILE_RANGE)
+                await send_file_tcp(writer, os.path.join(shared_files_dir, filename), offset, offset + length)
+
+        elif opcode == framing.DOWNLOAD_UDP:
+            try:
+                filename, udp_port_str = payload.decode(errors='ignore').rsplit(" ", 1)
+                udp_port = int(udp_port_str)
+            except ValueError:
+                send_text(writer, "Server: Invalid DOWNLOAD_UDP format.")
+                return True
+            await refresh_catalog()
+            file_path = os.path.join(shared_files_dir, filename)
+            if catalog.find(filename) is not None and os.path.isfile(file_path):
+                file_size = os.path.getsize(file_path)
+                client_ip = writer.get_extra_info('peername')[0]
+                transfer_id = udp_transfer.new_transfer_id()
+                chunk_size = udp_transfer.chunk_size_for(client_ip)
+                send_text(writer, f"{file_size} {transfer_id} {chunk_size} {filename}", framing.FILE_START_UDP)
+                log.info(f"Sending {filename} via UDP to {client_ip}:{udp_port}")
+
+                async def send_udp():
+                    if await loop.run_in_executor(None, send_file_udp, file_path, (client_ip, udp_port), transfer_id, chunk_size):
+                        log.info(f"Finished UDP send of {filename}")
+                    else:
+                        log.warning(f"UDP send of {filename} abandoned: no acknowledgements from {username}")
+                task = loop.create_task(send_udp())
+                udp_sends.add(task)
+                task.add_done_callback(udp_sends.discard)
+            else:
+                send_text(writer, f"Server: File '{filename}' not found.")
+
+        elif opcode == framing.EXIT:
+            log.info(f"User '{username}' initiated exit.")
+            return False
+
+        else:
+            log.warning(f"Unknown command from {username}: {framing.OPCODE_NAMES.get(opcode, opcode)}")
+            send_text(writer, "Server: Unknown command or protocol error.")
+        return True
+
+    async def handle_client(reader, writer):
+        addr = writer.get_extra_info('peername')
+        log.info(f"Client connected from {addr[0]}:{addr[1]}")
+        writer.transport.set_write_buffer_limits(high=HIGH_WATER, low=LOW_WATER)
+        send_text(writer, "Welcome to the instant messenger!")
+        session = registry.add(writer, addr)
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                session.reader.feed(data)
+                keep_going = True
+                for opcode, payload in session.reader.frames():
+                    keep_going = await handle_frame(session, opcode, payload)
+                    if not keep_going:
+                        break
+                if not keep_going:
+                    break
+                await writer.drain()
+        except (ConnectionError, framing.FrameError) as e:
+            log.info(f"Client disconnected abruptly: {session} ({e})")
+        finally:
+            registry.remove(session)
+            missed = dropped.pop(writer, 0)
+            if missed:
+                log.warning(f"{session} missed {missed} messages while stalled")
+            writer.close()
+            if session.username is not None and not session.stream:
+                log.info(f"Client disconnected: {session.username}")
+                broadcast_message(f"Server: {session.username} has left")
+
+    server = await asyncio.start_server(handle_client, HOST, port, backlog=1024)
+    log.info(f"Server listening on {HOST}:{port} (asyncio)")
+    log.info("Server started. Waiting for connections...")
+    async with server:
+        await server.serve_forever()
+
+def main():
+    if len(sys.argv) != 2:
+        print(f"Usage: python {sys.argv[0]} [port]")
+        sys.exit(1)
+
+    try:
+        port = int(sys.argv[1])
+    except ValueError:
+        print("Port must be an integer.")
+        sys.exit(1)
+
+    setup_logging()
+    try:
+        asyncio.run(serve(port))
+    except KeyboardInterrupt:
+        log.info("Server stopping...")
+
+if __name__ == "__main__":
+    main()
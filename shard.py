@@ -0,0 +1,217 @@
+import logging
+import multiprocessing
+import os
+import selectors
+import signal
+import socket
+import struct
+from collections import deque
+from itertools import islice
+
+import framing
+
+log = logging.getLogger("server")
+
+# Multi-process mode: N worker processes each accept on their own SO_REUSEPORT
+# listener, so the kernel spreads connections across them. Workers talk to the
+# parent process over a Unix socketpair each; the parent is the message bus and
+# owns the cluster-wide directory (which worker holds each username, and which
+# workers have members in each group). Bus messages reuse the frame format from
+# framing.py with the opcodes below; payload fields are length-prefixed.
+
+# Worker -> Bus
+CLAIM = 100 # <username>: reserve a username cluster-wide
+RELEASE = 101 # <username>: the user has left
+GROUP_ADD = 102 # <group>: this worker now has members in the group
+GROUP_DROP = 103 # <group>: this worker no longer has members in the group
+PUBLISH_ALL = 104 # <frame>: deliver to every user on the other workers
+PUBLISH_GROUP = 105 # <group> <frame>: deliver to the group's members on the other workers
+PUBLISH_USER = 106 # <sender> <target> <frame>: deliver to one user wherever they are
+
+# Bus -> Worker
+CLAIM_RESULT = 110 # <username> <b"1" or b"0">
+DELIVER_ALL = 111 # <frame>
+DELIVER_GROUP = 112 # <group> <frame>
+DELIVER_USER = 113 # <target> <frame>
+NOT_FOUND = 114 # <sender> <target>: a PUBLISH_USER had nowhere to go
+
+FIELD = struct.Struct("!I")
+IOV_MAX = 64
+
+def encode_fields(*fields):
+    parts = []
+    for field in fields:
+        if isinstance(field, str):
+            field = field.encode()
+        parts.append(FIELD.pack(len(field)))
+        parts.append(field)
+    return b"".join(parts)
+
+def decode_fields(payload):
+    fields = []
+    pos = 0
+    while pos < len(payload):
+        (length,) = FIELD.unpack_from(payload, pos)
+        pos += FIELD.size
+        fields.append(payload[pos:pos + length])
+        pos += length
+    return fields
+
+class BusConnection:
+    """One end of a worker <-> bus socketpair, non-blocking in both directions."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.sock.setblocking(False)
+        self.reader = framing.FrameReader()
+        self.outbox = deque()
+        self.want_write = False # Registered for write readiness (worker side)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def send(self, opcode, *fields):
+        self.outbox.append(framing.encode_frame(opcode, encode_fields(*fields)))
+
+    def flush(self):
+        """Returns True once everything queued has been written."""
+        queue = self.outbox
+        while queue:
+            try:
+                sent = self.sock.sendmsg(islice(queue, IOV_MAX))
+            except BlockingIOError:
+                return False
+            while sent:
+                head = queue[0]
+                if sent < len(head):
+                    queue[0] = memoryview(head)[sent:]
+                    return False
+                sent -= len(head)
+                queue.popleft()
+        return True
+
+    def read(self):
+        """Returns the (opcode, fields) messages received, or None once the other side has gone."""
+        try:
+            data = self.sock.recv(1 << 20)
+        except BlockingIOError:
+            return []
+        except OSError:
+            return None
+        if not data:
+            return None
+        self.reader.feed(data)
+        return [(opcode, decode_fields(payload)) for opcode, payload in self.reader.frames()]
+
+def run_bus(connections):
+    """The parent's loop: routes messages between workers until they have all exited."""
+    sel = selectors.DefaultSelector()
+    for worker_id, conn in connections.items():
+        sel.register(conn, selectors.EVENT_READ, worker_id)
+    users = {} # username -> worker id
+    groups = {} # group_name -> set(worker ids)
+    writing = set()
+
+    def forget(worker_id):
+        for name in [n for n, w in users.items() if w == worker_id]:
+            del users[name]
+        for name in list(groups):
+            groups[name].discard(worker_id)
+            if not groups[name]:
+                del groups[name]
+
+    while connections:
+        for key, mask in sel.select():
+            worker_id = key.data
+            conn = connections.get(worker_id)
+            if conn is None:
+                continue
+            if mask & selectors.EVENT_WRITE and conn.flush():
+                writing.discard(worker_id)
+                sel.modify(conn, selectors.EVENT_READ, worker_id)
+            if not mask & selectors.EVENT_READ:
+                continue
+            messages = conn.read()
+            if messages is None:
+                log.warning(f"Bus: worker {worker_id} has gone")
+                sel.unregister(conn)
+                del connections[worker_id]
+                writing.discard(worker_id)
+                forget(worker_id)
+                continue
+            for opcode, fields in messages:
+                if opcode == CLAIM:
+                    name = fields[0].decode()
+                    ok = name not in users
+                    if ok:
+                        users[name] = worker_id
+                    conn.send(CLAIM_RESULT, fields[0], b"1" if ok else b"0")
+                elif opcode == RELEASE:
+                    name = fields[0].decode()
+                    if users.get(name) == worker_id:
+                        del users[name]
+                elif opcode == GROUP_ADD:
+                    groups.setdefault(fields[0].decode(), set()).add(worker_id)
+                elif opcode == GROUP_DROP:
+                    name = fields[0].decode()
+                    if name in groups:
+                        groups[name].discard(worker_id)
+                        if not groups[name]:
+                            del groups[name]
+                elif opcode == PUBLISH_ALL:
+                    for other_id, other in connections.items():
+                        if other_id != worker_id:
+                            other.send(DELIVER_ALL, fields[0])
+                elif opcode == PUBLISH_GROUP:
+                    for other_id in groups.get(fields[0].decode(), ()):
+                        if other_id != worker_id:
+                            connections[other_id].send(DELIVER_GROUP, fields[0], fields[1])
+                elif opcode == PUBLISH_USER:
+                    sender, target, frame = fields
+                    target_id = users.get(target.decode())
+                    if target_id is None:
+                        conn.send(NOT_FOUND, sender, target)
+                    else:
+                        connections[target_id].send(DELIVER_USER, target, frame)
+        # Write out everything routed this turn
+        for other_id, other in connections.items():
+            if other.outbox and other_id not in writing and not other.flush():
+                writing.add(other_id)
+                sel.modify(other, selectors.EVENT_READ | selectors.EVENT_WRITE, other_id)
+    sel.close()
+
+def run_worker(port, worker_id, bus_sock, parent_end):
+    import server
+    parent_end.close()
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # The parent handles Ctrl+C and stops the workers
+    server.setup_logging() # The log writer thread does not survive the fork
+    listener = server.create_listener(port, reuse_port=True)
+    log.info(f"Worker {worker_id} (pid {os.getpid()}) listening on {server.HOST}:{port}")
+    # Each worker has its own counters, so each gets its own metrics port
+    metrics_port = server.METRICS_PORT + worker_id if server.METRICS_PORT else 0
+    store_dir = os.path.join(server.STORE_DIR, f"worker-{worker_id}") if server.STORE_DIR else None
+    server.serve(listener, BusConnection(bus_sock), metrics_port, store_dir)
+
+def run_sharded(port, worker_count):
+    if not hasattr(socket, "SO_REUSEPORT"):
+        print("SERVER_WORKERS needs SO_REUSEPORT, which this platform does not support.")
+        return
+    context = multiprocessing.get_context("fork")
+    connections = {}
+    processes = []
+    for worker_id in range(worker_count):
+        parent_end, worker_end = socket.socketpair()
+        process = context.Process(target=run_worker, args=(port, worker_id, worker_end, parent_end), daemon=True)
+        process.start()
+        worker_end.close()
+        connections[worker_id] = BusConnection(parent_end)
+        processes.append(process)
+    log.info(f"Started {worker_count} workers sharing port {port}")
+    try:
+        run_bus(connections)
+    except KeyboardInterrupt:
+        log.info("Server stopping...")
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.join()
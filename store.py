@@ -0,0 +1,259 @@
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from array import array
+from collections import deque
+
+# Durable chat log, enabled with SERVER_STORE_DIR. Every message that goes
+# into history.History is also appended here, in segments named after the
+# first sequence number they hold:
+#   <first seq>.log  records: crc32, seq, channel length, frame length, channel, frame
+#   <first seq>.idx  written when the segment is sealed: (channel key, seq, offset)
+#                    entries sorted by channel key then seq, read through mmap
+# The loop thread only appends to a deque; a writer thread turns the backlog
+# into one write() and one fsync() per commit interval (group commit).
+# A crash loses at most that interval, and a torn last record is cut off on
+# the next start.
+
+RECORD = struct.Struct("!IQHI")
+ENTRY = struct.Struct("!QQQ")
+
+def channel_key(channel):
+    # Stable across restarts, unlike hash()
+    return int.from_bytes(hashlib.blake2b(channel.encode(), digest_size=8).digest(), "big")
+
+class Segment:
+    __slots__ = ("first", "path", "size", "sealed", "keys")
+
+    def __init__(self, directory, first):
+        self.first = first
+        self.path = os.path.join(directory, f"{first:020d}")
+        self.size = 0
+        self.sealed = False
+        self.keys = {} # Unsealed only: channel key -> (array of seqs, array of offsets)
+
+    def add(self, key, seq, offset):
+        entry = self.keys.get(key)
+        if entry is None:
+            entry = self.keys[key] = (array("Q"), array("Q"))
+        entry[0].append(seq)
+        entry[1].append(offset)
+
+    def offsets(self, key, since):
+        """Offsets of the records on channel 'key' numbered after 'since'."""
+        if not self.sealed:
+            seqs, offsets = self.keys.get(key, ((), ()))
+            return [o for s, o in zip(seqs, offsets) if s > since]
+        with open(self.path + ".idx", "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return []
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as index:
+                # Binary search for the first entry at or after (key, since + 1)
+                lo, hi = 0, len(index) // ENTRY.size
+                while lo < hi:
+                    mid = (lo + hi) // 2
+                    if ENTRY.unpack_from(index, mid * ENTRY.size)[:2] < (key, since + 1):
+                        lo = mid + 1
+                    else:
+                        hi = mid
+                found = []
+                for i in range(lo, len(index) // ENTRY.size):
+                    entry_key, _, offset = ENTRY.unpack_from(index, i * ENTRY.size)
+                    if entry_key != key:
+                        break
+                    found.append(offset)
+                return found
+
+    def write_index(self):
+        entries = sorted((key, seq, offset) for key, (seqs, offsets) in self.keys.items()
+                         for seq, offset in zip(seqs, offsets))
+        with open(self.path + ".idx.tmp", "wb") as f:
+            f.write(b"".join(ENTRY.pack(*entry) for entry in entries))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.path + ".idx.tmp", self.path + ".idx")
+
+    def last_seq(self):
+        # Only needed when a crash left no open segment behind
+        with open(self.path + ".idx", "rb") as f:
+            data = f.read()
+        return max((ENTRY.unpack_from(data, i)[1] for i in range(0, len(data), ENTRY.size)), default=self.first - 1)
+
+class MessageLog:
+    """
+    Segmented append-only log of chat messages with per-segment indexes.
+    append() runs on the loop thread and costs one deque append; read()
+    runs on worker threads. Sealed segments beyond 'retention_bytes' are
+    deleted oldest first.
+    """
+
+    def __init__(self, directory, segment_bytes, retention_bytes, commit_interval):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.retention_bytes = retention_bytes
+        self.commit_interval = commit_interval
+        self.pending = deque() # (seq, channel, frame) not yet written
+        self.lock = threading.Lock() # Guards the segment list and the open segment's index
+        self.segments = []
+        self.seq = 0 # Newest sequence number on disk
+        self.commits = 0
+        self.fsync_seconds = 0.0
+        os.makedirs(directory, exist_ok=True)
+        self.recover()
+        self.file = open(self.segments[-1].path + ".log", "ab")
+        self.stopping = threading.Event()
+        self.writer = threading.Thread(target=self.run, name="message-log", daemon=True)
+        self.writer.start()
+
+    def recover(self):
+        firsts = sorted(int(name[:-4]) for name in os.listdir(self.directory) if name.endswith(".log"))
+        for n, first in enumerate(firsts):
+            segment = Segment(self.directory, first)
+            segment.size = os.path.getsize(segment.path + ".log")
+            if os.path.exists(segment.path + ".idx"):
+                segment.sealed = True
+            else:
+                self.seq = max(self.seq, self.scan(segment), first - 1)
+                if n < len(firsts) - 1:
+                    # Cut off mid-roll
+                    segment.write_index()
+                    segment.sealed = True
+                    segment.keys = {}
+            self.segments.append(segment)
+        if not self.segments or self.segments[-1].sealed:
+            # The newest segment is always an open one
+            if self.segments:
+                self.seq = max(self.seq, self.segments[-1].last_seq())
+            self.segments.append(Segment(self.directory, self.seq + 1))
+            open(self.segments[-1].path + ".log", "ab").close()
+
+    def scan(self, segment):
+        """Rebuilds an unsealed segment's index, truncating a torn tail. Returns its newest seq."""
+        with open(segment.path + ".log", "rb") as f:
+            data = f.read()
+        pos = 0
+        seq = 0
+        while pos + RECORD.size <= len(data):
+            crc, seq_n, channel_len, frame_len = RECORD.unpack_from(data, pos)
+            end = pos + RECORD.size + channel_len + frame_len
+            if end > len(data) or zlib.crc32(data[pos + 4:end]) != crc:
+                break
+            channel = data[pos + RECORD.size:pos + RECORD.size + channel_len].decode()
+            segment.add(channel_key(channel), seq_n, pos)
+            seq = seq_n
+            pos = end
+        if pos < len(data):
+            with open(segment.path + ".log", "r+b") as f:
+                f.truncate(pos)
+        segment.size = pos
+        return seq
+
+    def append(self, channel, seq, frame):
+        self.pending.append((seq, channel, frame))
+
+    def run(self):
+        while not self.stopping.wait(self.commit_interval):
+            self.commit()
+        self.commit()
+
+    def commit(self):
+        if not self.pending:
+            return
+        batch = bytearray()
+        added = []
+        segment = self.segments[-1]
+        pos = segment.size
+        while self.pending:
+            seq, channel, frame = self.pending.popleft()
+            channel_bytes = channel.encode()
+            body = struct.pack("!QHI", seq, len(channel_bytes), len(frame)) + channel_bytes + bytes(frame)
+            batch += struct.pack("!I", zlib.crc32(body)) + body
+            added.append((channel_key(channel), seq, pos))
+            pos = segment.size + len(batch)
+        started = time.perf_counter()
+        self.file.write(batch)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.fsync_seconds += time.perf_counter() - started
+        self.commits += 1
+        with self.lock:
+            for key, seq, offset in added:
+                segment.add(key, seq, offset)
+            segment.size = pos
+            self.seq = added[-1][1]
+        if segment.size >= self.segment_bytes:
+            self.roll()
+
+    def roll(self):
+        # The new segment exists before the old one is sealed, so a crash in between loses nothing
+        segment = Segment(self.directory, self.seq + 1)
+        new_file = open(segment.path + ".log", "ab")
+        old = self.segments[-1]
+        self.file.close()
+        self.file = new_file
+        with self.lock:
+            self.segments.append(segment)
+        old.write_index()
+        with self.lock:
+            old.sealed = True
+            old.keys = {}
+        self.retire()
+
+    def retire(self):
+        # Retention: the oldest sealed segments go once they pass retention_bytes together
+        victims = []
+        with self.lock:
+            total = sum(s.size for s in self.segments if s.sealed)
+            while total > self.retention_bytes and self.segments[0].sealed:
+                victim = self.segments.pop(0)
+                total -= victim.size
+                victims.append(victim)
+        for victim in victims:
+            for suffix in (".log", ".idx"):
+                try:
+                    os.remove(victim.path + suffix)
+                except OSError:
+                    pass # Still open for a read on Windows; it stays until a later start
+
+    def read(self, channel, since, max_bytes):
+        """
+        Worker job: (frames, newest seq included, more) for 'channel' after
+        'since', oldest first. Stops once 'max_bytes' have been collected,
+        with 'more' set if that cut the answer short.
+        """
+        key = channel_key(channel)
+        with self.lock:
+            segments = list(self.segments)
+        frames = []
+        total = 0
+        last = since
+        for n, segment in enumerate(segments):
+            if n + 1 < len(segments) and segments[n + 1].first <= since + 1:
+                continue # Everything in it is at or before 'since'
+            if segment.sealed:
+                offsets = segment.offsets(key, since)
+            else:
+                with self.lock:
+                    offsets = segment.offsets(key, since)
+            if not offsets:
+                continue
+            with open(segment.path + ".log", "rb") as f:
+                for offset in offsets:
+                    f.seek(offset)
+                    _, seq, channel_len, frame_len = RECORD.unpack(f.read(RECORD.size))
+                    f.seek(channel_len, os.SEEK_CUR)
+                    frames.append(f.read(frame_len))
+                    total += frame_len
+                    last = seq
+                    if total >= max_bytes:
+                        return frames, last, True
+        return frames, last, False
+
+    def close(self):
+        self.stopping.set()
+        self.writer.join()
+        self.file.close()
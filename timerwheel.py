@@ -0,0 +1,123 @@
+import time
+
+# Hierarchical timing wheel for the server loop's timers (heartbeats, idle
+# connections, flood-control delays). Level 0 has one slot per tick; each
+# slot of level n covers a whole turn of level n - 1. A timer goes into the
+# lowest level whose current turn contains its deadline, and is moved down
+# ("cascaded") when that slot comes round, so scheduling, cancelling and
+# each tick cost O(1) however many timers there are. Deadlines past the top
+# level wait in an overflow list that is re-sorted once per full turn.
+
+TICK = 0.01 # Seconds per level 0 slot
+SIZES = (256, 64, 64) # Slots per level: 2.56 s, 164 s and 2.9 h per turn
+
+class Timer:
+    __slots__ = ("due", "fn", "args")
+
+    def __init__(self, due, fn, args):
+        self.due = due # Tick number
+        self.fn = fn # None once cancelled
+        self.args = args
+
+class TimerWheel:
+    def __init__(self, tick=TICK, sizes=SIZES):
+        self.tick = tick
+        self.sizes = sizes
+        self.spans = [] # Ticks covered by one slot of each level
+        span = 1
+        for size in sizes:
+            self.spans.append(span)
+            span *= size
+        self.spans.append(span) # The overflow list acts as one slot above the top level
+        self.levels = [[[] for _ in range(size)] for size in sizes]
+        self.overflow = []
+        self.counts = [0] * (len(sizes) + 1) # Timers held at each level, cancelled ones included
+        self.start = time.monotonic()
+        self.current = 0 # Ticks processed so far
+        self.active = 0 # Timers scheduled and not yet run or cancelled
+
+    def __len__(self):
+        return self.active
+
+    def schedule(self, delay, fn, *args):
+        """Runs fn(*args) after 'delay' seconds, rounded up to the tick. Returns the Timer, for cancel()."""
+        due = int((time.monotonic() - self.start + delay) / self.tick) + 1
+        timer = Timer(max(due, self.current + 1), fn, args)
+        self.place(timer)
+        self.active += 1
+        return timer
+
+    def cancel(self, timer):
+        if timer is not None and timer.fn is not None:
+            timer.fn = None
+            self.active -= 1
+
+    def place(self, timer):
+        due = timer.due
+        for level, size in enumerate(self.sizes):
+            # The lowest level whose current turn also holds the deadline
+            if due // self.spans[level + 1] == self.current // self.spans[level + 1]:
+                self.levels[level][due // self.spans[level] % size].append(timer)
+                self.counts[level] += 1
+                return
+        self.overflow.append(timer)
+        self.counts[-1] += 1
+
+    def cascade(self, level, timers):
+        self.counts[level] -= len(timers)
+        for timer in timers:
+            if timer.fn is not None:
+                self.place(timer)
+
+    def advance(self, now):
+        """Runs every timer that is due by 'now'."""
+        target = int((now - self.start) / self.tick)
+        while self.current < target:
+            if not self.counts[0]:
+                # Nothing on level 0, so skip straight to the next cascade that has work
+                ahead = self.next_cascade()
+                if ahead is None or ahead > target:
+                    self.current = target
+                    return
+                self.current = ahead - 1
+            self.current += 1
+            tick = self.current
+            if tick % self.spans[-1] == 0 and self.overflow:
+                timers, self.overflow = self.overflow, []
+                self.cascade(-1, timers)
+            for level in range(len(self.sizes) - 1, 0, -1):
+                if tick % self.spans[level] == 0:
+                    slots = self.levels[level]
+                    index = tick // self.spans[level] % self.sizes[level]
+                    timers, slots[index] = slots[index], []
+                    if timers:
+                        self.cascade(level, timers)
+            slots = self.levels[0]
+            index = tick % self.sizes[0]
+            timers, slots[index] = slots[index], []
+            self.counts[0] -= len(timers)
+            for timer in timers:
+                fn = timer.fn
+                if fn is not None:
+                    timer.fn = None
+                    self.active -= 1
+                    fn(*timer.args)
+
+    def next_cascade(self):
+        # Tick of the next slot boundary on a level above 0 that holds timers
+        ahead = None
+        for level in range(1, len(self.counts)):
+            if self.counts[level]:
+                boundary = (self.current // self.spans[level] + 1) * self.spans[level]
+                if ahead is None or boundary < ahead:
+                    ahead = boundary
+        return ahead
+
+    def timeout(self, now):
+        """Seconds the loop may wait in select() before advance() has work, or None if no timers are set."""
+        if not self.active:
+            return None
+        ahead = self.current + 1 if self.counts[0] else self.next_cascade()
+        if ahead is None:
+            return None
+        return max(0.0, self.start + ahead * self.tick - now)
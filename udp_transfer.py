@@ -0,0 +1,391 @@
+import random
+import select
+import socket
+import struct
+import time
+from collections import deque
+
+# Reliable file transfer over UDP.
+#
+# The file is cut into chunk_size packets numbered from 0. Each DATA datagram
+# carries its sequence number, so the receiver writes it straight to offset
+# seq * chunk_size whatever order it arrives in. The receiver answers with ACK
+# datagrams holding a cumulative ack (every packet below it has arrived) and a
+# selective-ack bitmap covering the MAX_WINDOW packets from there. Gaps in the
+# bitmap act as NACKs: the sender resends a packet once packets sent after it
+# have been acked, or when its retransmit timer runs out.
+#
+# The sender keeps a congestion window (slow start, then additive increase,
+# halved once per loss episode) and paces each window across one round trip
+# instead of sleeping a fixed time per packet.
+
+DATA = 1
+ACK = 2
+DATA_COMPRESSED = 3 # DATA whose chunk is compressed with the codec agreed at JOIN
+DATA_HEADER = struct.Struct("!BII") # kind, transfer id, sequence number
+ACK_HEADER = struct.Struct("!BII")  # kind, transfer id, cumulative ack, then the SACK bitmap
+
+CHUNK_SIZE = 1400 # Keeps DATA datagrams inside a typical 1500 byte MTU
+LOOPBACK_CHUNK_SIZE = 32768 # No MTU on loopback, and fewer datagrams means far less per-packet work
+MAX_WINDOW = 1024 # Packets in flight at most; the SACK bitmap covers exactly this many
+SACK_BYTES = MAX_WINDOW // 8
+INITIAL_WINDOW = 32
+BURST = 32 # Packets sent back to back before pacing kicks in
+REORDER_THRESHOLD = 3 # A packet is lost once this many later packets were acked
+ACK_EVERY = 8
+MIN_RTO = 0.02
+MAX_RTO = 2.0
+IDLE_TIMEOUT = 10.0
+LINGER = 0.5 # Receiver keeps re-acking this long after the last packet, in case its final ACK was lost
+SOCKET_BUFFER = 4 * 1024 * 1024
+COMPRESS_PROBE = 16 # Packets tried before compression is given up on for an incompressible file
+
+def packet_count(size, chunk_size=CHUNK_SIZE):
+    return (size + chunk_size - 1) // chunk_size
+
+def chunk_size_for(host):
+    if host.startswith("127.") or host == "::1":
+        return LOOPBACK_CHUNK_SIZE
+    return CHUNK_SIZE
+
+def new_transfer_id():
+    return random.getrandbits(32)
+
+def set_buffers(sock):
+    for option in (socket.SO_SNDBUF, socket.SO_RCVBUF):
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, option, SOCKET_BUFFER)
+        except OSError:
+            pass
+
+class UdpSender:
+    """
+    Sends one file to a UdpReceiver listening at 'addr'. With 'data' (a
+    memoryview of the whole file, e.g. a memory mapping) packets are copied
+    from it instead of being read from 'f'. With 'codec' (see compression.py)
+    each chunk is sent compressed when that makes it smaller.
+    """
+
+    def __init__(self, f, size, addr, transfer_id, chunk_size=CHUNK_SIZE, loss_rate=0.0, data=None, codec=None):
+        self.file = f
+        self.data = data
+        self.codec = codec
+        self.size = size
+        self.addr = addr
+        self.transfer_id = transfer_id
+        self.chunk_size = chunk_size
+        self.loss_rate = loss_rate # Fraction of DATA datagrams to drop on purpose, for testing
+        self.total = packet_count(size, chunk_size)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+        set_buffers(self.sock)
+
+        self.acked = bytearray(self.total)
+        self.cum = 0 # Every packet below this has been acked
+        self.sack = 0 # Bit i set: packet cum + i acked out of order
+        self.next_seq = 0
+        self.sent_at = {} # seq -> send time, for packets in flight, oldest first
+        self.retransmitted = set()
+        self.lost = deque()
+        self.newest_acked_send = 0.0
+        self.highest_acked = -1
+
+        self.cwnd = float(INITIAL_WINDOW)
+        self.ssthresh = float(MAX_WINDOW)
+        self.recovery_until = 0 # No further window cut until the cumulative ack passes this
+        self.srtt = None
+        self.rttvar = 0.0
+        self.rto = 0.2
+        self.next_send = 0.0
+
+        self.packet = bytearray(DATA_HEADER.size + chunk_size)
+        self.packets_sent = 0
+        self.retransmits = 0
+        self.compressed = 0 # Packets that went out compressed
+
+    def run(self):
+        last_progress = time.monotonic()
+        try:
+            while self.cum < self.total:
+                now = time.monotonic()
+                if now >= self.next_send:
+                    self.fill_window(now)
+                wait = self.rto
+                if self.sent_at:
+                    oldest = next(iter(self.sent_at.values()))
+                    wait = max(0.0, oldest + self.rto - now)
+                if self.can_send():
+                    wait = min(wait, max(0.0, self.next_send - now))
+                readable, _, _ = select.select([self.sock], [], [], wait)
+                if readable and self.read_acks():
+                    last_progress = time.monotonic()
+                self.check_timeouts(time.monotonic())
+                if time.monotonic() - last_progress > IDLE_TIMEOUT:
+                    return False
+            return True
+        finally:
+            self.sock.close()
+
+    def can_send(self):
+        if len(self.sent_at) >= min(int(self.cwnd), MAX_WINDOW):
+            return False
+        return bool(self.lost) or (self.next_seq < self.total and self.next_seq < self.cum + MAX_WINDOW)
+
+    def fill_window(self, now):
+        sent = 0
+        while sent < BURST and self.can_send():
+            if self.lost:
+                seq = self.lost.popleft()
+                if self.acked[seq]:
+                    continue
+                self.retransmitted.add(seq)
+                self.retransmits += 1
+            else:
+                seq = self.next_seq
+                self.next_seq += 1
+            self.send_packet(seq)
+            self.sent_at.pop(seq, None)
+            self.sent_at[seq] = now
+            sent += 1
+        if sent and self.srtt is not None:
+            # Spread one congestion window over one round trip
+            self.next_send = now + sent * self.srtt / max(self.cwnd, 1.0)
+
+    def send_packet(self, seq):
+        self.packets_sent += 1
+        if self.loss_rate and random.random() < self.loss_rate:
+            return
+        view = memoryview(self.packet)
+        offset = seq * self.chunk_size
+        if self.data is not None:
+            n = min(self.chunk_size, self.size - offset)
+            view[DATA_HEADER.size:DATA_HEADER.size + n] = self.data[offset:offset + n]
+        else:
+            self.file.seek(offset)
+            n = self.file.readinto(view[DATA_HEADER.size:])
+        datagram = view[:DATA_HEADER.size + n]
+        DATA_HEADER.pack_into(self.packet, 0, DATA, self.transfer_id, seq)
+        if self.codec is not None:
+            packed = self.codec.compress(view[DATA_HEADER.size:DATA_HEADER.size + n])
+            if len(packed) < n:
+                datagram = DATA_HEADER.pack(DATA_COMPRESSED, self.transfer_id, seq) + packed
+                self.compressed += 1
+            elif self.packets_sent >= COMPRESS_PROBE and not self.compressed:
+                self.codec = None # Nothing has shrunk so far; stop spending CPU on it
+        try:
+            self.sock.sendto(datagram, self.addr)
+        except (BlockingIOError, InterruptedError):
+            pass # Treated like a lost datagram; the retransmit timer covers it
+
+    def read_acks(self):
+        progress = False
+        while True:
+            try:
+                data = self.sock.recv(ACK_HEADER.size + SACK_BYTES)
+            except (BlockingIOError, InterruptedError):
+                return progress
+            except OSError:
+                # e.g. ICMP port unreachable surfacing on the socket
+                return progress
+            if len(data) < ACK_HEADER.size:
+                continue
+            kind, transfer_id, cum = ACK_HEADER.unpack_from(data)
+            if kind != ACK or transfer_id != self.transfer_id:
+                continue
+            if self.on_ack(min(cum, self.total), int.from_bytes(data[ACK_HEADER.size:], "little")):
+                progress = True
+
+    def on_ack(self, cum, bits):
+        now = time.monotonic()
+        newly_acked = 0
+        if cum < self.cum:
+            # A stale ACK overtaken by a newer one; line its bitmap up with our cumulative ack
+            bits >>= self.cum - cum
+            cum = self.cum
+        if cum > self.cum:
+            for seq in range(self.cum, cum):
+                if self.mark_acked(seq, now):
+                    newly_acked += 1
+            self.sack >>= cum - self.cum
+            self.cum = cum
+        new_bits = bits & ~self.sack
+        self.sack |= new_bits
+        while new_bits:
+            low = new_bits & -new_bits
+            seq = cum + low.bit_length() - 1
+            new_bits ^= low
+            if seq < self.total and self.mark_acked(seq, now):
+                newly_acked += 1
+        if bits:
+            self.highest_acked = max(self.highest_acked, cum + bits.bit_length() - 1)
+        else:
+            self.highest_acked = max(self.highest_acked, cum - 1)
+
+        if newly_acked:
+            if self.cwnd < self.ssthresh:
+                self.cwnd += newly_acked
+            else:
+                self.cwnd += newly_acked / self.cwnd
+            self.cwnd = min(self.cwnd, float(MAX_WINDOW))
+            self.detect_losses()
+        return newly_acked > 0
+
+    def mark_acked(self, seq, now):
+        if self.acked[seq]:
+            return False
+        self.acked[seq] = 1
+        sent = self.sent_at.pop(seq, None)
+        if sent is not None:
+            self.newest_acked_send = max(self.newest_acked_send, sent)
+            if seq not in self.retransmitted:
+                self.update_rtt(now - sent)
+        return True
+
+    def update_rtt(self, sample):
+        if self.srtt is None:
+            self.srtt = sample
+            self.rttvar = sample / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - sample)
+            self.srtt = 0.875 * self.srtt + 0.125 * sample
+        self.rto = min(MAX_RTO, max(MIN_RTO, self.srtt + 4 * self.rttvar))
+
+    def detect_losses(self):
+        # sent_at is in send order, so stop at the first packet sent after the newest acked one
+        while self.sent_at:
+            seq, sent = next(iter(self.sent_at.items()))
+            if sent > self.newest_acked_send or seq + REORDER_THRESHOLD > self.highest_acked:
+                break
+            del self.sent_at[seq]
+            self.on_loss(seq)
+
+    def check_timeouts(self, now):
+        timed_out = False
+        while self.sent_at:
+            seq, sent = next(iter(self.sent_at.items()))
+            if sent + self.rto > now:
+                break
+            del self.sent_at[seq]
+            self.on_loss(seq)
+            timed_out = True
+        if timed_out:
+            self.rto = min(MAX_RTO, self.rto * 2)
+
+    def on_loss(self, seq):
+        self.lost.append(seq)
+        if seq >= self.recovery_until:
+            # One window cut per loss episode
+            self.ssthresh = max(self.cwnd / 2, 2.0)
+            self.cwnd = self.ssthresh
+            self.recovery_until = self.next_seq
+
+class UdpReceiver:
+    """
+    Receives one file on an already bound UDP socket. Packets are written to
+    their own offset in 'f', so arrival order does not matter.
+    """
+
+    def __init__(self, sock, f, size, transfer_id, chunk_size=CHUNK_SIZE, codec=None):
+        self.sock = sock
+        self.file = f
+        self.codec = codec
+        self.size = size
+        self.transfer_id = transfer_id
+        self.chunk_size = chunk_size
+        self.total = packet_count(size, chunk_size)
+        self.cum = 0
+        self.bits = 0 # Bit i set: packet cum + i arrived out of order
+        self.count = 0
+        self.sender = None
+        self.duplicates = 0
+        self.finished = None # time.monotonic() when the last packet arrived, before the linger
+
+    def run(self):
+        buf = bytearray(DATA_HEADER.size + self.chunk_size)
+        view = memoryview(buf)
+        self.file.truncate(self.size)
+        self.sock.setblocking(False)
+        last_data = time.monotonic()
+        while self.count < self.total:
+            readable, _, _ = select.select([self.sock], [], [], MIN_RTO)
+            if not readable:
+                if time.monotonic() - last_data > IDLE_TIMEOUT:
+                    return False
+                if self.sender:
+                    self.send_ack()
+                continue
+            # Drain everything queued, acking every ACK_EVERY packets, on any gap, and once the queue is empty
+            unacked = 0
+            while True:
+                try:
+                    n, addr = self.sock.recvfrom_into(buf)
+                except (BlockingIOError, InterruptedError):
+                    break
+                except OSError:
+                    continue
+                in_order = self.on_data(view, n, addr)
+                if in_order is None:
+                    continue
+                unacked += 1
+                if unacked >= ACK_EVERY or not in_order:
+                    self.send_ack()
+                    unacked = 0
+            if unacked:
+                self.send_ack()
+            last_data = time.monotonic()
+        self.finished = last_data
+        self.linger(buf, view)
+        return True
+
+    def on_data(self, view, n, addr):
+        """Stores one DATA datagram. Returns None if it is not ours, else whether it arrived in order."""
+        if n < DATA_HEADER.size:
+            return None
+        kind, transfer_id, seq = DATA_HEADER.unpack_from(view)
+        if kind not in (DATA, DATA_COMPRESSED) or transfer_id != self.transfer_id or seq >= self.total:
+            return None
+        chunk = view[DATA_HEADER.size:n]
+        if kind == DATA_COMPRESSED:
+            if self.codec is None:
+                return None
+            try:
+                chunk = self.codec.decompress(chunk, self.chunk_size)
+            except Exception:
+                return None # Corrupt; the sender will resend it
+        self.sender = addr
+        offset = seq - self.cum
+        if offset < 0 or offset >= MAX_WINDOW or (self.bits >> offset) & 1:
+            self.duplicates += 1
+            return False
+        self.file.seek(seq * self.chunk_size)
+        self.file.write(chunk)
+        self.count += 1
+        self.bits |= 1 << offset
+        # Slide the cumulative ack past the run of packets that are now complete
+        run = (~self.bits & (self.bits + 1)).bit_length() - 1
+        self.bits >>= run
+        self.cum += run
+        return offset == 0
+
+    def send_ack(self):
+        packet = ACK_HEADER.pack(ACK, self.transfer_id, self.cum) + self.bits.to_bytes(SACK_BYTES, "little")
+        try:
+            self.sock.sendto(packet, self.sender)
+        except OSError:
+            pass
+
+    def linger(self, buf, view):
+        if not self.sender:
+            return
+        self.send_ack()
+        deadline = time.monotonic() + LINGER
+        while time.monotonic() < deadline:
+            readable, _, _ = select.select([self.sock], [], [], MIN_RTO)
+            if not readable:
+                continue
+            try:
+                n, addr = self.sock.recvfrom_into(buf)
+            except OSError:
+                continue
+            if self.on_data(view, n, addr) is not None:
+                self.send_ack()
@@ -0,0 +1,97 @@
+import socket
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+class WorkerPool:
+    """
+    Runs blocking file work (directory listings, file opens, UDP streaming)
+    on a fixed set of threads so the event loop never waits on disk or on a
+    UDP transfer. Each owner (a client socket) may only have 'per_owner'
+    jobs running; extra jobs wait in that owner's queue.
+
+    Completion callbacks run on the event loop thread: workers push results
+    onto a deque and write one byte to a socketpair that the loop watches,
+    and the loop then calls run_callbacks().
+    """
+
+    def __init__(self, max_workers, per_owner, max_waiting):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="file-worker")
+        self.per_owner = per_owner
+        self.max_waiting = max_waiting
+        self.running = {} # owner -> number of jobs on a worker thread
+        self.waiting = {} # owner -> deque of (fn, args, callback, started, discarded)
+        self.waiting_count = 0
+        self.completed = deque() # (owner, callback, result, error), filled by workers
+        self.wake_recv, self.wake_send = socket.socketpair()
+        self.wake_recv.setblocking(False)
+        self.wake_send.setblocking(False)
+
+    def fileno(self):
+        return self.wake_recv.fileno()
+
+    def submit(self, owner, fn, args, callback, started=None, discarded=None):
+        """
+        Queues fn(*args); callback(result, error) runs on the loop. Returns False if the pool is full.
+        started() runs on the loop as the job is handed to a thread, and discarded() instead
+        if cancel() drops it before then, to release whatever its arguments hold.
+        """
+        if self.running.get(owner, 0) < self.per_owner:
+            self.start(owner, fn, args, callback, started)
+            return True
+        if self.waiting_count >= self.max_waiting:
+            return False
+        self.waiting.setdefault(owner, deque()).append((fn, args, callback, started, discarded))
+        self.waiting_count += 1
+        return True
+
+    def start(self, owner, fn, args, callback, started=None, discarded=None):
+        self.running[owner] = self.running.get(owner, 0) + 1
+        if started is not None:
+            started()
+        self.executor.submit(self.work, owner, fn, args, callback)
+
+    def work(self, owner, fn, args, callback):
+        try:
+            result, error = fn(*args), None
+        except Exception as e:
+            result, error = None, e
+        self.completed.append((owner, callback, result, error))
+        try:
+            self.wake_send.send(b"\0")
+        except BlockingIOError:
+            pass # The loop already has wakeups pending
+
+    def run_callbacks(self):
+        try:
+            while self.wake_recv.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while self.completed:
+            owner, callback, result, error = self.completed.popleft()
+            self.running[owner] -= 1
+            if not self.running[owner]:
+                del self.running[owner]
+            queue = self.waiting.get(owner)
+            if queue:
+                self.waiting_count -= 1
+                self.start(owner, *queue.popleft())
+                if not queue:
+                    del self.waiting[owner]
+            callback(result, error)
+
+    def cancel(self, owner):
+        """Forgets jobs that have not started yet; running jobs still report back."""
+        queue = self.waiting.pop(owner, ())
+        self.waiting_count -= len(queue)
+        for _, _, _, _, discarded in queue:
+            if discarded is not None:
+                discarded()
+
+    def active(self):
+        return sum(self.running.values()) + self.waiting_count
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.wake_recv.close()
+        self.wake_send.close()